@@ -3,7 +3,8 @@
 from .qqbotcls import QQBot, QQBotSlot, QQBotSched, RunBot, _bot
 from .qterm import QTerm
 from .common import AutoTest
-from .mainloop import MainLoop, Put, PutTo, AddWorkerTo
+from .mainloop import MainLoop, Put, PutTo, AddWorkerTo, PutTask, PutToTask
+from .mainloop import SetPool, Submit, SubmitTo
 from .qconf import version
 Main = RunBot
 qqbotslot = QQBotSlot
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+# 基于 asyncio 的简易 HTTP/1.1 客户端（仅支持 python3.5 及以上版本）
+# 多个 AsyncHttpSession 可以共用同一个 ConnectionPool ：每个 session 有自己的
+# headers 和 cookies ，而 keep-alive 连接统一放在 pool 中复用。
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import asyncio, ssl, zlib, time, collections, email.utils
+
+from urllib.parse import urlsplit, urljoin, urlencode
+
+class HttpError(Exception):
+    pass
+
+class HttpConnectionError(HttpError):
+    pass
+
+class HttpSSLError(HttpConnectionError):
+    pass
+
+class HttpTimeout(HttpError):
+    pass
+
+class Response(object):
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def __repr__(self):
+        return '<Response [%d]>' % self.status_code
+
+class ConnectionPool(object):
+    def __init__(self, maxPerHost=10, idleTimeout=60):
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.idle = collections.defaultdict(list)
+        self.sems = {}
+        self.sslContexts = {}
+        self.nOpen, self.nReuse = 0, 0
+
+    def sslContext(self, verify):
+        if verify not in self.sslContexts:
+            ctx = ssl.create_default_context()
+            if not verify:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            self.sslContexts[verify] = ctx
+        return self.sslContexts[verify]
+
+    async def acquire(self, scheme, host, port, verify):
+        key = (scheme, host, port, verify)
+        if key not in self.sems:
+            self.sems[key] = asyncio.Semaphore(self.maxPerHost)
+        sem = self.sems[key]
+        await sem.acquire()
+        try:
+            idle = self.idle[key]
+            while idle:
+                reader, writer, t = idle.pop()
+                if time.time() - t < self.idleTimeout and \
+                        not reader.at_eof() and \
+                        not writer.transport.is_closing():
+                    self.nReuse += 1
+                    return key, reader, writer, True
+                writer.close()
+
+            if scheme == 'https':
+                reader, writer = await asyncio.open_connection(
+                    host, port, ssl=self.sslContext(verify),
+                    server_hostname=host
+                )
+            else:
+                reader, writer = await asyncio.open_connection(host, port)
+            self.nOpen += 1
+            return key, reader, writer, False
+        except:
+            sem.release()
+            raise
+
+    def release(self, key, reader, writer, reusable):
+        if reusable:
+            self.idle[key].append((reader, writer, time.time()))
+        else:
+            writer.close()
+        self.sems[key].release()
+
+    def Close(self):
+        for idle in self.idle.values():
+            for reader, writer, t in idle:
+                writer.close()
+        self.idle.clear()
+
+class AsyncHttpSession(object):
+    def __init__(self, pool=None):
+        self.pool = ConnectionPool() if pool is None else pool
+        self.headers = {}
+        self.cookies = {}
+        self.verify = True
+
+    async def get(self, url, timeout=30):
+        return await self.request('GET', url, None, timeout)
+
+    async def post(self, url, data, timeout=30):
+        return await self.request('POST', url, data, timeout)
+
+    async def request(self, method, url, data=None, timeout=30,
+                      maxRedirects=10):
+        try:
+            return await asyncio.wait_for(
+                self.send(method, url, data, maxRedirects), timeout
+            )
+        except asyncio.TimeoutError:
+            raise HttpTimeout('%s %s 超时（%s秒）' % (method, url, timeout))
+
+    async def send(self, method, url, data, maxRedirects):
+        for i in range(maxRedirects + 1):
+            resp = await self.fetch(method, url, data)
+            if resp.status_code in (301, 302, 303, 307, 308) and \
+                    'location' in resp.headers:
+                url = urljoin(url, resp.headers['location'])
+                if resp.status_code in (301, 302, 303):
+                    method, data = 'GET', None
+            else:
+                return resp
+        raise HttpError('重定向次数过多：%s' % url)
+
+    async def fetch(self, method, url, data):
+        u = urlsplit(url)
+        scheme = u.scheme.lower()
+        port = u.port or (scheme == 'https' and 443 or 80)
+        path = (u.path or '/') + (u.query and ('?' + u.query) or '')
+
+        if data is None:
+            body = b''
+        elif isinstance(data, dict):
+            body = urlencode(data).encode('utf8')
+        elif isinstance(data, str):
+            body = data.encode('utf8')
+        else:
+            body = data
+
+        headers = dict(self.headers)
+        headers['Host'] = u.netloc
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        headers['Connection'] = 'keep-alive'
+        if body or method == 'POST':
+            headers['Content-Length'] = str(len(body))
+        if self.cookies:
+            headers['Cookie'] = '; '.join(
+                '%s=%s' % kv for kv in self.cookies.items()
+            )
+
+        head = ['%s %s HTTP/1.1' % (method, path)]
+        head.extend('%s: %s' % kv for kv in headers.items())
+        req = ('\r\n'.join(head) + '\r\n\r\n').encode('utf8') + body
+
+        # 从 pool 中取出的连接可能已被服务器关闭，此时换一个新连接再试一次
+        for attempt in (0, 1):
+            try:
+                key, reader, writer, reused = await self.pool.acquire(
+                    scheme, u.hostname, port, self.verify
+                )
+            except ssl.SSLError as e:
+                raise HttpSSLError(e)
+            except OSError as e:
+                raise HttpConnectionError(e)
+
+            reusable = False
+            try:
+                writer.write(req)
+                await writer.drain()
+                status, respHeaders, setCookies, content, reusable = \
+                    await readResponse(reader, method)
+            except ssl.SSLError as e:
+                raise HttpSSLError(e)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                if reused and attempt == 0:
+                    continue
+                raise HttpConnectionError(e)
+            finally:
+                self.pool.release(key, reader, writer, reusable)
+            break
+
+        for s in setCookies:
+            setCookie(self.cookies, s)
+
+        encoding = respHeaders.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                content = zlib.decompress(content)
+            except zlib.error:
+                content = zlib.decompress(content, -zlib.MAX_WBITS)
+
+        return Response(url, status, respHeaders, content)
+
+async def readResponse(reader, method):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError('连接已被服务器关闭')
+
+    parts = line.decode('latin-1').split(None, 2)
+    version, status = parts[0].upper(), int(parts[1])
+
+    headers, setCookies = {}, []
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        k, sep, v = line.decode('latin-1').partition(':')
+        k, v = k.strip().lower(), v.strip()
+        if k == 'set-cookie':
+            setCookies.append(v)
+        else:
+            headers[k] = v
+
+    keepAlive = version == 'HTTP/1.1' and \
+                headers.get('connection', '').lower() != 'close'
+
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        content = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        content = b''.join(chunks)
+    elif 'content-length' in headers:
+        content = await reader.readexactly(int(headers['content-length']))
+    else:
+        content = await reader.read()
+        keepAlive = False
+
+    return status, headers, setCookies, content, keepAlive
+
+# SmartQQ 的 cookie 都在 qq.com 域下，这里只按名字保存 cookie ，不区分 domain/path
+def setCookie(cookies, setCookieStr):
+    first, sep, attrs = setCookieStr.partition(';')
+    name, sep, value = first.partition('=')
+    name, value = name.strip(), value.strip()
+    if not name:
+        return
+
+    expired = False
+    for attr in attrs.split(';'):
+        k, sep, v = attr.strip().partition('=')
+        k, v = k.lower(), v.strip()
+        if k == 'max-age':
+            try:
+                expired = int(v) <= 0
+            except ValueError:
+                pass
+        elif k == 'expires':
+            t = email.utils.parsedate_tz(v)
+            if t is not None:
+                expired = email.utils.mktime_tz(t) < time.time()
+
+    if expired:
+        cookies.pop(name, None)
+    else:
+        cookies[name] = value
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+# 基于 asyncio 的 QQ 会话（仅支持 python3.5 及以上版本）
+# 与 BasicQSession 的接口相同，但所有 IO 方法都是协程。所有请求在同一个事件循环
+# 中进行，连接由 ConnectionPool 统一管理（多个 AsyncQSession 可共用一个 pool），
+# 因此 Poll/SendTo/smartRequest 可以并发执行，无需为每种任务 Copy 一个会话。
+#
+# 用法：
+#     session = AsyncQSession()
+#     await session.Login(conf)
+#     ctype, fromUin, membUin, content = await session.Poll()
+#     await session.SendTo(contact, 'hello')
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import asyncio, random
+
+from qqbot.asynchttp import AsyncHttpSession, HttpConnectionError
+from qqbot.asynchttp import HttpSSLError, HttpTimeout
+from qqbot.basicqsession import RequestError, POLL_URL, LOGIN_URL, HEADERS
+from qqbot.basicqsession import INIT_COOKIES, qrcodeUrl, authStatusArgs
+from qqbot.basicqsession import onAuthorized, vfwebqqArgs, login2Args
+from qqbot.basicqsession import testLoginArgs, pollArgs, sendArgs
+from qqbot.basicqsession import checkSendTo, judgeResponse, pollItems
+from qqbot.basicqsession import pinghotUrl, redirectUrl, qHash, bknHash
+from qqbot.basicqsession import urlTimeout
+from qqbot.retrypolicy import GetPolicy, ShouldPing, ERROR_NAMES
+from qqbot.qrcodemanager import QrcodeManager
+from qqbot.utf8logger import CRITICAL, ERROR, WARN, INFO, DEBUG
+from qqbot.utf8logger import DisableLog, EnableLog
+from qqbot.common import Partition
+
+class AsyncQSession(object):
+
+    # 同 BasicQSession.redirectTo
+    redirectTo = None
+
+    # 等待二维码授权时查询扫描状态的间隔（秒）
+    authInterval = 3
+
+    def __init__(self, pool=None, redirectTo=None):
+        self.pool = pool
+        if redirectTo:
+            self.redirectTo = redirectTo
+
+    async def Login(self, conf):
+        await self.prepareSession()
+        await self.waitForAuth(conf)
+        await self.getPtwebqq()
+        await self.getVfwebqq()
+        await self.getUinAndPsessionid()
+        await self.TestLogin()
+
+    async def prepareSession(self):
+        self.clientid = 53999199
+        self.msgId = 6000000
+        self.session = AsyncHttpSession(self.pool)
+        self.session.headers.update(HEADERS)
+        await self.urlGet(LOGIN_URL)
+        self.session.cookies.update(INIT_COOKIES)
+        await self.getAuthStatus()
+        self.session.cookies.pop('qrsig')
+
+    async def getQrcode(self):
+        qrcode = (await self.urlGet(qrcodeUrl())).content
+        INFO('已获取二维码')
+        return qrcode
+
+    async def waitForAuth(self, conf):
+        qrcodeManager = QrcodeManager(conf)
+        try:
+            qrcodeManager.Show(await self.getQrcode())
+            x, y = 1, 1
+            while True:
+                await asyncio.sleep(self.authInterval)
+                authStatus = await self.getAuthStatus()
+                if '二维码未失效' in authStatus:
+                    if x:
+                        INFO('等待二维码扫描及授权...')
+                        x = 0
+                elif '二维码认证中' in authStatus:
+                    if y:
+                        INFO('二维码已扫描，等待授权...')
+                        y = 0
+                elif '二维码已失效' in authStatus:
+                    WARN('二维码已失效, 重新获取二维码')
+                    qrcodeManager.Show(await self.getQrcode())
+                    x, y = 1, 1
+                elif '登录成功' in authStatus:
+                    INFO('已获授权')
+                    onAuthorized(self, conf, authStatus,
+                                 self.session.cookies['superuin'])
+                    break
+                else:
+                    CRITICAL('获取二维码扫描状态时出错, html="%s"', authStatus)
+                    sys.exit(1)
+        finally:
+            qrcodeManager.Destroy()
+
+    async def getAuthStatus(self):
+        result = await self.urlGet(
+            **authStatusArgs(self.session.cookies['qrsig'])
+        )
+        return result.content.decode('utf8')
+
+    async def getPtwebqq(self):
+        await self.urlGet(self.urlPtwebqq)
+        self.ptwebqq = self.session.cookies['ptwebqq']
+        INFO('已获取ptwebqq')
+
+    async def getVfwebqq(self):
+        result = await self.smartRequest(**vfwebqqArgs(self))
+        self.vfwebqq = result['vfwebqq']
+        INFO('已获取vfwebqq')
+
+    async def getUinAndPsessionid(self):
+        result = await self.smartRequest(**login2Args(self))
+        self.uin = result['uin']
+        self.psessionid = result['psessionid']
+        self.hash = qHash(self.uin, self.ptwebqq)
+        self.bkn = bknHash(self.session.cookies['skey'])
+        INFO('已获取uin和psessionid')
+
+    async def TestLogin(self):
+        try:
+            DisableLog()
+            await self.smartRequest(**testLoginArgs(self))
+        finally:
+            EnableLog()
+
+        INFO('登录成功。登录账号：%s(%s)', self.nick, self.qq)
+
+    async def Poll(self):
+        if not getattr(self, 'pollBuffer', None):
+            self.pollBuffer = [item for msgId, item in await self.PollAll()] \
+                              or [('timeout', '', '', '')]
+        return self.pollBuffer.pop(0)
+
+    async def PollAll(self):
+        try:
+            result = await self.smartRequest(**pollArgs(self))
+        except RequestError:
+            ERROR('接收消息出错，开始测试登录 cookie 是否过期...')
+            try:
+                await self.TestLogin()
+            except RequestError:
+                ERROR('登录 cookie 很可能已过期')
+                raise
+            else:
+                INFO('登录 cookie 尚未过期')
+                return []
+        else:
+            if (not result) or (not isinstance(result, list)):
+                DEBUG(result)
+                return []
+            else:
+                return pollItems(result)
+
+    async def send(self, ctype, uin, content, epCodes=[0]):
+        self.msgId += 1
+        await self.smartRequest(expectedCodes=epCodes,
+                                **sendArgs(self, ctype, uin, content))
+
+    async def SendTo(self, contact, content, resendOn1202=True):
+        content, result = checkSendTo(contact, content)
+
+        if result:
+            ERROR(result)
+            return result
+
+        epCodes = resendOn1202 and [0] or [0, 1202]
+
+        result = '向 %s 发消息成功' % (contact,)
+        while content:
+            front, content = Partition(content)
+            try:
+                await self.send(contact.ctype, contact.uin, front, epCodes)
+            except Exception as e:
+                result = '错误：向 %s 发消息失败 %s' % (str(contact), e)
+                ERROR(result, exc_info=(not isinstance(e, RequestError)))
+                break
+            else:
+                INFO('%s：%s' % (result, front))
+        return result
+
+    async def urlGet(self, url, data=None, Referer=None, Origin=None,
+                     timeout=None):
+        Referer and self.session.headers.update( {'Referer': Referer} )
+        Origin and self.session.headers.update( {'Origin': Origin} )
+        timeout = timeout or urlTimeout(url)
+        url = redirectUrl(url, self.redirectTo)
+
+        try:
+            if data is None:
+                return await self.session.get(url, timeout=timeout)
+            else:
+                return await self.session.post(url, data, timeout=timeout)
+        except HttpSSLError:
+            if self.session.verify:
+                ERROR('无法和腾讯服务器建立私密连接，'
+                      ' 5 秒后将尝试使用非私密连接和腾讯服务器通讯。')
+                await asyncio.sleep(5)
+                WARN('开始尝试使用非私密连接和腾讯服务器通讯。')
+                self.session.verify = False
+                return await self.urlGet(url, data, Referer, Origin,
+                                         timeout)
+            else:
+                raise
+
+    async def smartRequest(self, url, data=None, Referer=None, Origin=None,
+                           expectedCodes=(0,100003,100100), expectedKey=None,
+                           timeoutRetVal=None, repeatOnDeny=2, policy=None):
+        state = (policy or GetPolicy(url)).Begin(url, repeatOnDeny)
+        while True:
+            url = url.format(rand=repr(random.random()))
+            html = ''
+            if not state.Allow():
+                ERROR('接口“%s”已熔断，放弃请求', state.endpoint)
+                raise RequestError('接口“%s”已熔断' % state.endpoint)
+            try:
+                resp = await self.urlGet(url, data, Referer, Origin,
+                                         state.Remaining(urlTimeout(url)))
+            except (HttpConnectionError, HttpTimeout) as e:
+                error, errorInfo = 'CE', '网络错误 %s' % e
+            else:
+                html = resp.content.decode('utf8')
+                result, error = judgeResponse(
+                    resp.status_code, html, expectedCodes, expectedKey
+                )
+                if error is None:
+                    state.OnSuccess()
+                    return result
+                elif error == 'TO':
+                    if ShouldPing(state.policy):
+                        await self.session.get(
+                            redirectUrl(pinghotUrl(), self.redirectTo)
+                        )
+                    if url == POLL_URL:
+                        state.OnSuccess()
+                        return {'errmsg': ''}
+                errorInfo = ERROR_NAMES[error]
+
+            decision, delay = state.OnFailure(error, bool(timeoutRetVal))
+
+            if len(html) > 40:
+                html = html[:20] + '...' + html[-20:]
+
+            if decision == 'retry':
+                DEBUG('第%d次请求“%s”时出现 %s，html=%s，%.2f 秒后重试',
+                      state.N, url.split('?', 1)[0], errorInfo, repr(html),
+                      delay)
+                await asyncio.sleep(delay)
+            elif decision == 'timeout-value':
+                return timeoutRetVal
+            else:
+                ERROR('第%d次请求“%s”时出现 %s, html=%s',
+                      state.N, url.split('?', 1)[0], errorInfo, repr(html))
+                raise RequestError
+
+if __name__ == '__main__':
+    # 使用本地的 MockSmartQQ 服务器离线测试 AsyncQSession 的完整流程
+    import tempfile
+    from qqbot.qconf import QConf
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.asynchttp import ConnectionPool
+    from qqbot.qcontactdb.contactdb import ContactDB
+
+    server = MockSmartQQ()
+    server.Start()
+
+    async def main():
+        conf = QConf(['-b', tempfile.mkdtemp(), '-q', ''])
+        pool = ConnectionPool()
+        session = AsyncQSession(pool, server.url)
+        session.authInterval = 0.1
+        await session.Login(conf)
+
+        server.PushMessage('buddy', '1001', '', 'hello /微笑')
+        server.PushMessage('group', '2001', '20010001', 'hi')
+        buddy = ContactDB.NullContact('buddy', '1001')
+
+        # poll 的同时并发地发消息、获取好友列表
+        results = await asyncio.gather(
+            session.Poll(),
+            session.SendTo(buddy, 'hello ' * 300),
+            session.smartRequest(
+                url = 'http://s.web2.qq.com/api/get_user_friends2',
+                data = {'r': '{}'},
+                expectedKey = 'marknames'
+            )
+        )
+        for r in results:
+            print(repr(r)[:100])
+        print('sent: %r' % [m[:2] for m in server.sent])
+        print('connections opened: %d, reused: %d' % (pool.nOpen, pool.nReuse))
+        pool.Close()
+
+    asyncio.new_event_loop().run_until_complete(main())
+    server.Stop()
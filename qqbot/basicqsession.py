@@ -10,9 +10,10 @@ import random, pickle, time, requests
 from qqbot.qrcodemanager import QrcodeManager
 from qqbot.utf8logger import CRITICAL, ERROR, WARN, INFO, DEBUG
 from qqbot.utf8logger import DisableLog, EnableLog
-from qqbot.common import PY3, Partition, JsonLoads, JsonDumps
+from qqbot.common import PY3, Partition, JsonLoads, JsonDumps, UrlSplit
 from qqbot.facemap import FaceParse, FaceReverseParse
 from qqbot.mainloop import Put
+from qqbot.retrypolicy import GetPolicy, ShouldPing, ERROR_NAMES
 
 def disableInsecureRequestWarning():
     try:
@@ -29,6 +30,13 @@ class RequestError(Exception):
 
 class BasicQSession(object):
 
+    # 若设置为一个 url （如 MockSmartQQ 的地址），则所有请求都将转发到该地址
+    redirectTo = None
+
+    # 所有会话共用的 requests 连接池（多账号模式下由 QQBotHost 设置），
+    # 为 None 时每个会话使用各自的连接池
+    sharedAdapter = None
+
     def Login(self, conf):        
         self.prepareSession()
         self.waitForAuth(conf)
@@ -40,28 +48,11 @@ class BasicQSession(object):
     def prepareSession(self):
         self.clientid = 53999199
         self.msgId = 6000000
-        self.lastSendTime = 0
         self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9;'
-                           ' rv:27.0) Gecko/20100101 Firefox/27.0'),
-            'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'
-        })
-        self.urlGet(
-            'https://ui.ptlogin2.qq.com/cgi-bin/login?daid=164&target=self&'
-            'style=16&mibao_css=m_webqq&appid=501004106&enable_qlogin=0&'
-            'no_verifyimg=1&s_url=http%3A%2F%2Fw.qq.com%2Fproxy.html&'
-            'f_url=loginerroralert&strong_login=1&login_state=10&t=20131024001'
-        )
-        self.session.cookies.update({
-            'RK': 'OfeLBai4FB',
-            'pgv_pvi': '911366144',
-            'pgv_info': 'ssid pgv_pvid=1051433466',
-            'ptcz': ('ad3bf14f9da2738e09e498bfeb93dd9da7'
-                     '540dea2b7a71acfb97ed4d3da4e277'),
-            'qrsig': ('hJ9GvNx*oIvLjP5I5dQ19KPa3zwxNI'
-                      '62eALLO*g2JLbKPYsZIRsnbJIxNe74NzQQ')
-        })
+        self.session.headers.update(HEADERS)
+        self.mountSharedAdapter()
+        self.urlGet(LOGIN_URL)
+        self.session.cookies.update(INIT_COOKIES)
         self.getAuthStatus()
         self.session.cookies.pop('qrsig')
     
@@ -69,13 +60,16 @@ class BasicQSession(object):
         c = self.__class__()
         c.__dict__.update(self.__dict__)
         c.session = pickle.loads(pickle.dumps(c.session))
+        c.mountSharedAdapter()
         return c
 
+    def mountSharedAdapter(self):
+        if self.sharedAdapter is not None:
+            self.session.mount('http://', self.sharedAdapter)
+            self.session.mount('https://', self.sharedAdapter)
+
     def getQrcode(self):
-        qrcode = self.urlGet(
-            'https://ssl.ptlogin2.qq.com/ptqrshow?appid=501004106&e=0&l=M&' +
-            's=5&d=72&v=4&t=' + repr(random.random())
-        ).content
+        qrcode = self.urlGet(qrcodeUrl()).content
         INFO('已获取二维码')
         return qrcode
 
@@ -101,14 +95,8 @@ class BasicQSession(object):
                     x, y = 1, 1
                 elif '登录成功' in authStatus:
                     INFO('已获授权')
-                    items = authStatus.split(',')
-                    self.nick = str(items[-1].split("'")[1])
-                    self.qq = str(int(self.session.cookies['superuin'][1:]))
-                    self.urlPtwebqq = items[2].strip().strip("'")
-                    t = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(time.time()))
-                    self.dbbasename = '%s-%s-contact.db' % (t, self.qq)
-                    self.dbname = conf.absPath(self.dbbasename)
-                    conf.SetQQ(self.qq)
+                    onAuthorized(self, conf, authStatus,
+                                 self.session.cookies['superuin'])
                     break
                 else:
                     CRITICAL('获取二维码扫描状态时出错, html="%s"', authStatus)
@@ -117,22 +105,8 @@ class BasicQSession(object):
             qrcodeManager.Destroy()
 
     def getAuthStatus(self):
-        # by @zofuthan
         result = self.urlGet(
-            url='https://ssl.ptlogin2.qq.com/ptqrlogin?ptqrtoken=' + 
-                str(bknHash(self.session.cookies['qrsig'], init_str=0)) +
-                '&webqq_type=10&remember_uin=1&login2qq=1&aid=501004106' +
-                '&u1=http%3A%2F%2Fw.qq.com%2Fproxy.html%3Flogin2qq%3D1%26' +
-                'webqq_type%3D10&ptredirect=0&ptlang=2052&daid=164&' +
-                'from_ui=1&pttype=1&dumy=&fp=loginerroralert&action=0-0-' +
-                repr(random.random() * 900000 + 1000000) +
-                '&mibao_css=m_webqq&t=undefined&g=1&js_type=0' +
-                '&js_ver=10141&login_sig=&pt_randsalt=0',
-            Referer=('https://ui.ptlogin2.qq.com/cgi-bin/login?daid=164&'
-                     'target=self&style=16&mibao_css=m_webqq&appid=501004106&'
-                     'enable_qlogin=0&no_verifyimg=1&s_url=http%3A%2F%2F'
-                     'w.qq.com%2Fproxy.html&f_url=loginerroralert&'
-                     'strong_login=1&login_state=10&t=20131024001')
+            **authStatusArgs(self.session.cookies['qrsig'])
         ).content
         return result if not PY3 else result.decode('utf8')
 
@@ -142,29 +116,11 @@ class BasicQSession(object):
         INFO('已获取ptwebqq')
 
     def getVfwebqq(self):
-        self.vfwebqq = self.smartRequest(
-            url = ('http://s.web2.qq.com/api/getvfwebqq?ptwebqq=%s&'
-                   'clientid=%s&psessionid=&t={rand}') %
-                  (self.ptwebqq, self.clientid),
-            Referer = ('http://s.web2.qq.com/proxy.html?v=20130916001'
-                       '&callback=1&id=1'),
-            Origin = 'http://s.web2.qq.com'
-        )['vfwebqq']
+        self.vfwebqq = self.smartRequest(**vfwebqqArgs(self))['vfwebqq']
         INFO('已获取vfwebqq')
 
     def getUinAndPsessionid(self):
-        result = self.smartRequest(
-            url = 'http://d1.web2.qq.com/channel/login2',
-            data = {
-                'r': JsonDumps({
-                    'ptwebqq': self.ptwebqq, 'clientid': self.clientid,
-                    'psessionid': '', 'status': 'online'
-                })
-            },
-            Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001'
-                       '&callback=1&id=2'),
-            Origin = 'http://d1.web2.qq.com'
-        )
+        result = self.smartRequest(**login2Args(self))
         self.uin = result['uin']
         self.psessionid = result['psessionid']
         self.hash = qHash(self.uin, self.ptwebqq)
@@ -176,36 +132,24 @@ class BasicQSession(object):
             disableInsecureRequestWarning()
         try:
             DisableLog()
-            # 请求一下 get_online_buddies 页面，避免103错误。
-            # 若请求无错误发生，则表明登录成功
-            self.smartRequest(
-                url = ('http://d1.web2.qq.com/channel/get_online_buddies2?'
-                       'vfwebqq=%s&clientid=%d&psessionid=%s&t={rand}') %
-                      (self.vfwebqq, self.clientid, self.psessionid),
-                Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001&'
-                           'callback=1&id=2'),
-                Origin = 'http://d1.web2.qq.com',
-                repeatOnDeny = 0
-            )
+            self.smartRequest(**testLoginArgs(self))
         finally:
             EnableLog()
         
         INFO('登录成功。登录账号：%s(%s)', self.nick, self.qq)
 
+    # 每次返回一条消息 (ctype, fromUin, membUin, content) ，一次 poll 收到的
+    # 多条消息缓存在 pollBuffer 中，依次返回
     def Poll(self):
+        if not getattr(self, 'pollBuffer', None):
+            self.pollBuffer = [item for msgId, item in self.PollAll()] or \
+                              [('timeout', '', '', '')]
+        return self.pollBuffer.pop(0)
+
+    # 返回本次 poll 收到的所有消息 [(msgId, (ctype, fromUin, membUin, content))]
+    def PollAll(self):
         try:
-            result = self.smartRequest(
-                url = 'https://d1.web2.qq.com/channel/poll2',
-                data = {
-                    'r': JsonDumps({
-                        'ptwebqq':self.ptwebqq, 'clientid':self.clientid,
-                        'psessionid':self.psessionid, 'key':''
-                    })
-                },
-                Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001&'
-                           'callback=1&id=2'),
-                expectedCodes = (0, 100003, 100100, 100012)
-            )
+            result = self.smartRequest(**pollArgs(self))
         except RequestError:
             ERROR('接收消息出错，开始测试登录 cookie 是否过期...')
             try:
@@ -215,78 +159,21 @@ class BasicQSession(object):
                 raise
             else:
                 INFO('登录 cookie 尚未过期')
-                return 'timeout', '', '', ''
+                return []
         else:
             if (not result) or (not isinstance(result, list)):
                 DEBUG(result)
-                return 'timeout', '', '', ''
+                return []
             else:
-                result = result[0]
-                ctype = {
-                    'message': 'buddy',
-                    'group_message': 'group',
-                    'discu_message': 'discuss'
-                }[result['poll_type']]
-                fromUin = str(result['value']['from_uin'])
-                memberUin = str(result['value'].get('send_uin', ''))
-                content = FaceReverseParse(result['value']['content'])
-                return ctype, fromUin, memberUin, content
+                return pollItems(result)
 
     def send(self, ctype, uin, content, epCodes=[0]):
         self.msgId += 1
-        sendUrl = {
-            'buddy': 'http://d1.web2.qq.com/channel/send_buddy_msg2',
-            'group': 'http://d1.web2.qq.com/channel/send_qun_msg2',
-            'discuss': 'http://d1.web2.qq.com/channel/send_discu_msg2'
-        }
-        sendTag = {'buddy':'to', 'group':'group_uin', 'discuss':'did'}
-        self.smartRequest(
-            url = sendUrl[ctype],
-            data = {
-                'r': JsonDumps({
-                    sendTag[ctype]: int(uin),
-                    'content': JsonDumps(
-                        FaceParse(content) +
-                        [['font', {'name': '宋体', 'size': 10,
-                                  'style': [0,0,0], 'color': '000000'}]]
-                    ),
-                    'face': 522,
-                    'clientid': self.clientid,
-                    'msg_id': self.msgId,
-                    'psessionid': self.psessionid
-                })
-            },
-            Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001&'
-                       'callback=1&id=2'),
-            expectedCodes = epCodes
-        )
+        self.smartRequest(expectedCodes=epCodes,
+                          **sendArgs(self, ctype, uin, content))
     
     def SendTo(self, contact, content, resendOn1202=True):
-        result = None
-
-        if not hasattr(contact, 'ctype'):
-            result = '错误：消息接受者必须为一个 QContact 对象'
-        
-        if contact.ctype.endswith('-member'):
-            result = '错误：不能给群成员或讨论组成员发消息'
-        
-        if PY3:
-            if isinstance(content, str):
-                content = content
-            elif isinstance(content, bytes):
-                content = content.decode('utf8')
-            else:
-                result = '错误：消息内容必须为 str 或 bytes 对象'
-        else:
-            if isinstance(content, str):
-                content = content
-            elif isinstance(content, unicode):
-                content = content.encode('utf8')
-            else:
-                result = '错误：消息内容必须为 str 或 unicode 对象'
-
-        if not content:
-            result = '错误：不允许发送空消息'
+        content, result = checkSendTo(contact, content)
 
         if result:
             ERROR(result)
@@ -294,7 +181,7 @@ class BasicQSession(object):
         
         epCodes = resendOn1202 and [0] or [0, 1202]
 
-        result = '向 %s 发消息成功' % contact
+        result = '向 %s 发消息成功' % (contact,)
         while content:
             front, content = Partition(content)
             try:
@@ -307,10 +194,11 @@ class BasicQSession(object):
                 INFO('%s：%s' % (result, front))
         return result
 
-    def urlGet(self, url, data=None, Referer=None, Origin=None):
+    def urlGet(self, url, data=None, Referer=None, Origin=None, timeout=None):
         Referer and self.session.headers.update( {'Referer': Referer} )
         Origin and self.session.headers.update( {'Origin': Origin} )
-        timeout = 30 if url != 'https://d1.web2.qq.com/channel/poll2' else 120
+        timeout = timeout or urlTimeout(url)
+        url = redirectUrl(url, self.redirectTo)
             
         try:
             if data is None:
@@ -332,82 +220,294 @@ class BasicQSession(object):
                 WARN('开始尝试使用非私密连接和腾讯服务器通讯。')
                 self.session.verify = False
                 disableInsecureRequestWarning()
-                return self.urlGet(url, data, Referer, Origin)
+                return self.urlGet(url, data, Referer, Origin, timeout)
             else:
                 raise
 
     def smartRequest(self, url, data=None, Referer=None, Origin=None,
                      expectedCodes=(0,100003,100100), expectedKey=None,
-                     timeoutRetVal=None, repeatOnDeny=2):
-        nCE, nTO, nUE, nDE = 0, 0, 0, 0
+                     timeoutRetVal=None, repeatOnDeny=2, policy=None):
+        state = (policy or GetPolicy(url)).Begin(url, repeatOnDeny)
         while True:
             url = url.format(rand=repr(random.random()))
             html = ''
-            errorInfo = ''
+            if not state.Allow():
+                ERROR('接口“%s”已熔断，放弃请求', state.endpoint)
+                raise RequestError('接口“%s”已熔断' % state.endpoint)
             try:
-                resp = self.urlGet(url, data, Referer, Origin)
+                resp = self.urlGet(url, data, Referer, Origin,
+                                   state.Remaining(urlTimeout(url)))
             except (requests.ConnectionError,
                     requests.exceptions.ReadTimeout) as e:
-                nCE += 1
-                errorInfo = '网络错误 %s' % e
+                error, errorInfo = 'CE', '网络错误 %s' % e
             else:
                 html = resp.content if not PY3 else resp.content.decode('utf8')
-                if resp.status_code in (502, 504, 404):
-                    self.session.get(
-                        ('http://pinghot.qq.com/pingd?dm=w.qq.com.hot&'
-                         'url=/&hottag=smartqq.im.polltimeout&hotx=9999&'
-                         'hoty=9999&rand=%s') % random.randint(10000, 99999)
-                    )
-                    if url == 'https://d1.web2.qq.com/channel/poll2':
+                result, error = judgeResponse(
+                    resp.status_code, html, expectedCodes, expectedKey
+                )
+                if error is None:
+                    state.OnSuccess()
+                    return result
+                elif error == 'TO':
+                    if ShouldPing(state.policy):
+                        self.session.get(
+                            redirectUrl(pinghotUrl(), self.redirectTo)
+                        )
+                    if url == POLL_URL:
+                        state.OnSuccess()
                         return {'errmsg': ''}
-                    nTO += 1
-                    errorInfo = '超时'
-                else:
-                    try:
-                        rst = JsonLoads(html)
-                    except ValueError:
-                        nUE += 1
-                        errorInfo = ' URL 地址错误'
-                    else:
-                        result = rst.get('result', rst)
-                        
-                        if expectedKey:
-                            if expectedKey in result:
-                                return result
-                        else:                        
-                            if 'retcode' in rst:
-                                retcode = rst['retcode']
-                            elif 'errCode' in rst:
-                                retcode = rst['errCode']
-                            elif 'ec' in rst:
-                                retcode = rst['ec']
-                            else:
-                                retcode = -1
-    
-                            if (retcode in expectedCodes):
-                                return result
+                errorInfo = ERROR_NAMES[error]
 
-                        nDE += 1
-                        errorInfo = '请求被拒绝错误'
-            
-            n = nCE + nTO + nUE+ nDE
+            decision, delay = state.OnFailure(error, bool(timeoutRetVal))
             
             if len(html) > 40:
                 html = html[:20] + '...' + html[-20:]
 
-            # 出现网络错误、超时、 URL 地址错误可以多试几次 
-            # 若网络没有问题但 retcode 有误，一般连续 3 次都出错就没必要再试了
-            if nCE < 5 and nTO < 20 and nUE < 5 and nDE <= repeatOnDeny:
-                DEBUG('第%d次请求“%s”时出现 %s，html=%s',
-                      n, url.split('?', 1)[0], errorInfo, repr(html))
-                time.sleep(0.5)
-            elif nTO == 20 and timeoutRetVal: # by @killerhack
+            if decision == 'retry':
+                DEBUG('第%d次请求“%s”时出现 %s，html=%s，%.2f 秒后重试',
+                      state.N, url.split('?', 1)[0], errorInfo, repr(html),
+                      delay)
+                time.sleep(delay)
+            elif decision == 'timeout-value': # by @killerhack
                 return timeoutRetVal
             else:
                 ERROR('第%d次请求“%s”时出现 %s, html=%s',
-                      n, url.split('?', 1)[0], errorInfo, repr(html))
+                      state.N, url.split('?', 1)[0], errorInfo, repr(html))
                 raise RequestError
 
+POLL_URL = 'https://d1.web2.qq.com/channel/poll2'
+
+LOGIN_URL = (
+    'https://ui.ptlogin2.qq.com/cgi-bin/login?daid=164&target=self&'
+    'style=16&mibao_css=m_webqq&appid=501004106&enable_qlogin=0&'
+    'no_verifyimg=1&s_url=http%3A%2F%2Fw.qq.com%2Fproxy.html&'
+    'f_url=loginerroralert&strong_login=1&login_state=10&t=20131024001'
+)
+
+HEADERS = {
+    'User-Agent': ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9;'
+                   ' rv:27.0) Gecko/20100101 Firefox/27.0'),
+    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'
+}
+
+INIT_COOKIES = {
+    'RK': 'OfeLBai4FB',
+    'pgv_pvi': '911366144',
+    'pgv_info': 'ssid pgv_pvid=1051433466',
+    'ptcz': ('ad3bf14f9da2738e09e498bfeb93dd9da7'
+             '540dea2b7a71acfb97ed4d3da4e277'),
+    'qrsig': ('hJ9GvNx*oIvLjP5I5dQ19KPa3zwxNI'
+              '62eALLO*g2JLbKPYsZIRsnbJIxNe74NzQQ')
+}
+
+def qrcodeUrl():
+    return ('https://ssl.ptlogin2.qq.com/ptqrshow?appid=501004106&e=0&l=M&' +
+            's=5&d=72&v=4&t=' + repr(random.random()))
+
+def authStatusArgs(qrsig):
+    # by @zofuthan
+    return dict(
+        url='https://ssl.ptlogin2.qq.com/ptqrlogin?ptqrtoken=' + 
+            str(bknHash(qrsig, init_str=0)) +
+            '&webqq_type=10&remember_uin=1&login2qq=1&aid=501004106' +
+            '&u1=http%3A%2F%2Fw.qq.com%2Fproxy.html%3Flogin2qq%3D1%26' +
+            'webqq_type%3D10&ptredirect=0&ptlang=2052&daid=164&' +
+            'from_ui=1&pttype=1&dumy=&fp=loginerroralert&action=0-0-' +
+            repr(random.random() * 900000 + 1000000) +
+            '&mibao_css=m_webqq&t=undefined&g=1&js_type=0' +
+            '&js_ver=10141&login_sig=&pt_randsalt=0',
+        Referer=('https://ui.ptlogin2.qq.com/cgi-bin/login?daid=164&'
+                 'target=self&style=16&mibao_css=m_webqq&appid=501004106&'
+                 'enable_qlogin=0&no_verifyimg=1&s_url=http%3A%2F%2F'
+                 'w.qq.com%2Fproxy.html&f_url=loginerroralert&'
+                 'strong_login=1&login_state=10&t=20131024001')
+    )
+
+def onAuthorized(self, conf, authStatus, superuin):
+    items = authStatus.split(',')
+    self.nick = str(items[-1].split("'")[1])
+    self.qq = str(int(superuin[1:]))
+    self.urlPtwebqq = items[2].strip().strip("'")
+    # 同一 QQ 号的联系人数据库在重新登录后继续使用（见 qcontactdb/contactdb.py ）
+    self.dbbasename = '%s-contact.db' % self.qq
+    self.dbname = conf.absPath(self.dbbasename)
+    conf.SetQQ(self.qq)
+
+def vfwebqqArgs(self):
+    return dict(
+        url = ('http://s.web2.qq.com/api/getvfwebqq?ptwebqq=%s&'
+               'clientid=%s&psessionid=&t={rand}') %
+              (self.ptwebqq, self.clientid),
+        Referer = ('http://s.web2.qq.com/proxy.html?v=20130916001'
+                   '&callback=1&id=1'),
+        Origin = 'http://s.web2.qq.com'
+    )
+
+def login2Args(self):
+    return dict(
+        url = 'http://d1.web2.qq.com/channel/login2',
+        data = {
+            'r': JsonDumps({
+                'ptwebqq': self.ptwebqq, 'clientid': self.clientid,
+                'psessionid': '', 'status': 'online'
+            })
+        },
+        Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001'
+                   '&callback=1&id=2'),
+        Origin = 'http://d1.web2.qq.com'
+    )
+
+def testLoginArgs(self):
+    # 请求一下 get_online_buddies 页面，避免103错误。
+    # 若请求无错误发生，则表明登录成功
+    return dict(
+        url = ('http://d1.web2.qq.com/channel/get_online_buddies2?'
+               'vfwebqq=%s&clientid=%d&psessionid=%s&t={rand}') %
+              (self.vfwebqq, self.clientid, self.psessionid),
+        Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001&'
+                   'callback=1&id=2'),
+        Origin = 'http://d1.web2.qq.com',
+        repeatOnDeny = 0
+    )
+
+def redirectUrl(url, base):
+    if not base:
+        return url
+    u = UrlSplit(url)
+    return base.rstrip('/') + (u.path or '/') + (u.query and '?'+u.query or '')
+
+def urlTimeout(url):
+    return 30 if url != POLL_URL else 120
+
+def pinghotUrl():
+    return ('http://pinghot.qq.com/pingd?dm=w.qq.com.hot&'
+            'url=/&hottag=smartqq.im.polltimeout&hotx=9999&'
+            'hoty=9999&rand=%s') % random.randint(10000, 99999)
+
+# 以下几个函数与 IO 无关，由 BasicQSession 和 AsyncQSession 共用
+
+# 判断一次请求的结果，返回 (result, error) ，error 为 None 表示请求成功，
+# 'TO'/'UE'/'DE' 分别表示 超时/URL 地址错误/请求被拒绝
+def judgeResponse(statusCode, html, expectedCodes, expectedKey):
+    if statusCode in (502, 504, 404):
+        return None, 'TO'
+
+    try:
+        rst = JsonLoads(html)
+    except ValueError:
+        return None, 'UE'
+
+    result = rst.get('result', rst)
+    
+    if expectedKey:
+        if expectedKey in result:
+            return result, None
+    else:
+        if 'retcode' in rst:
+            retcode = rst['retcode']
+        elif 'errCode' in rst:
+            retcode = rst['errCode']
+        elif 'ec' in rst:
+            retcode = rst['ec']
+        else:
+            retcode = -1
+
+        if (retcode in expectedCodes):
+            return result, None
+
+    return None, 'DE'
+
+def pollItem(item):
+    ctype = {
+        'message': 'buddy',
+        'group_message': 'group',
+        'discu_message': 'discuss'
+    }[item['poll_type']]
+    fromUin = str(item['value']['from_uin'])
+    memberUin = str(item['value'].get('send_uin', ''))
+    content = FaceReverseParse(item['value']['content'])
+    return ctype, fromUin, memberUin, content
+
+def pollItems(result):
+    items = []
+    for item in result:
+        try:
+            items.append((item['value'].get('msg_id'), pollItem(item)))
+        except (KeyError, TypeError, AttributeError):
+            DEBUG('无法识别的 poll 结果：%r', item)
+    return items
+
+def pollArgs(self):
+    return dict(
+        url = POLL_URL,
+        data = {
+            'r': JsonDumps({
+                'ptwebqq':self.ptwebqq, 'clientid':self.clientid,
+                'psessionid':self.psessionid, 'key':''
+            })
+        },
+        Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001&'
+                   'callback=1&id=2'),
+        expectedCodes = (0, 100003, 100100, 100012)
+    )
+
+def sendArgs(self, ctype, uin, content):
+    sendUrl = {
+        'buddy': 'http://d1.web2.qq.com/channel/send_buddy_msg2',
+        'group': 'http://d1.web2.qq.com/channel/send_qun_msg2',
+        'discuss': 'http://d1.web2.qq.com/channel/send_discu_msg2'
+    }
+    sendTag = {'buddy':'to', 'group':'group_uin', 'discuss':'did'}
+    return dict(
+        url = sendUrl[ctype],
+        data = {
+            'r': JsonDumps({
+                sendTag[ctype]: int(uin),
+                'content': JsonDumps(
+                    FaceParse(content) +
+                    [['font', {'name': '宋体', 'size': 10,
+                              'style': [0,0,0], 'color': '000000'}]]
+                ),
+                'face': 522,
+                'clientid': self.clientid,
+                'msg_id': self.msgId,
+                'psessionid': self.psessionid
+            })
+        },
+        Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001&'
+                   'callback=1&id=2')
+    )
+
+# 检查 SendTo 的参数，返回 (content, err)
+def checkSendTo(contact, content):
+    result = None
+
+    if not hasattr(contact, 'ctype'):
+        result = '错误：消息接受者必须为一个 QContact 对象'
+    
+    elif contact.ctype.endswith('-member'):
+        result = '错误：不能给群成员或讨论组成员发消息'
+    
+    if PY3:
+        if isinstance(content, str):
+            content = content
+        elif isinstance(content, bytes):
+            content = content.decode('utf8')
+        else:
+            result = '错误：消息内容必须为 str 或 bytes 对象'
+    else:
+        if isinstance(content, str):
+            content = content
+        elif isinstance(content, unicode):
+            content = content.encode('utf8')
+        else:
+            result = '错误：消息内容必须为 str 或 unicode 对象'
+
+    if not content:
+        result = '错误：不允许发送空消息'
+
+    return content, result
+
 def qHash(x, K):
     N = [0] * 4
     for T in range(len(K)):
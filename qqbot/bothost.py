@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# 多账号模式：在同一个进程中运行多个 QQBot 对象。
+# 每个账号有自己的 QSession 、 QContactDB 和插件回调函数表，所有账号共用同一个
+# MainLoop 、同一个定时任务调度器以及同一个 requests 连接池。插件函数的第一个参数
+# bot 即为收到消息的账号对应的 QQBot 对象（可通过 bot.conf.qq 区分账号），每个账号
+# 加载的插件由各自配置中的 plugins 选项决定。
+#
+# 用法： qqbot -us somebody,somebody2 或者在配置文件中设置 "users" 选项。
+# 单个账号 stop/restart/fresh-restart 或登录过期时，只影响该账号，其他账号照常运行；
+# 全部账号都停止后，进程退出。
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, requests
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from qqbot.qconf import QConf
+from qqbot.qqbotcls import QQBot, getReason, RESTART, FRESH_RESTART
+from qqbot.qqbotcls import LOGIN_EXPIRE
+from qqbot.basicqsession import BasicQSession
+from qqbot.utf8logger import INFO, ERROR, WARN
+from qqbot.common import StartDaemonThread
+from qqbot.mainloop import MainLoop, Put, PutTo, PutTask, BACKGROUND
+
+# 这些选项在各账号的配置中单独设定，不从命令行继承
+accountOptions = ('-u', '--user', '-us', '--users', '-q', '--qq',
+                  '-m', '--mailAccount', '-mc', '--mailAuthCode')
+
+def accountArgv(argv, user, qq=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    result = []
+    while argv:
+        arg = argv.pop(0)
+        if arg in accountOptions:
+            argv and argv.pop(0)
+        elif arg.split('=', 1)[0] not in accountOptions:
+            result.append(arg)
+    result += ['-u', user]
+    if qq is not None:
+        result += ['-q', qq]
+    return result
+
+class QQBotHost(object):
+    def __init__(self, argv=None):
+        self.argv = argv
+        self.conf = QConf(argv)
+        self.users = self.conf.users
+        self.bots = {}
+        self.ports = {}
+        self.scheduler = BackgroundScheduler(daemon=True)
+        n = len(self.users)
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=10, pool_maxsize=max(10, 4*n)
+        )
+
+    def Run(self):
+        BasicQSession.sharedAdapter = self.adapter
+
+        INFO('多账号模式，共 %d 个账号：%s', len(self.users), self.users)
+
+        for user in self.users:
+            bot = self.login(user)
+            if bot is not None:
+                self.addBot(user, bot)
+
+        if not self.bots:
+            ERROR('没有任何账号登录成功，QQBot 将停止运行')
+            sys.exit(1)
+
+        StartDaemonThread(self.intervalForever)
+
+        try:
+            MainLoop()
+        except SystemExit as e:
+            for bot in list(self.bots.values()):
+                bot.onExit(e.code, getReason(e.code), None)
+            raise
+        except Exception as e:
+            ERROR('', exc_info=True)
+            ERROR('Mainloop 发生未知错误：%r', e)
+            for bot in list(self.bots.values()):
+                bot.onExit(1, 'unknown-error', e)
+            raise SystemExit(1)
+
+    def login(self, user, qq=None):
+        bot = QQBot(self)
+        try:
+            bot.Login(accountArgv(self.argv, user, qq))
+        except (Exception, SystemExit) as e:
+            ERROR('', exc_info=True)
+            ERROR('账号 %s 登录失败：%r', user, e)
+            return None
+        else:
+            return bot
+
+    # main thread
+    def addBot(self, user, bot):
+        port = bot.conf.termServerPort
+        if port and self.ports.get(port, user) != user:
+            WARN('账号 %s 的 termServerPort(%s) 已被账号 %s 占用，'
+                 '该账号的 qq 命令和 HTTP-API 接口将无法使用',
+                 user, port, self.ports[port])
+            bot.conf.termServerPort = 0
+        elif port:
+            self.ports[port] = user
+
+        self.bots[user] = bot
+        bot.user = user
+        bot.start()
+        INFO('账号 %s(qq=%s) 已启动', user, bot.conf.qq)
+
+    # main thread
+    def onBotExit(self, bot, code):
+        user = getattr(bot, 'user', None)
+        if self.bots.get(user) is not bot:
+            return
+
+        self.bots.pop(user)
+        bot.shutdown()
+        bot.onExit(code, getReason(code), None)
+        INFO('账号 %s(qq=%s) 已停止（%s）', user, bot.conf.qq, getReason(code))
+
+        if code == RESTART or \
+                (code == LOGIN_EXPIRE and bot.conf.restartOnOffline):
+            PutTo('qqbot-host', self.relogin, user, bot.conf.qq)
+        elif code == FRESH_RESTART:
+            PutTo('qqbot-host', self.relogin, user, '')
+        elif not self.bots:
+            INFO('全部账号均已停止')
+            sys.exit(code)
+
+    # child thread
+    def relogin(self, user, qq):
+        time.sleep(5)
+        INFO('重新登录账号 %s （%s）', user,
+             qq and ('自动登录，qq=%s' % qq) or '手工登录')
+        bot = self.login(user, qq)
+        if bot is not None:
+            Put(self.addBot, user, bot)
+        else:
+            Put(self.onLoginFail, user)
+
+    # main thread
+    def onLoginFail(self, user):
+        if not self.bots:
+            ERROR('全部账号均已停止')
+            sys.exit(1)
+
+    # child thread
+    def intervalForever(self):
+        while True:
+            time.sleep(300)
+            PutTask(self.onInterval, priority=BACKGROUND, source='interval',
+                    timeout=300)
+
+    def onInterval(self):
+        for bot in list(self.bots.values()):
+            bot.onInterval()
@@ -202,11 +202,13 @@ def Import(moduleName):
     return sys.modules[moduleName]
 
 if not PY3:
-    import urllib
+    import urllib, urlparse
     Unquote = urllib.unquote
+    UrlSplit = urlparse.urlsplit
 else:
     import urllib.parse
     Unquote = urllib.parse.unquote
+    UrlSplit = urllib.parse.urlsplit
 
 def mydump(fn, d):
     with open(fn, 'wb') as f:
@@ -10,7 +10,24 @@
 # qq send buddy jack /可爱
 # bot.SendTo(contact, '/可爱')
 
-import re, sys
+# 消息的文本形式与分段形式
+#   1) 收到的消息（ FaceReverseParse ）的文本中，表情为 " /微笑 " ， emoji 字符为
+#      " /Emoji128512 " 。文本为 Message 对象（ str 的子类），插件可以直接使用其
+#      segments 属性：由 Segment(kind, value) 组成的 tuple ， kind 为 'text' （ value
+#      为文本）、 'face' （ value 为表情代码）或 'emoji' （ value 为 Unicode 码位）。
+#      解析收到的消息时同时得到分段形式，不需要再解析文本；其他 Message 对象在第一次
+#      读取 segments 时才由文本解析（ Segments ）
+#   2) JoinSegments(segments) 得到相应的文本形式，可直接用于 bot.SendTo ，
+#      Segments(JoinSegments(segments)) 与 segments 相同（相邻的文本段合并）
+#   3) 发送消息时（ FaceParse ）把文本中的 "/微笑" 转换为表情
+#
+# 表情名称的匹配：所有名称组成一个 trie ，编译为一个正则表达式（如 "/(蛋(?:糕)?|...)" ），
+# 由 sre 在 C 中逐个字符地沿 trie 匹配，而不是逐个尝试 170 多个名称；同一位置可以匹配
+# 多个名称时取最长的那个（与原来的正则表达式的结果相同）。不含 "/" 的消息（绝大多数）
+# 直接返回。 emoji 只在消息中含有码位大于 0x1f000 的字符时才替换（先用 emojiPat.search
+# 检查，而不是在 Python 中逐个字符检查）
+
+import re, sys, collections
 
 faceText = [
     "微笑", "撇嘴", "色", "发呆", "得意", "流泪", "害羞", "闭嘴", "睡", "大哭", "尴尬", "发怒",
@@ -59,35 +76,222 @@ pat = re.compile(p)
 
 PY3 = (sys.version_info[0] == 3)
 
+# 收到的消息中表情的文本形式
+faceStr = dict((code, ' /%s ' % face) for code, face in faceMap.items()
+               if isinstance(code, int))
+
+# 由 words 组成的 trie 对应的正则表达式
+def trieRegex(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[''] = None
+
+    def regexOf(node):
+        alts = [re.escape(c) + regexOf(node[c]) for c in sorted(node) if c]
+        if not alts:
+            return ''
+        elif '' in node:
+            return '(?:%s)?' % '|'.join(alts)
+        elif len(alts) == 1:
+            return alts[0]
+        else:
+            return '(?:%s)' % '|'.join(alts)
+
+    return regexOf(trie)
+
+faceNames = trieRegex(face for face in faceText if face in faceMap)
+facePat = re.compile('/(%s)' % faceNames)
+
+# 文本形式中的表情和 emoji
+segmentPat = re.compile(' /(?:(%s)|Emoji(\\d+)) ' % faceNames)
+
+# 与 ord(c) > 0x1f000 相同
+if PY3:
+    emojiPat = re.compile('[\U0001F001-\U0010FFFF]')
+    emojiStr = lambda m: ' /Emoji%d ' % ord(m.group())
+
+Segment = collections.namedtuple('Segment', 'kind value')
+
+# 见文件开头的说明。 content 为收到的消息的原始内容（不含开头的字体信息）
+class Message(str):
+    if PY3:
+        __slots__ = ('_content', '_segments')
+
+    def __new__(cls, text, content=None):
+        m = str.__new__(cls, text)
+        m._content = content
+        m._segments = None
+        return m
+
+    @property
+    def segments(self):
+        if self._segments is None:
+            if self._content is None:
+                self._segments = Segments(self)
+            else:
+                self._segments = segmentsOf(self._content)
+        return self._segments
+
 def EmojiEncode(pollContent):
     if not PY3:
         return pollContent
 
     for i in range(1, len(pollContent)):
         item = pollContent[i]
-        if isinstance(item, str):
-            newstr = []
-            for c in item:
-                if ord(c) > 0x1f000: # ord("\U0001F000")
-                    newstr.append(' /Emoji%d ' % ord(c))
-                else:
-                    newstr.append(c)
-            pollContent[i] = ''.join(newstr)
+        if isinstance(item, str) and emojiPat.search(item):
+            pollContent[i] = emojiPat.sub(emojiStr, item)
 
     return pollContent
 
+# 返回 Message 对象
 def FaceReverseParse(pollContent):
-    newContent = EmojiEncode(pollContent) 
-    return ''.join(
-        (' /%s ' % faceMap.get(m[1], '表情')) if isinstance(m, list) else str(m)
-        #(' %d ' % m[1]) if isinstance(m, list) else str(m)
-        for m in newContent[1:]
-    )
+    content = pollContent[1:]
+    text = ''.join([
+        faceStr.get(m[1], ' /表情 ') if isinstance(m, list) else
+        m if isinstance(m, str) else str(m) for m in content
+    ])
+    # 表情的文本形式中没有 emoji ，可以对整个文本替换
+    if PY3 and emojiPat.search(text):
+        text = emojiPat.sub(emojiStr, text)
+    return Message(text, content)
+
+def segmentsOf(content):
+    segments = []
+    for m in content:
+        if isinstance(m, list):
+            segments.append(Segment('face', m[1]))
+        elif not isinstance(m, str):
+            segments.append(Segment('text', str(m)))
+        elif PY3 and emojiPat.search(m):
+            start = 0
+            for e in emojiPat.finditer(m):
+                if e.start() > start:
+                    segments.append(Segment('text', m[start:e.start()]))
+                segments.append(Segment('emoji', ord(e.group())))
+                start = e.end()
+            if start < len(m):
+                segments.append(Segment('text', m[start:]))
+        elif m:
+            segments.append(Segment('text', m))
+    return tuple(segments)
 
 def FaceParse(sendContent):
-    result = pat.split(sendContent)
+    if '/' not in sendContent:
+        return [sendContent] if sendContent else []
+
+    result = facePat.split(sendContent)
     for i in range(1, len(result), 2):
-        result[i] = ['face', faceMap.get(result[i][1:], 134)]
+        result[i] = ['face', faceMap[result[i]]]
     s = 0 if result[0] else 1
     result[-1] or result.pop()
     return result[s:]
+
+# 由文本形式得到分段形式（未知的表情 " /表情 " 仍为文本）
+def Segments(text):
+    segments, start = [], 0
+    for m in segmentPat.finditer(text):
+        face, emoji = m.groups()
+        if face is None and int(emoji) <= 0x1f000:
+            continue
+        if m.start() > start:
+            segments.append(Segment('text', text[start:m.start()]))
+        if face is not None:
+            segments.append(Segment('face', faceMap[face]))
+        else:
+            segments.append(Segment('emoji', int(emoji)))
+        start = m.end()
+    if start < len(text):
+        segments.append(Segment('text', text[start:]))
+    return tuple(segments)
+
+def JoinSegments(segments):
+    return ''.join([
+        s.value if s.kind == 'text' else
+        faceStr.get(s.value, ' /表情 ') if s.kind == 'face' else
+        ' /Emoji%d ' % s.value for s in segments
+    ])
+
+if __name__ == '__main__':
+    # 与原来的实现（正则表达式分割、逐个字符检查 emoji ）比较结果和耗时，语料为随机
+    # 生成的聊天消息：纯文本（ 5% 含网址）、带表情、带 emoji 、混合
+    import random, timeit, copy
+
+    def oldFaceParse(sendContent):
+        result = pat.split(sendContent)
+        for i in range(1, len(result), 2):
+            result[i] = ['face', faceMap.get(result[i][1:], 134)]
+        s = 0 if result[0] else 1
+        result[-1] or result.pop()
+        return result[s:]
+
+    def oldFaceReverseParse(pollContent):
+        for i in range(1, len(pollContent)):
+            item = pollContent[i]
+            if PY3 and isinstance(item, str):
+                pollContent[i] = ''.join(
+                    (' /Emoji%d ' % ord(c)) if ord(c) > 0x1f000 else c
+                    for c in item
+                )
+        return ''.join(
+            (' /%s ' % faceMap.get(m[1], '表情')) if isinstance(m, list)
+            else str(m) for m in pollContent[1:]
+        )
+
+    rand = random.Random(1)
+    words = ['今天', '晚上', '一起', '吃饭', '好的', '哈哈哈', '收到', '明天见',
+             '这个问题', '怎么解决', 'ok', 'QQBot', '群主', '红包', '作业']
+    faces = [f for f in faceText if f in faceMap]
+    emojis = [chr(c) for c in (0x1f600, 0x1f602, 0x1f44d, 0x1f389)] \
+             if PY3 else []
+
+    def sentence(nFace, nEmoji):
+        parts = [rand.choice(words) for i in range(rand.randint(3, 12))]
+        if rand.random() < 0.05:
+            parts.append(' https://github.com/pandolia/qqbot/issues/104 ')
+        for i in range(nFace):
+            parts.insert(rand.randint(0, len(parts)), '/' + rand.choice(faces))
+        for i in range(nEmoji):
+            parts.insert(rand.randint(0, len(parts)), rand.choice(emojis))
+        return ''.join(parts)
+
+    def pollContentOf(text):
+        content = [['font', {}]]
+        for x in oldFaceParse(text):
+            content.append(x)
+        return content
+
+    corpora = [
+        ('plain', [sentence(0, 0) for i in range(1000)]),
+        ('faces', [sentence(rand.randint(1, 3), 0) for i in range(1000)]),
+        ('emoji', [sentence(0, rand.randint(1, 3) if PY3 else 0)
+                   for i in range(1000)]),
+        ('mixed', [sentence(rand.randint(0, 2), rand.randint(0, 2) * PY3)
+                   for i in range(1000)]),
+    ]
+
+    for name, texts in corpora:
+        polls = [pollContentOf(t) for t in texts]
+        for t, c in zip(texts, polls):
+            assert FaceParse(t) == oldFaceParse(t), t
+            m = FaceReverseParse(c)
+            assert m == oldFaceReverseParse(copy.deepcopy(c)), t
+            assert Segments(m) == m.segments and JoinSegments(m.segments) == m
+
+        def timeOf(func, args):
+            n = 20
+            t = min(timeit.repeat(lambda: [func(a) for a in args],
+                                  number=n, repeat=3))
+            return t / n / len(args) * 1e6
+
+        # segments: 收到的消息的分段形式（由原始内容得到）； Segments: 由文本解析
+        print('%-6s FaceParse %5.2f -> %5.2f us   FaceReverseParse %5.2f -> '
+              '%5.2f us   segments %5.2f us   Segments %5.2f us' % (
+                  name, timeOf(oldFaceParse, texts), timeOf(FaceParse, texts),
+                  timeOf(oldFaceReverseParse, polls),
+                  timeOf(FaceReverseParse, polls),
+                  timeOf(segmentsOf, [c[1:] for c in polls]),
+                  timeOf(Segments, [FaceReverseParse(c) for c in polls])
+              ))
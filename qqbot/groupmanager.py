@@ -20,19 +20,20 @@ def isdigit(s):
 
 class GroupManagerSession(object):
     
-    def GroupKick(self, groupqq, qqlist, placehold=None):
+    def GroupKick(self, groupqq, qqlist, placehold=None, policy=None):
         r = self.smartRequest(
             url = 'http://qinfo.clt.qq.com/cgi-bin/qun_info/delete_group_member',
             Referer = 'http://qinfo.clt.qq.com/member.html',
             data={'gc': groupqq, 'ul': '|'.join(qqlist), 'bkn': self.bkn},
             expectedCodes=(0,3,11),
-            repeatOnDeny=5
+            repeatOnDeny=5,
+            policy=policy
         )
         # 新接口不再区分多个用户的踢出状态，多个用户要么全部操作成功，要么全部失败
         return r.get('ec', -1) == 0
 
     
-    def GroupSetAdmin(self, groupqq, qqlist, admin=True):
+    def GroupSetAdmin(self, groupqq, qqlist, admin=True, policy=None):
         # 新接口只支持设置一人，不支持批量操作
         r = self.smartRequest(
             url = 'http://qinfo.clt.qq.com/cgi-bin/qun_info/set_group_admin',
@@ -40,29 +41,32 @@ class GroupManagerSession(object):
             data = {'src':'qinfo_v2', 'gc':groupqq, 'u':qqlist[0],
                     'op':int(admin), 'bkn':self.bkn},
             expectedCodes = (0, 14),
-            repeatOnDeny = 6
+            repeatOnDeny = 6,
+            policy = policy
         )
         return r.get('ec', -1) == 0
 
-    def GroupShut(self, groupqq, qqlist, t):
+    def GroupShut(self, groupqq, qqlist, t, policy=None):
         shutlist = JsonDumps([{'uin':int(qq), 't':t} for qq in qqlist])
         self.smartRequest(
             url = 'http://qinfo.clt.qq.com/cgi-bin/qun_info/set_group_shutup',
             Referer = 'http://qinfo.clt.qq.com/qinfo_v3/member.html',
             data = {'gc':groupqq, 'bkn':self.bkn, 'shutup_list':shutlist},
             expectedCodes = (0,),
-            repeatOnDeny = 5
+            repeatOnDeny = 5,
+            policy = policy
         )
         return True
 
-    def GroupSetCard(self, groupqq, qqlist, card):
+    def GroupSetCard(self, groupqq, qqlist, card, policy=None):
         self.smartRequest(
             url = 'http://qinfo.clt.qq.com/cgi-bin/qun_info/set_group_card',
             Referer='http://qinfo.clt.qq.com/member.html',
             data = {'gc': groupqq, 'bkn': self.bkn, 'u':qqlist[0], 'name':card}
                    if card else {'gc': groupqq, 'bkn': self.bkn, 'u':qqlist[0]},
             expectedCodes = (0,),
-            repeatOnDeny = 5
+            repeatOnDeny = 5,
+            policy = policy
         )
         return True
 
@@ -107,7 +111,7 @@ class GroupManager(object):
     
     def GroupKick(self, group, membs):
         result = self.membsOperation(
-            group, membs, ('踢除%s[{m}]' % group), self.groupKick, None
+            group, membs, ('踢除%s[{m}]' % (group,)), self.groupKick, None
         )
         for r, m in zip(result, membs):
             if r.startswith('成功'):
@@ -5,67 +5,424 @@ p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if p not in sys.path:
     sys.path.insert(0, p)
 
-import traceback
+import traceback, threading, collections, time
 
-from qqbot.common import StartDaemonThread, Queue
+from concurrent.futures import Future
 
-def workAt(taskQueue):
-    while True:
+from qqbot.utf8logger import WARN
+from qqbot.common import StartDaemonThread
+from qqbot.metrics import Inc, Observe, SetGauge
+
+# 任务的优先级，数值越小越优先
+CONTROL, MESSAGE, NORMAL, BACKGROUND = 0, 1, 2, 3
+PRIORITY_NAMES = ('control', 'message', 'normal', 'background')
+
+# 每个任务都有一个 future ，任务执行完后其返回值或异常将设置到 future 中，任务开始
+# 执行前可以调用 future.cancel() 取消该任务，超时未执行的任务也将被取消。
+# report 为 True 时（ Put/PutTo 等不关心结果的任务），任务抛出的异常将打印出来。
+def funcName(func):
+    name = getattr(func, '__name__', None)
+    if name is None:
+        return repr(func)
+    return '%s.%s' % (getattr(func, '__module__', '?'), name)
+
+class Task(object):
+    def __init__(self, func, args=(), kwargs=None, priority=NORMAL,
+                 source=None, timeout=None, report=True):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.priority = priority
+        self.source = source
+        self.t = time.time()
+        self.deadline = timeout and (self.t + timeout)
+        self.report = report
+        self.future = Future()
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+    def Run(self, call=None):
+        if not self.future.set_running_or_notify_cancel():
+            return
         try:
-            func, args, kwargs = taskQueue.get(timeout=0.5)
-        except Queue.Empty:
-            pass
-        else:
-            # func(*args, **kwargs)
-            try:
-                func(*args, **kwargs)
-            except SystemExit:
-                raise
-            except:
+            result = self() if call is None else call()
+        except SystemExit as e:
+            self.future.set_exception(e)
+            raise
+        except BaseException as e:
+            self.future.set_exception(e)
+            if self.report:
                 traceback.print_exc()
+        else:
+            self.future.set_result(result)
+
+# 带优先级和公平调度的任务队列：
+#   1) 总是先执行优先级高的任务，但低优先级的任务等待时间超过 starveAfter 中设定
+#      的秒数后将被优先执行，避免被饿死
+#   2) 同一优先级内，不同来源（ source ，如 消息的发送者 、 term 命令 、定时任务）
+#      的任务轮流执行，某个来源大量放入的任务不会阻塞其他来源的任务
+#   3) 超过 deadline 仍未开始执行的任务将被丢弃
+# 运行指标： mainloop_depth{queue,priority} 、 mainloop_wait{queue,priority} 、
+#            mainloop_expired{queue,priority}
+class TaskQueue(object):
+
+    starveAfter = {MESSAGE: 2.0, NORMAL: 5.0, BACKGROUND: 30.0}
+
+    def __init__(self, label='main'):
+        self.label = label
+        self.cond = threading.Condition()
+        self.classes = [collections.OrderedDict() for p in PRIORITY_NAMES]
+        self.sizes = [0] * len(PRIORITY_NAMES)
+        self.waiting = 0
+
+    def put(self, task):
+        with self.cond:
+            sources = self.classes[task.priority]
+            if task.source not in sources:
+                sources[task.source] = collections.deque()
+            sources[task.source].append(task)
+            self.sizes[task.priority] += 1
+            self.setDepth(task.priority)
+            self.cond.notify()
+
+    # timeout 为 None 时一直等待，否则超时后返回 None 。队列为空时，若 stop()
+    # 返回 True 则立即返回 None （ stop 在 self.cond 内调用）
+    def get(self, timeout=None, stop=None):
+        with self.cond:
+            while True:
+                while not any(self.sizes):
+                    if stop is not None and stop():
+                        return None
+                    self.waiting += 1
+                    try:
+                        self.cond.wait(timeout)
+                    finally:
+                        self.waiting -= 1
+                    if timeout is not None and not any(self.sizes):
+                        return None
+
+                task = self.pop()
+                name = PRIORITY_NAMES[task.priority]
+                now = time.time()
+                if task.deadline and now > task.deadline:
+                    WARN('任务 %s 在队列 %s 中等待了 %.1f 秒，已超过其期限，不再执行',
+                         funcName(task.func), self.label, now - task.t)
+                    Inc('mainloop_expired', queue=self.label, priority=name)
+                    task.future.cancel()
+                    continue
+
+                Observe('mainloop_wait', now - task.t,
+                        queue=self.label, priority=name)
+                return task
+
+    def pop(self):
+        now, chosen = time.time(), None
+        for p, sources in enumerate(self.classes):
+            if not self.sizes[p]:
+                continue
+            if chosen is None:
+                chosen = p
+            limit = self.starveAfter.get(p)
+            if limit is not None and p != chosen and \
+                    now - min(q[0].t for q in sources.values()) > limit:
+                chosen = p
+                break
+
+        # 取出第一个来源的第一个任务，并把该来源移到最后
+        sources = self.classes[chosen]
+        source = next(iter(sources))
+        q = sources.pop(source)
+        task = q.popleft()
+        if q:
+            sources[source] = q
+        self.sizes[chosen] -= 1
+        self.setDepth(chosen)
+        return task
+
+    def setDepth(self, p):
+        SetGauge('mainloop_depth', self.sizes[p],
+                 queue=self.label, priority=PRIORITY_NAMES[p])
+
+    def qsize(self):
+        return sum(self.sizes)
+
+def workAt(taskQueue, timeout=None):
+    while True:
+        task = taskQueue.get(timeout)
+        if task is not None:
+            task.Run()
+
+# PutTo 的子队列对应的工作线程池
+# 队列中积压的任务多于空闲的线程时增加线程（不超过 maxWorkers ），在 idleTimeout
+# 秒内同时忙碌的线程数一直少于线程总数时回收多余的空闲线程（不少于 minWorkers ）。
+# 空闲线程阻塞在队列上，不会定时醒来；回收在下一次放入任务时进行。
+# process=True 时，任务在一个进程池中执行（任务函数及参数必须可以 pickle ），
+# 适合 CPU 密集型的插件任务，此时线程只负责把任务转交给进程池并等待其完成。
+# 运行指标： pool_workers{queue} 、 pool_tasks{queue} 、 pool_run{queue} 、
+#            pool_errors{queue} ，以及 TaskQueue 的 mainloop_* 指标
+class WorkerPool(object):
+    def __init__(self, label, minWorkers=1, maxWorkers=1, idleTimeout=60,
+                 process=False):
+        self.label = label
+        self.queue = TaskQueue(label)
+        self.minWorkers = minWorkers
+        self.maxWorkers = max(minWorkers, maxWorkers)
+        self.idleTimeout = idleTimeout
+        self.executor = None
+        self.nWorkers = 0
+        self.retiring = 0
+        self.busyAt = {}
+        self.SetProcess(process)
+        self.grow()
+
+    def Configure(self, minWorkers=None, maxWorkers=None, idleTimeout=None,
+                  process=None):
+        with self.queue.cond:
+            if minWorkers is not None:
+                self.minWorkers = minWorkers
+            if maxWorkers is not None:
+                self.maxWorkers = maxWorkers
+            self.maxWorkers = max(self.minWorkers, self.maxWorkers)
+            if idleTimeout is not None:
+                self.idleTimeout = idleTimeout
+        if process is not None:
+            self.SetProcess(process)
+        self.grow()
+
+    def SetProcess(self, process):
+        if process and self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(self.maxWorkers)
+        elif not process and self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def put(self, task):
+        self.queue.put(task)
+        self.grow()
+
+    def busy(self):
+        return self.nWorkers - self.queue.waiting
+
+    def grow(self):
+        with self.queue.cond:
+            backlog = self.queue.qsize() - self.queue.waiting
+            n = max(self.minWorkers - self.nWorkers,
+                    min(backlog, self.maxWorkers - self.nWorkers))
+            self.nWorkers += max(n, 0)
+            if backlog > 0:
+                self.retiring = 0
+            else:
+                self.shrink()
+            SetGauge('pool_workers', self.nWorkers, queue=self.label)
+        for i in range(n):
+            StartDaemonThread(self.work)
+
+    # 在 self.queue.cond 内调用。 busyAt[n] 为最近一次有 n 个线程同时忙碌的时间，
+    # 保留最近 idleTimeout 秒内曾同时忙碌的最大线程数
+    def shrink(self):
+        now = time.time()
+        for n, t in list(self.busyAt.items()):
+            if now - t >= self.idleTimeout:
+                del self.busyAt[n]
+        needed = max([self.minWorkers, self.busy()] + list(self.busyAt))
+        excess = self.nWorkers - self.retiring - needed
+        if excess > 0 and self.queue.waiting:
+            self.retiring += min(excess, self.queue.waiting)
+            self.queue.cond.notify_all()
+
+    # 在 self.queue.cond 内调用
+    def retire(self):
+        if self.retiring > 0:
+            self.retiring -= 1
+            self.nWorkers -= 1
+            SetGauge('pool_workers', self.nWorkers, queue=self.label)
+            return True
+        return False
+
+    def work(self):
+        while True:
+            task = self.queue.get(stop=self.retire)
+            if task is None:
+                return
+
+            with self.queue.cond:
+                self.busyAt[self.busy()] = time.time()
+
+            t = time.time()
+            if self.executor is None:
+                task.Run()
+            else:
+                task.Run(lambda: self.executor.submit(
+                    task.func, *task.args, **task.kwargs
+                ).result())
+            if task.future.done() and not task.future.cancelled() and \
+                    task.future.exception() is not None:
+                Inc('pool_errors', queue=self.label)
+            Inc('pool_tasks', queue=self.label)
+            Observe('pool_run', time.time() - t, queue=self.label)
+
+    def Stats(self):
+        return {
+            'workers': self.nWorkers,
+            'busy': self.busy(),
+            'depth': self.queue.qsize(),
+            'min': self.minWorkers,
+            'max': self.maxWorkers,
+            'process': self.executor is not None
+        }
 
 class TaskLoop(object):
     def __init__(self):
-        self.mainQueue = Queue.Queue()
-        self.childQueues = {}    
-    
+        self.mainQueue = TaskQueue('main')
+        self.childQueues = {}
+
     # Put a task into `mainQueue`, it will be executed in the main thread.
     # So all tasks you `Put` will be executed one after another. Means that
     # you can access the global data safely in these tasks.
     def Put(self, func, *args, **kwargs):
-        self.mainQueue.put((func, args, kwargs))
-    
+        self.mainQueue.put(Task(func, args, kwargs))
+
+    # Same as `Put`, but with a priority (CONTROL/MESSAGE/NORMAL/BACKGROUND),
+    # a source (tasks from different sources of the same priority are
+    # executed in turn) and a timeout (the task is dropped if it has not
+    # started `timeout` seconds after being put).
+    # Returns the task's future.
+    def PutTask(self, func, args=(), kwargs=None, priority=NORMAL,
+                source=None, timeout=None, report=True):
+        task = Task(func, args, kwargs, priority, source, timeout, report)
+        self.mainQueue.put(task)
+        return task.future
+
+    # Same as `Put`, but returns a `concurrent.futures.Future`. Exceptions
+    # raised by the task are not printed, they are re-raised by
+    # `future.result()`. Block on it with `future.result(timeout)` in a
+    # child thread (never in the main thread, which would deadlock), or
+    # `await asyncio.wrap_future(future)` in a coroutine. Call
+    # `future.cancel()` to cancel the task if it has not started yet.
+    def Submit(self, func, *args, **kwargs):
+        return self.PutTask(func, args, kwargs, report=False)
+
     # Put a task into a child queue which with label `queueLabel`. It will be
     # executed in a child thread. Normally, it is a good idea to put an IO
     # task into a child queue, and when this task finishs his job, he put
     # a committing task with his result into the main queue.
     # At first, there is only one worker(thread) works on a child queue. You
-    # can call `AddWorkerTo` to add workers(threads) to a child queue.
+    # can call `AddWorkerTo` to allow more workers(threads) on a child queue,
+    # or call `SetPool` to configure the worker pool of a child queue.
     def PutTo(self, queueLabel, func, *args, **kwargs):
-        self.Put(self.putTo, queueLabel, func, args, kwargs)
-    
-    def putTo(self, queueLabel, func, args, kwargs):
-        if queueLabel in self.childQueues:
-            self.childQueues[queueLabel].put((func, args, kwargs))
-        else:
-            self.childQueues[queueLabel] = Queue.Queue()
-            self.childQueues[queueLabel].put((func, args, kwargs))
-            StartDaemonThread(workAt, self.childQueues[queueLabel])
+        self.PutToTask(queueLabel, func, args, kwargs)
+
+    def PutToTask(self, queueLabel, func, args=(), kwargs=None,
+                  priority=NORMAL, source=None, timeout=None, report=True):
+        task = Task(func, args, kwargs, priority, source, timeout, report)
+        self.PutTask(self.putTo, (queueLabel, task), priority=CONTROL)
+        return task.future
+
+    # Same as `PutTo`, but returns a future, see `Submit`.
+    def SubmitTo(self, queueLabel, func, *args, **kwargs):
+        return self.PutToTask(queueLabel, func, args, kwargs, report=False)
+
+    def putTo(self, queueLabel, task):
+        self.pool(queueLabel).put(task)
 
+    def pool(self, queueLabel):
+        if queueLabel not in self.childQueues:
+            self.childQueues[queueLabel] = WorkerPool(queueLabel)
+        return self.childQueues[queueLabel]
+
+    # Allow `n` more workers on the child queue. Workers are started only
+    # when there is a backlog and stopped again when they stay idle.
     def AddWorkerTo(self, queueLabel, n):
-        self.Put(self.addWorkerTo, queueLabel, n)
-    
+        self.PutTask(self.addWorkerTo, (queueLabel, n), priority=CONTROL)
+
     def addWorkerTo(self, queueLabel, n):
-        if queueLabel not in self.childQueues:
-            self.childQueues[queueLabel] = Queue.Queue()
-        for i in range(n):
-            StartDaemonThread(workAt, self.childQueues[queueLabel])
+        pool = self.pool(queueLabel)
+        pool.Configure(maxWorkers=pool.maxWorkers+n)
+
+    # Configure the worker pool of a child queue, see `WorkerPool`.
+    def SetPool(self, queueLabel, minWorkers=None, maxWorkers=None,
+                idleTimeout=None, process=None):
+        self.PutTask(self.setPool, (queueLabel, minWorkers, maxWorkers,
+                                    idleTimeout, process), priority=CONTROL)
+
+    def setPool(self, queueLabel, *args):
+        self.pool(queueLabel).Configure(*args)
 
+    def PoolStats(self):
+        return dict((label, pool.Stats())
+                    for label, pool in list(self.childQueues.items()))
+
+    # 主线程定时醒来，以便在 python2 / windows 下及时响应 Ctrl+C
     def Run(self):
-        workAt(self.mainQueue)
+        workAt(self.mainQueue, 0.5)
 
 mainLoop = TaskLoop()
 MainLoop = mainLoop.Run
 Put = mainLoop.Put
+PutTask = mainLoop.PutTask
 PutTo = mainLoop.PutTo
+PutToTask = mainLoop.PutToTask
+Submit = mainLoop.Submit
+SubmitTo = mainLoop.SubmitTo
 AddWorkerTo = mainLoop.AddWorkerTo
+SetPool = mainLoop.SetPool
+PoolStats = mainLoop.PoolStats
+
+if __name__ == '__main__':
+    # 一个来源大量放入任务时，其他来源和其他优先级的任务的执行顺序
+    from qqbot.metrics import Report
+
+    done = []
+    def handle(name):
+        time.sleep(0.001)
+        done.append(name)
+
+    for i in range(500):
+        PutTask(handle, ('flood%d' % i,), priority=MESSAGE, source='group1')
+    for i in range(3):
+        PutTask(handle, ('buddy%d' % i,), priority=MESSAGE, source=str(i))
+    PutTask(handle, ('term',), source='term')
+    PutTask(handle, ('stale',), priority=BACKGROUND, timeout=0.1)
+    PutTask(sys.exit, (0,), priority=BACKGROUND)
+
+    try:
+        MainLoop()
+    except SystemExit:
+        pass
+    print(dict((name, done.index(name)) for name in
+               ('buddy0', 'buddy1', 'buddy2', 'term') if name in done))
+    print(Report('mainloop'))
+
+    # 弹性线程池：积压时增加线程，空闲后回收
+    pool = WorkerPool('io', minWorkers=1, maxWorkers=8, idleTimeout=0.5)
+    t = time.time()
+    for i in range(80):
+        pool.put(Task(time.sleep, (0.05,)))
+    while pool.queue.qsize() or pool.busy():
+        time.sleep(0.01)
+    print('80 tasks in %.2f s, stats=%s' % (time.time() - t, pool.Stats()))
+    time.sleep(0.6)
+    pool.put(Task(time.sleep, (0.01,)))
+    time.sleep(0.1)
+    print('after idle: %s' % pool.Stats())
+    print(Report('pool'))
+
+    # future ：返回值、异常、取消以及超时
+    loop = TaskLoop()
+    StartDaemonThread(loop.Run)
+    print(loop.Submit(sum, [1, 2, 3]).result(timeout=1))
+    try:
+        loop.SubmitTo('io', lambda: 1 / 0).result(timeout=1)
+    except ZeroDivisionError as e:
+        print('exception propagated: %r' % e)
+    blocker = loop.Submit(time.sleep, 0.3)
+    f = loop.Submit(sum, [4, 5])
+    print('cancelled: %s' % f.cancel())
+    blocker.result()
+    from concurrent.futures import TimeoutError
+    try:
+        loop.Submit(time.sleep, 0.3).result(timeout=0.05)
+    except TimeoutError:
+        print('timed out')
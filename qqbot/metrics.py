@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# 运行指标：计数器（ Counter ）、数值（ Gauge ）和直方图（ Histogram ）。
+# 所有指标按 名称+标签 登记在同一张表中，可通过 qq stats 命令或
+# HTTP-API （ /stats ）查看。
+#
+# 用法：
+#     Inc('smartrequest_retry', endpoint='poll2', decision='retry')
+#     Observe('smartrequest_backoff', 0.73, endpoint='poll2')
+#     SetGauge('sendqueue_depth', 12, ctype='group')
+#     print(Report())
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import threading, bisect
+
+# 默认的直方图分桶（单位：秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def Inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def Snapshot(self):
+        return self.value
+
+class Gauge(object):
+    def __init__(self):
+        self.value = 0
+
+    def Set(self, value):
+        self.value = value
+
+    def Snapshot(self):
+        return self.value
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count, self.sum, self.max = 0, 0.0, 0.0
+
+    def Observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    # 近似的百分位数：返回第一个累计比例达到 q 的分桶上界
+    def Percentile(self, q):
+        if not self.count:
+            return 0.0
+        n, target = 0, q * self.count
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= target:
+                return min(self.buckets[i], self.max) \
+                       if i < len(self.buckets) else self.max
+        return self.max
+
+    def Snapshot(self):
+        return {
+            'count': self.count,
+            'avg': self.count and round(self.sum / self.count, 6),
+            'p50': round(self.Percentile(0.5), 6),
+            'p90': round(self.Percentile(0.9), 6),
+            'p99': round(self.Percentile(0.99), 6),
+            'max': round(self.max, 6)
+        }
+
+_lock = threading.Lock()
+_metrics = {}
+
+def getMetric(cls, name, labels, *args):
+    key = (name, tuple(sorted(labels.items())))
+    m = _metrics.get(key)
+    if m is None:
+        with _lock:
+            m = _metrics.get(key)
+            if m is None:
+                m = _metrics[key] = cls(*args)
+    return m
+
+def GetCounter(name, **labels):
+    return getMetric(Counter, name, labels)
+
+def GetGauge(name, **labels):
+    return getMetric(Gauge, name, labels)
+
+def GetHistogram(name, buckets=DEFAULT_BUCKETS, **labels):
+    return getMetric(Histogram, name, labels, buckets)
+
+def Inc(name, n=1, **labels):
+    GetCounter(name, **labels).Inc(n)
+
+def SetGauge(name, value, **labels):
+    GetGauge(name, **labels).Set(value)
+
+def Observe(name, value, **labels):
+    GetHistogram(name, **labels).Observe(value)
+
+def labelStr(labels):
+    return ','.join('%s=%s' % kv for kv in labels)
+
+# 返回 {name: {labelStr: value}} ，只包含名称以 prefix 开头的指标
+def Snapshot(prefix=''):
+    result = {}
+    for (name, labels), m in sorted(list(_metrics.items())):
+        if name.startswith(prefix):
+            result.setdefault(name, {})[labelStr(labels)] = m.Snapshot()
+    return result
+
+def Report(prefix=''):
+    lines = []
+    for name, d in sorted(Snapshot(prefix).items()):
+        for labels, v in sorted(d.items()):
+            if isinstance(v, dict):
+                v = ' '.join('%s=%s' % (k, v[k]) for k in
+                             ('count', 'avg', 'p50', 'p90', 'p99', 'max'))
+            lines.append('%s{%s} %s' % (name, labels, v))
+    return '\n'.join(lines) or '无运行指标'
+
+def Reset(prefix=''):
+    with _lock:
+        for key in list(_metrics.keys()):
+            if key[0].startswith(prefix):
+                del _metrics[key]
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# 模拟 SmartQQ 服务器，用于离线测试 BasicQSession/AsyncQSession 的完整流程。
+# 将会话的 redirectTo 设为 MockSmartQQ().url 后，所有请求都将发往本服务器。
+#
+# 用法：
+#     server = MockSmartQQ(nGroups=10, nMembers=50)
+#     server.Start()
+#     session.redirectTo = server.url
+#     server.PushMessage('group', '2001', '20010001', 'hello')
+#     ...
+#     server.sent   # [(ctype, uin, content), ...] 收到的所有发送消息请求
+#     server.Relogin()  # 模拟重新登录后 psessionid 及群/成员的 uin 改变
+#     server.Stop()
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, threading
+
+from qqbot.common import PY3, Queue, JsonDumps, JsonLoads, STR2BYTES, BYTES2STR
+from qqbot.common import StartDaemonThread, UrlSplit
+
+if PY3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+class threadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class MockSmartQQ(object):
+    def __init__(self, host='127.0.0.1', port=0, qq='3497303033',
+                 nBuddies=3, nGroups=2, nMembers=5, nDiscusses=1,
+                 pollHold=1.0, latency=0):
+        self.qq = qq
+        self.psessionid = 'mockpsession'
+        self.logins = 0
+        self.pollHold = pollHold
+        self.latency = latency
+        self.buddies = [(str(1000+i), 'buddy%d' % i) for i in range(nBuddies)]
+        self.groups = [(str(2000+i), str(3000+i), 'group%d' % i)
+                       for i in range(nGroups)]
+        self.members = dict(
+            (gcode, [(str(int(gid)*10000+j), 'member%d' % j)
+                     for j in range(nMembers)])
+            for gid, gcode, name in self.groups
+        )
+        self.discusses = [(str(4000+i), 'discuss%d' % i)
+                          for i in range(nDiscusses)]
+        self.messages = Queue.Queue()
+        self.sent = []
+        self.requests = []
+        self.msgId = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.handle(self, None)
+
+            def do_POST(self):
+                n = int(self.headers.get('Content-Length') or 0)
+                server.handle(self, BYTES2STR(self.rfile.read(n)))
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = threadingHTTPServer((host, port), handler)
+        self.url = 'http://%s:%d' % self.httpd.server_address[:2]
+
+    def Start(self):
+        StartDaemonThread(self.httpd.serve_forever)
+
+    def Stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # SmartQQ 每次登录分配的 uin 可能不同：此后的登录使用新的 psessionid ，
+    # 所有群及群成员的 uin 加上 shift （群名、 gcode 不变）
+    def Relogin(self, shift=100):
+        with self.lock:
+            self.logins += 1
+            self.psessionid = 'mockpsession%d' % self.logins
+            self.groups = [(str(int(gid)+shift), gcode, name)
+                           for gid, gcode, name in self.groups]
+            self.members = dict(
+                (gcode, [(str(int(uin)+shift), nick) for uin, nick in ms])
+                for gcode, ms in self.members.items()
+            )
+
+    def PushMessage(self, ctype, fromUin, membUin, text):
+        with self.lock:
+            self.msgId += 1
+            msgId = self.msgId
+        value = {
+            'from_uin': int(fromUin), 'msg_id': msgId, 'to_uin': int(self.qq),
+            'time': int(time.time()),
+            'content': [['font', {'name': '宋体', 'size': 10}], text]
+        }
+        if ctype != 'buddy':
+            value['send_uin'] = int(membUin)
+        pollType = {'buddy': 'message', 'group': 'group_message',
+                    'discuss': 'discu_message'}[ctype]
+        self.messages.put({'poll_type': pollType, 'value': value})
+        return msgId
+
+    def handle(self, req, body):
+        u = UrlSplit(req.path)
+        path = u.path.rstrip('/')
+        query = dict((k, v[0]) for k, v in parse_qs(u.query).items())
+        form = dict((k, v[0]) for k, v in parse_qs(body or '').items())
+        self.requests.append((path, time.time()))
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        func = getattr(self, 'on_' + path.split('/')[-1].split('.')[0], None)
+        if func is None:
+            status, headers, content = 404, {}, ''
+        else:
+            headers = {}
+            content = func(query, form, headers)
+            status = 302 if 'Location' in headers else 200
+
+        if not isinstance(content, bytes):
+            if not isinstance(content, str):
+                content = JsonDumps(content)
+            content = STR2BYTES(content)
+
+        req.send_response(status)
+        for k, v in headers.items():
+            if k == 'Set-Cookie':
+                for c in v:
+                    req.send_header(k, c)
+            else:
+                req.send_header(k, v)
+        req.send_header('Content-Length', str(len(content)))
+        req.end_headers()
+        req.wfile.write(content)
+
+    # 登录流程
+
+    def on_login(self, query, form, headers):
+        headers['Set-Cookie'] = ['pt_login_sig=mock; Path=/']
+        return 'ok'
+
+    def on_ptqrshow(self, query, form, headers):
+        headers['Set-Cookie'] = ['qrsig=mockqrsig; Path=/']
+        headers['Content-Type'] = 'image/png'
+        return b'\x89PNG\r\n\x1a\nmock'
+
+    def on_ptqrlogin(self, query, form, headers):
+        headers['Set-Cookie'] = ['superuin=o%s; Path=/' % self.qq]
+        return ("ptuiCB('0','0','%s/check_sig?pttype=1','0',"
+                "'登录成功！', 'mock-nick');") % self.url
+
+    def on_check_sig(self, query, form, headers):
+        headers['Set-Cookie'] = ['ptwebqq=mockptwebqq; Path=/',
+                                 'skey=@mockskey; Path=/']
+        headers['Location'] = '/proxy.html'
+        return ''
+
+    def on_proxy(self, query, form, headers):
+        return ''
+
+    def on_getvfwebqq(self, query, form, headers):
+        return {'retcode': 0, 'result': {'vfwebqq': 'mockvfwebqq'}}
+
+    def on_login2(self, query, form, headers):
+        return {'retcode': 0,
+                'result': {'uin': int(self.qq), 'psessionid': self.psessionid}}
+
+    def on_get_online_buddies2(self, query, form, headers):
+        return {'retcode': 0, 'result': []}
+
+    def on_pingd(self, query, form, headers):
+        return ''
+
+    # 收发消息
+
+    def on_poll2(self, query, form, headers):
+        try:
+            items = [self.messages.get(timeout=self.pollHold)]
+        except Queue.Empty:
+            return {'errmsg': 'error!!!', 'retcode': 0}
+        while True:
+            try:
+                items.append(self.messages.get_nowait())
+            except Queue.Empty:
+                break
+        return {'retcode': 0, 'result': items}
+
+    def onSend(self, ctype, tag, form):
+        r = JsonLoads(form['r'])
+        self.sent.append((ctype, str(r[tag]), JsonLoads(r['content'])))
+        return {'errCode': 0, 'msg': 'send ok'}
+
+    def on_send_buddy_msg2(self, query, form, headers):
+        return self.onSend('buddy', 'to', form)
+
+    def on_send_qun_msg2(self, query, form, headers):
+        return self.onSend('group', 'group_uin', form)
+
+    def on_send_discu_msg2(self, query, form, headers):
+        return self.onSend('discuss', 'did', form)
+
+    # 联系人列表
+
+    def on_get_user_friends2(self, query, form, headers):
+        return {'retcode': 0, 'result': {
+            'friends': [{'uin': int(uin)} for uin, nick in self.buddies],
+            'marknames': [],
+            'info': [{'uin': int(uin), 'nick': nick}
+                     for uin, nick in self.buddies]
+        }}
+
+    def on_get_group_name_list_mask2(self, query, form, headers):
+        return {'retcode': 0, 'result': {
+            'gmasklist': [],
+            'gmarklist': [],
+            'gnamelist': [{'gid': int(gid), 'code': int(gcode), 'name': name}
+                          for gid, gcode, name in self.groups]
+        }}
+
+    def on_get_group_info_ext2(self, query, form, headers):
+        members = self.members.get(query.get('gcode'), [])
+        return {'retcode': 0, 'result': {
+            'ginfo': {'members': [{'muin': int(uin)} for uin, n in members]},
+            'minfo': [{'nick': nick} for uin, nick in members],
+            'cards': []
+        }}
+
+    def on_get_discus_list(self, query, form, headers):
+        return {'retcode': 0, 'result': {
+            'dnamelist': [{'did': int(did), 'name': name}
+                          for did, name in self.discusses]
+        }}
+
+    def on_get_discu_info(self, query, form, headers):
+        did = query.get('did', '')
+        uins = [(did + str(j), 'dmember%d' % j) for j in range(3)]
+        return {'retcode': 0, 'result': {
+            'info': {'mem_list': [{'mem_uin': int(u), 'ruin': int(u)}
+                                  for u, n in uins]},
+            'mem_info': [{'uin': int(u), 'nick': n} for u, n in uins]
+        }}
+
+    # 群管理
+
+    def on_delete_group_member(self, query, form, headers):
+        return {'ec': 0}
+
+    on_set_group_admin = on_delete_group_member
+    on_set_group_shutup = on_delete_group_member
+    on_set_group_card = on_delete_group_member
+
+if __name__ == '__main__':
+    server = MockSmartQQ(port=int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    print('MockSmartQQ 服务器：%s' % server.url)
+    server.httpd.serve_forever()
@@ -101,6 +101,8 @@ def Query(host, port, req):
     try:
         sock.connect((host, int(port)))
         sock.sendall(req)
+        # 关闭写端，服务器读到 EOF 即知道请求已发送完毕（见 termserver.py ）
+        sock.shutdown(socket.SHUT_WR)
         while True:
             data = sock.recv(8096)
             if not data:
@@ -227,7 +227,7 @@ class Client(object):
         if tar is None:
             self.send(self.servername, '401', [nick], 'No such nick/channel')
             return
-        self.bot.SendTo(tar, msg)
+        self.bot.SendTo(tar.contact, msg)
     
     def onQQMessage(self, bot, contact, member, content):
         if self.handler is None:
@@ -241,8 +241,7 @@ class Client(object):
         if contact.ctype == 'buddy':
             buddy = self.buddies.get(uin=contact.uin)
             if buddy is None:
-                self.buddies.add(contact)
-                buddy = contact
+                buddy = self.buddies.add(contact)
             # <== :Eva!2571046716@qqbot PRIVMSG hcj :ghhhhh
             prefix = '%s!%s@qqbot' % (buddy.nick, buddy.uin)
             self.send(prefix, 'PRIVMSG', [self.nick], content)
@@ -250,8 +249,7 @@ class Client(object):
         elif contact.ctype in ('group', 'discuss'):
             channel = self.channels.get(uin=contact.uin)
             if channel is None:
-                self.channels.add(contact)
-                channel = contact
+                channel = self.channels.add(contact)
             if self.nick not in channel.membNicks:
                 self.join(channel)
             nick = removeSpecial(member.name)
@@ -293,10 +291,20 @@ specials = re.compile(r'[!$#: ]')
 def removeSpecial(s):
     return '*'.join(specials.split(s))
 
+# QContact 对象是只读的， IRC 昵称及频道成员保存在 ircContact 对象中
+class ircContact(object):
+    def __init__(self, contact, nick):
+        self.contact = contact
+        self.uin = contact.uin
+        self.ctype = contact.ctype
+        self.nick = nick
+        if contact.ctype in ('group', 'discuss'):
+            self.membNicks = set()
+
 class ContactList(object):
     def __init__(self, contacts=None, discusses=None):
-        self.nicks = {}     # nick ==> contact
-        self.uins = {}      # uin ==> contact
+        self.nicks = {}     # nick ==> ircContact
+        self.uins = {}      # uin ==> ircContact
         if contacts:
             for contact in contacts:
                 self.add(contact)
@@ -306,8 +314,7 @@ class ContactList(object):
     
     def add(self, contact):
         if contact.uin in self.uins:
-            return
-        self.uins[contact.uin] = contact
+            return self.uins[contact.uin]
         name = removeSpecial(contact.name)
         if contact.ctype == 'group':
             name = '#' + name
@@ -318,10 +325,9 @@ class ContactList(object):
         while nick in self.nicks:
             nick = name + str(i)
             i += 1
-        self.nicks[nick] = contact
-        contact.__dict__['nick'] = nick
-        if contact.ctype in ('group', 'discuss'):
-            contact.__dict__['membNicks'] = set()
+        c = self.uins[contact.uin] = self.nicks[nick] = \
+            ircContact(contact, nick)
+        return c
     
     def get(self, nick=None, uin=None):
         if nick is not None:
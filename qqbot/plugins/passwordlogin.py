@@ -117,7 +117,6 @@ class NewBasicQSession(BasicQSession):
         self.bkn = bknHash(self.session.cookies['skey'])        
         self.clientid = 53999199
         self.msgId = 6000000
-        self.lastSendTime = 0
         self.nick = nick
         
         self.session.headers.update({
@@ -130,8 +129,7 @@ class NewBasicQSession(BasicQSession):
         except:
             self.TestLogin()
 
-        t = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(time.time()))
-        self.dbbasename = '%s-%s-contact.db' % (t, self.qq)
+        self.dbbasename = '%s-contact.db' % self.qq
         self.dbname = conf.absPath(self.dbbasename)
         conf.SetQQ(self.qq)
 
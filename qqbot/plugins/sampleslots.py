@@ -46,6 +46,25 @@ def onUpdate(bot, tinfo):
     # tinfo : 联系人列表的代号，详见文档中关于 bot.List 的第一个参数的含义解释
     DEBUG('%s.onUpdate: %s', __name__, tinfo)
 
+def onContactAdded(bot, tinfo, contact):
+    # 更新联系人列表时，发现列表中新增了一个联系人时被调用（第一次获取某个列表时不调用）
+    # bot : QQBot 对象，提供 List/SendTo/GroupXXX/Stop/Restart 等接口，详见文档第五节
+    # tinfo : 联系人列表的代号，如 'buddy' 或一个群（群成员列表）
+    # contact : QContact 对象，新增的联系人
+    DEBUG('%s.onContactAdded: %s %s', __name__, tinfo, contact)
+
+def onContactRemoved(bot, tinfo, contact):
+    # 更新联系人列表时，发现列表中的一个联系人已被删除（如退群）时被调用
+    # contact : QContact 对象，被删除的联系人（更新前的资料）
+    DEBUG('%s.onContactRemoved: %s %s', __name__, tinfo, contact)
+
+def onContactChanged(bot, tinfo, contact, oldContact):
+    # 更新联系人列表时，发现一个联系人的资料（如名称、群名片）有变化时被调用
+    # contact : QContact 对象，更新后的资料
+    # oldContact : QContact 对象，更新前的资料
+    DEBUG('%s.onContactChanged: %s %s -> %s', __name__, tinfo, oldContact,
+          contact)
+
 def onPlug(bot):
     # 本插件被加载时被调用，提供 List/SendTo/GroupXXX/Stop/Restart 等接口，详见文档第五节
     # 提醒：如果本插件设置为启动时自动加载，则本函数将延迟到登录完成后被调用
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# 流水线式的消息接收（ long-poll ）
+#
+# 同时保持 n 个 poll2 请求（每个请求使用一个会话副本、一个线程），一个请求返回后
+# 立即发起下一个，其他请求仍在等待，因此两次 poll 之间不会出现没有请求在等待消息的
+# 空档。每次 poll 返回的所有消息都按顺序交给 onMessage ，并按 msg_id 去重（同一
+# 条消息可能被多个请求返回）。
+#
+# 运行指标： poll_rtt （一次 poll 请求的耗时）、 poll_gap （没有任何 poll 请求在
+# 等待消息的时长）、 poll_items 、 poll_duplicates 、 poll_inflight
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, threading, collections
+
+from qqbot.basicqsession import RequestError
+from qqbot.utf8logger import ERROR
+from qqbot.common import StartDaemonThread
+from qqbot.metrics import Inc, Observe, SetGauge
+
+class Poller(object):
+
+    # 各个 poll 线程启动时间的间隔（秒），避免所有请求同时返回
+    stagger = 0.5
+
+    def __init__(self, session, n=2, dedupWindow=1000):
+        self.session = session
+        self.n = max(1, n)
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.seenOrder = collections.deque()
+        self.dedupWindow = dedupWindow
+        self.inflight = 0
+        self.idleSince = None
+        self.stopped = False
+        self.expired = False
+
+    # onMessage(ctype, fromUin, membUin, content) 在 poll 线程中被调用
+    # onExpire() 在登录 cookie 过期时被调用一次
+    def Start(self, onMessage, onExpire):
+        self.onMessage = onMessage
+        self.onExpire = onExpire
+        for i in range(self.n):
+            StartDaemonThread(self.pollAt, self.session.Copy(), i)
+
+    # 已发出的 poll 请求将在返回后结束
+    def Stop(self):
+        self.stopped = True
+
+    def pollAt(self, session, i):
+        time.sleep(i * self.stagger)
+        while not self.stopped:
+            t = self.begin()
+            try:
+                items = session.PollAll()
+            except RequestError:
+                self.end(t)
+                self.expire()
+                break
+            except:
+                self.end(t)
+                ERROR('qsession.Poll 方法出错', exc_info=True)
+            else:
+                self.end(t)
+                self.deliver(items)
+
+    def begin(self):
+        with self.lock:
+            if self.inflight == 0 and self.idleSince is not None:
+                Observe('poll_gap', time.time() - self.idleSince)
+            self.inflight += 1
+            SetGauge('poll_inflight', self.inflight)
+        return time.time()
+
+    def end(self, t):
+        with self.lock:
+            Observe('poll_rtt', time.time() - t)
+            self.inflight -= 1
+            SetGauge('poll_inflight', self.inflight)
+            if self.inflight == 0:
+                self.idleSince = time.time()
+
+    def expire(self):
+        with self.lock:
+            if self.expired or self.stopped:
+                return
+            self.expired = self.stopped = True
+        self.onExpire()
+
+    def deliver(self, items):
+        with self.lock:
+            for msgId, item in items:
+                if msgId is not None:
+                    if msgId in self.seen:
+                        Inc('poll_duplicates')
+                        continue
+                    self.seen.add(msgId)
+                    self.seenOrder.append(msgId)
+                    if len(self.seenOrder) > self.dedupWindow:
+                        self.seen.discard(self.seenOrder.popleft())
+                Inc('poll_items')
+                if not self.stopped:
+                    self.onMessage(*item)
+
+if __name__ == '__main__':
+    # 使用本地的 MockSmartQQ 服务器比较 n=1 和 n=3 时的消息延迟
+    import tempfile
+    from qqbot.qconf import QConf
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.metrics import Report, Reset
+
+    server = MockSmartQQ(pollHold=1.0, latency=0.05)
+    server.Start()
+
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    session.Login(QConf(['-b', tempfile.mkdtemp(), '-q', '']))
+
+    for n in (1, 3):
+        Reset('poll')
+        received = []
+        poller = Poller(session, n)
+        poller.stagger = 0.3
+        poller.Start(lambda *item: received.append((time.time(), item[3])),
+                     lambda: None)
+        time.sleep(1)
+        sent = {}
+        for i in range(50):
+            sent['msg%d' % i] = time.time()
+            server.PushMessage('group', '2000', '20000001', 'msg%d' % i)
+            time.sleep(0.02)
+        time.sleep(2)
+        poller.Stop()
+        delays = sorted(t - sent[text] for t, text in received)
+        print('n=%d received=%d in-order=%s p50=%.3f max=%.3f' % (
+            n, len(received),
+            [x[1] for x in received] == ['msg%d' % i for i in range(50)],
+            delays[len(delays) // 2], delays[-1]
+        ))
+        print(Report('poll'))
+        time.sleep(1.5)
+
+    server.Stop()
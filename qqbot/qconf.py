@@ -53,6 +53,15 @@ sampleConfStr = '''
         # 完成全部联系人列表获取之后才启动 QQBot 
         "startAfterFetch" : False,
         
+        # 同时等待消息的 poll 请求数
+        "pollConcurrency" : 2,
+        
+        # 各类联系人列表的最长有效时间（秒），过期的列表在后台自动刷新，设为 0 则不刷新
+        "contactMaxAge" : {
+            "buddy" : 3600, "group" : 3600, "discuss" : 3600,
+            "group-member" : 7200, "discuss-member" : 7200,
+        },
+        
         # 插件目录
         "pluginPath" : ".",
         
@@ -64,6 +73,13 @@ sampleConfStr = '''
     
     },
     
+    # 多账号模式：在同一个进程中同时登录多个 QQ 账号，每个账号使用一个用户的配置
+    # （各账号的 termServerPort 应设置为不同的端口号或 0 ），例如：
+    # "多账号配置" : {
+    #     "users" : ["somebody", "somebody2"],
+    # },
+    # 然后使用 qqbot -u 多账号配置 启动程序，或直接使用 qqbot -us somebody,somebody2
+    
     # 可以在 默认配置 中配置所有用户都通用的设置
     "默认配置" : {
         "qq" : "",
@@ -90,9 +106,12 @@ sampleConfStr = '''
     #     "restartOnOffline" : False,
     #     "daemon" : False,
     #     "startAfterFetch" : False,
+    #     "pollConcurrency" : 2,
+    #     "contactMaxAge" : {},
     #     "pluginPath" : "",
     #     "plugins" : [],
-    #     "pluginsConf" : {}
+    #     "pluginsConf" : {},
+    #     "users" : []
     # },
 
 }
@@ -110,9 +129,12 @@ rootConf = {
     "restartOnOffline" : False,
     "daemon" : False,
     "startAfterFetch" : False,
+    "pollConcurrency" : 2,
+    "contactMaxAge" : {},
     "pluginPath" : "",
     "plugins" : [],
     "pluginsConf" : {},
+    "users" : [],
 }
 
 if sys.argv[0].endswith('.py') or sys.argv[0].endswith('.pyc'):
@@ -126,7 +148,7 @@ QQBot 机器人
 用法: {PROGNAME} [-h] [-d] [-nd] [-u USER] [-q QQ]
           [-p TERMSERVERPORT] [-ip HTTPSERVERIP][-hp HTTPSERVERPORT]
           [-m MAILACCOUNT] [-mc MAILAUTHCODE] [-r] [-nr]
-          [-fi FETCHINTERVAL]
+          [-fi FETCHINTERVAL] [-pc POLLCONCURRENCY] [-us USERS]
 
 选项:
   通用:
@@ -151,6 +173,10 @@ QQBot 机器人
     -q QQ, --qq QQ          指定本次启动时使用的QQ号。
                             如果指定的QQ号的自动登陆信息存在，那么将会使用自动
                               登陆信息进行快速登陆。
+    -us USERS, --users USERS
+                            多账号模式，在同一个进程中登录多个账号。
+                            USERS 为以逗号分隔的多个配置文件项目的名称，每个
+                              账号使用一个项目中的设定。
 
   QTerm本地控制台服务:
     -p TERMSERVERPORT, --termServerPort TERMSERVERPORT
@@ -181,7 +207,10 @@ QQBot 机器人
 
   其他：
     -cq, --cmdQrcode        以文本模式显示二维码
-    -saf, --startAfterFetch 全部联系人资料获取完成后再启动 QQBot
+    -saf, --startAfterFetch 好友/群/讨论组列表获取完成后再启动 QQBot ，
+                            并在后台并行获取全部成员列表
+    -pc POLLCONCURRENCY, --pollConcurrency POLLCONCURRENCY
+                            同时等待消息的 poll 请求数，默认为 2
     -pp PLUGINPATH, --pluginPath PLUGINPATH
                             设置插件目录
     -pl PLUGINS, --plugins PLUGINS
@@ -254,10 +283,14 @@ class QConf(object):
         parser.add_argument('-saf', '--startAfterFetch',
                             action='store_true', default=None)
 
+        parser.add_argument('-pc', '--pollConcurrency', type=int)
+
         parser.add_argument('-pp', '--pluginPath')
 
         parser.add_argument('-pl', '--plugins')
 
+        parser.add_argument('-us', '--users')
+
         try:
             opts = parser.parse_args(argv)
         except:
@@ -303,6 +336,9 @@ class QConf(object):
         if opts.pluginPath:
             opts.pluginPath = SYSTEMSTR2STR(opts.pluginPath)
         
+        if opts.users:
+            opts.users = SYSTEMSTR2STR(opts.users).split(',')
+        
         for k, v in list(opts.__dict__.items()):
             if getattr(self, k, None) is None:
                 setattr(self, k, v)
@@ -434,11 +470,16 @@ class QConf(object):
         INFO('掉线后自动重启：%s', self.restartOnOffline and '是' or '否')
         INFO('后台模式（daemon 模式）：%s', self.daemon and '是' or '否')
         INFO('启动方式：%s',
-             self.startAfterFetch and '慢启动（联系人列表获取完成后再启动）'
+             self.startAfterFetch and '慢启动（联系人列表获取完成后再启动，'
+                                      '成员列表在后台获取）'
                                    or '快速启动（登录成功后立即启动）')
+        INFO('同时等待消息的 poll 请求数：%s', self.pollConcurrency)
+        self.contactMaxAge and \
+            INFO('联系人列表的最长有效时间：%s', self.contactMaxAge)
         self.pluginPath and INFO('插件目录0：%s', self.pluginPath)
         self.pluginPath1 and INFO('插件目录1：%s', self.pluginPath1)
         INFO('启动时需要加载的插件：%s', self.plugins)
+        self.users and INFO('多账号模式，账号配置：%s', self.users)
 
     def absPath(self, rela):
         return os.path.join(self.bench, rela)
@@ -1,2 +1,2 @@
-from .qcontactdb import QContactDB
+from .qcontactdb import QContactDB, NotInDB
 from .contactdb import QContact
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# 联系人缓存
+#
+# 收到每条消息时都要查找发送者（群消息还要查找成员以及自己在群内的名称），
+# ContactCache 将最近查找过的联系人按 (类型, 所属群/讨论组的 uin, uin) 缓存在内存
+# 中（最多 maxSize 个，ttl 秒后过期，超出数量时淘汰最久未使用的）。
+#
+# ContactDB 的 Update 使列表中被增加、删除或修改的联系人的缓存失效（ remap 时清空
+# 整个缓存）， Modify/Delete 使对应联系人的缓存失效。
+#
+# 不存在的联系人也会被缓存（ Get 返回 MISSING ），例如群消息中查找自己在群内的名称，
+# 该 uin 被 Update 加入列表时这条记录同样失效。
+#
+# 运行指标： contactcache_hit{ctype} 、 contactcache_miss{ctype}
+
+import sys, os.path as op
+p = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, threading, collections
+
+from qqbot.metrics import Inc
+
+MISSING = object()
+
+# (tType(tinfo), 所属群/讨论组的 uin)
+def tableKey(tinfo):
+    if tinfo in ('buddy', 'group', 'discuss'):
+        return (tinfo, '')
+    else:
+        return (tinfo.ctype + '-member', tinfo.uin)
+
+class ContactCache(object):
+
+    maxSize = 20000
+    ttl = 600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.hits = self.misses = 0
+        self.enabled = True
+
+    def Get(self, tinfo, uin):
+        if not self.enabled:
+            return None
+        tkey = tableKey(tinfo)
+        key = tkey + (uin,)
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None:
+                contact, expires = item
+                if expires > time.time():
+                    self.items[key] = item
+                    self.hits += 1
+                    Inc('contactcache_hit', ctype=tkey[0])
+                    return contact
+            self.misses += 1
+        Inc('contactcache_miss', ctype=tkey[0])
+        return None
+
+    # contact 为 MISSING 时表示此 uin 不在列表中
+    def Put(self, tinfo, uin, contact):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.items[tableKey(tinfo) + (uin,)] = \
+                (contact, time.time() + self.ttl)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+
+    def Invalidate(self, tinfo, uin):
+        with self.lock:
+            self.items.pop(tableKey(tinfo) + (uin,), None)
+
+    def Clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def Stats(self):
+        n = self.hits + self.misses
+        return {
+            'size': len(self.items), 'hits': self.hits, 'misses': self.misses,
+            'hitRate': n and round(self.hits / float(n), 4)
+        }
@@ -1,6 +1,51 @@
 # -*- coding: utf-8 -*-
 
-import sqlite3, traceback
+# 联系人数据库
+#
+# 好友、群、讨论组各存放在一张表中；所有群的成员存放在同一张 group_member 表中，
+# 所有讨论组的成员存放在同一张 discuss_member 表中，以 owner （群/讨论组的 uin ）
+# 区分，并建有 (owner, uin) 、 (owner, qq) 、 (owner, name) 索引。
+#
+# contact_tables 表记录已获取的联系人列表（ tName(tinfo) ）及其更新时间，打开数据库时
+# 读入内存（ self.present ），List 时无需再查询 sqlite_master ，后台刷新（见
+# refresher.py ）也按此时间判断列表是否过期。
+#
+# 数据库文件在重启后继续使用（见 qsession.py ）。 contact_tables 表同时记录每个列表
+# 是在哪次登录（ generation ，即登录时的 psessionid ）中获取的，上次登录获取的列表
+# （ self.carried ）在本次登录中仍可使用，但其中的 uin 可能已经改变：
+#   1) 每个列表在第一次使用时重新获取（见 QContactDB.List ），获取失败时仍使用
+#      数据库中的内容；其余列表由后台刷新（见 refresher.py ）尽快重新获取
+#   2) 重新获取群/讨论组列表时，按名称把上次的群/讨论组与新列表对应起来，其成员列表
+#      移到新的 uin 下（ remap ），无法对应的群/讨论组的成员列表被删除
+#
+# contact_search/contact_grams 表为模糊搜索的索引（见 search.py ），随联系人的
+# Update/Modify/Delete 一起更新。从没有索引的旧版本升级时不在打开数据库时为全部
+# 联系人建立索引，而是把已有的列表记入 contact_unindexed 表，每个列表在第一次
+# 模糊搜索或重新获取时再建立索引。
+#
+# 旧版本中每个群/讨论组的成员各自存放在一张 group_member_<uin> 表中，打开数据库时
+# 自动迁移到新的表中（ PRAGMA user_version 记录数据库的版本）。
+#
+# 连接与事务：
+#   1) 数据库文件使用 WAL 日志模式（ synchronous=NORMAL ），读取不会被写入阻塞
+#   2) 各列表类型、各操作的 SQL 语句只拼接一次（ sqlOf ），连接的 cached_statements
+#      足够容纳所有语句，每条语句在 sqlite 中也只编译一次
+#   3) 写入（ Sync/Modify/Delete ）使用写连接，由 self.lock 保护，可在任意线程中调用；
+#      Modify/Delete 先放入队列，在 commitDelay 秒后或累积 commitBatch 个后在一个
+#      事务中提交（如 GroupManager 连续修改多个成员），读取前先提交队列中的修改
+#   4) 打开数据库的线程（主线程）使用写连接读取，其他线程（如 FetchPool 的工作线程、
+#      term 服务器的线程）各自使用一个只读连接，互不阻塞
+
+import sys, os.path as op
+p = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import sqlite3, traceback, time, re, threading, contextlib
+
+from qqbot.utf8logger import INFO
+from qqbot.qcontactdb.contactcache import ContactCache
+from qqbot.qcontactdb.search import SEARCH_FIELDS, IndexRows, Search
 
 TAGS = ('qq=', 'name=', 'nick=', 'mark=', 'card=', 'uin=')
 
@@ -9,11 +54,27 @@ CTYPES = {
     'group-member': '成员', 'discuss-member': '成员'
 }
 
+# 联系人对象是只读的，各字段（顺序同 cls.fields ）存放在 __slots__ 中，通过属性
+# 读取（ c.uin 、 c.name 等）， ctype/chs_type 为类属性。对象不带 __dict__ ，列出
+# 一个 2000 人的群时不再为每个成员各建一个 dict 。
+# c.__dict__ 仍可读取（返回各字段组成的新 dict ），但修改它不会改变联系人对象。
 class QContact(object):
+    __slots__ = ()
+
     def __init__(self, *fields):
-        for k, field in zip(self.fields, fields):
-            self.__dict__[k] = field
-        self.__dict__['ctype'] = self.__class__.ctype
+        for setter, field in zip(self.setters, fields):
+            setter(self, field)
+
+    # 由数据库中的一行记录直接生成联系人对象
+    @classmethod
+    def FromRow(cls, row):
+        c = object.__new__(cls)
+        for setter, field in zip(cls.setters, row):
+            setter(c, field)
+        return c
+
+    def __reduce__(self):
+        return (self.__class__, tuple(getattr(self, f) for f in self.fields))
 
     def __repr__(self):
         return '%s“%s”' % (self.chs_type, self.name)
@@ -21,6 +82,17 @@ class QContact(object):
     def __setattr__(self, k, v):
         raise TypeError("QContact object is readonly")
 
+    @property
+    def __dict__(self):
+        d = dict((f, getattr(self, f)) for f in self.fields)
+        d['ctype'] = self.ctype
+        return d
+
+# 由 columns 得到各字段名（即子类的 __slots__ ）
+def fieldsOf(columns):
+    return tuple(row.strip().split(None, 1)[0]
+                 for row in columns.strip().split('\n'))
+
 class Buddy(QContact):
     columns = '''\
         qq VARCHAR(12),
@@ -29,6 +101,7 @@ class Buddy(QContact):
         mark VARCHAR(80),
         name VARCHAR(80)
     '''
+    __slots__ = fieldsOf(columns)
 
 class Group(QContact):
     columns = '''\
@@ -39,12 +112,14 @@ class Group(QContact):
         name VARCHAR(80),
         gcode VARCHAR(12)
     '''
+    __slots__ = fieldsOf(columns)
 
 class Discuss(QContact):
     columns = '''\
         uin VARCHAR(12) PRIMARY KEY,
         name VARCHAR(80)
     '''
+    __slots__ = fieldsOf(columns)
 
 class GroupMember(QContact):
     columns = '''\
@@ -63,6 +138,7 @@ class GroupMember(QContact):
         levelname VARCHAR(36),
         point INTEGER
     '''
+    __slots__ = fieldsOf(columns)
 
 class DiscussMember(QContact):
     columns = '''\
@@ -70,16 +146,30 @@ class DiscussMember(QContact):
         uin VARCHAR(12) PRIMARY KEY,
         name VARCHAR(80)
     '''
+    __slots__ = fieldsOf(columns)
 
 contactMaker = {}
 
 for cls in [Buddy, Group, Discuss, GroupMember, DiscussMember]:
     cls.ctype = cls.__name__.lower().replace('member', '-member')
     cls.chs_type = CTYPES[cls.ctype]
-    cls.fields = [row.strip().split(None, 1)[0]
-                  for row in cls.columns.strip().split('\n')]
+    cls.fields = list(cls.__slots__)
+    cls.fieldStr = ','.join(cls.fields)
+    cls.setters = [getattr(cls, field).__set__ for field in cls.fields]
+    cls.table = cls.ctype.replace('-', '_')
     contactMaker[cls.ctype] = cls
 
+# 1: 合并成员表； 2: 模糊搜索索引； 3: contact_tables.generation
+DB_VERSION = 3
+
+# (cond, args) ，如 ('name like ?', ['%jack%'])
+def likeCond(column, value, like=False):
+    if like:
+        value = '%' + value + '%'
+    return '%s%s?' % (column, like and ' like ' or '='), [value]
+
+legacyRegex = re.compile(r'^(group|discuss)_member_(\d+)$')
+
 def tName(tinfo):
     if tinfo in ('buddy', 'group', 'discuss'):
         return tinfo
@@ -102,44 +192,554 @@ def tType(tinfo):
 def tMaker(tinfo):
     return contactMaker[tType(tinfo)]
 
+# 成员表中的 owner 列的值，好友/群/讨论组表返回 None
+def tOwner(tinfo):
+    if tinfo in ('buddy', 'group', 'discuss'):
+        return None
+    else:
+        return tinfo.uin
+
+def schemaOf(tmaker):
+    if not tmaker.ctype.endswith('-member'):
+        sqls = ["CREATE TABLE IF NOT EXISTS '%s' (%s)" %
+                (tmaker.table, tmaker.columns)]
+        cols = [(c,) for c in ('qq', 'name') if c in tmaker.fields]
+    else:
+        columns = tmaker.columns.replace(' PRIMARY KEY', '').rstrip()
+        sqls = ["CREATE TABLE IF NOT EXISTS '%s' ("
+                "owner VARCHAR(12), %s, PRIMARY KEY (owner, uin))" %
+                (tmaker.table, columns)]
+        cols = [('owner', c) for c in ('qq', 'name') if c in tmaker.fields]
+    for c in cols:
+        sqls.append("CREATE INDEX IF NOT EXISTS '%s_%s' ON '%s' (%s)" %
+                    (tmaker.table, '_'.join(c), tmaker.table, ','.join(c)))
+    return sqls
+
+searchSchema = [
+    "CREATE TABLE IF NOT EXISTS contact_search (ttype VARCHAR(16), "
+    "owner VARCHAR(12), uin VARCHAR(12), texts TEXT, initials TEXT)",
+    "CREATE INDEX IF NOT EXISTS contact_search_owner_uin "
+    "ON contact_search (ttype, owner, uin)",
+    "CREATE TABLE IF NOT EXISTS contact_grams (ttype VARCHAR(16), "
+    "owner VARCHAR(12), gram VARCHAR(8), uin VARCHAR(12))",
+    "CREATE INDEX IF NOT EXISTS contact_grams_owner_gram "
+    "ON contact_grams (ttype, owner, gram)",
+    "CREATE INDEX IF NOT EXISTS contact_grams_owner_uin "
+    "ON contact_grams (ttype, owner, uin)"
+]
+
 class ContactDB(object):
-    def __init__(self, dbname=':memory:'):
-        self.conn = sqlite3.connect(dbname)
-        self.conn.text_factory = str
+
+    commitDelay = 0.05
+    commitBatch = 100
+
+    # generation: 本次登录的标识，见文件开头的说明
+    def __init__(self, dbname=':memory:', generation=''):
+        self.dbname = dbname
+        self.generation = generation
+        self.conn = self.connect()
         self.cursor = self.conn.cursor()
+        self.lock = threading.RLock()
+        self.thread = threading.current_thread()
+        self.local = threading.local()
+        self.stmts = {}
+        self.ops = []
+        self.timer = None
+        self.cache = ContactCache()
+        self.setup()
+
+    def connect(self, readonly=False):
+        conn = sqlite3.connect(self.dbname, check_same_thread=False,
+                               cached_statements=256)
+        conn.text_factory = str
+        if self.dbname != ':memory:':
+            if not readonly:
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        if readonly:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    # 读取时使用的游标，见文件开头的说明。 :memory: 数据库只有一个连接
+    @contextlib.contextmanager
+    def reading(self):
+        if self.ops:
+            self.Flush()
+        if self.dbname == ':memory:' or \
+                threading.current_thread() is self.thread:
+            with self.lock:
+                yield self.cursor
+        else:
+            cursor = getattr(self.local, 'cursor', None)
+            if cursor is None:
+                cursor = self.local.cursor = self.connect(True).cursor()
+            yield cursor
+
+    def read(self, sql, args=()):
+        with self.reading() as cursor:
+            cursor.execute(sql, args)
+            return cursor.fetchall()
+
+    # key: (列表类型, 操作, 条件) ，同一 key 的 SQL 语句只拼接一次。
+    # op 为 'SELECT' 、 'DELETE' 、 'INSERT' 或 'SET col1=?,col2=?'
+    def sqlOf(self, tmaker, op, cond=''):
+        key = (tmaker.ctype, op, cond)
+        sql = self.stmts.get(key)
+        if sql is not None:
+            return sql
+
+        member = tmaker.ctype.endswith('-member')
+        where = ' AND '.join(c for c in (member and 'owner=?', cond) if c)
+        where = where and (' WHERE ' + where)
+        if op == 'SELECT':
+            sql = "SELECT %s FROM '%s'%s" % \
+                  (tmaker.fieldStr, tmaker.table, where)
+        elif op == 'DELETE':
+            sql = "DELETE FROM '%s'%s" % (tmaker.table, where)
+        elif op == 'INSERT':
+            n = len(tmaker.fields) + member
+            sql = "INSERT INTO '%s' (%s%s) VALUES(%s)" % (
+                tmaker.table, member and 'owner,' or '', tmaker.fieldStr,
+                ','.join(['?']*n)
+            )
+        else:
+            sql = "UPDATE '%s' %s%s" % (tmaker.table, op, where)
+        self.stmts[key] = sql
+        return sql
+
+    # 放入 Modify/Delete 的队列， op 在持有 self.lock 时调用
+    def defer(self, op):
+        with self.lock:
+            self.ops.append(op)
+            if len(self.ops) >= self.commitBatch:
+                self.Flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.commitDelay, self.Flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    # 在一个事务中执行并提交队列中的修改。出错时逐个重新执行，跳过出错的修改
+    def Flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            ops, self.ops = self.ops, []
+            if not ops:
+                return
+            try:
+                for op in ops:
+                    op()
+            except:
+                self.conn.rollback()
+                traceback.print_exc()
+            else:
+                self.conn.commit()
+                return
+
+            for op in ops:
+                try:
+                    op()
+                except:
+                    self.conn.rollback()
+                    traceback.print_exc()
+                else:
+                    self.conn.commit()
+
+    def Close(self):
+        self.Flush()
+        with self.lock:
+            self.conn.close()
+
+    def setup(self):
+        self.cursor.execute(
+            "SELECT tbl_name FROM sqlite_master WHERE type='table'"
+        )
+        names = [r[0] for r in self.cursor.fetchall()]
+        self.cursor.execute("PRAGMA user_version")
+        version = self.cursor.fetchone()[0]
+
+        try:
+            for tmaker in contactMaker.values():
+                for sql in schemaOf(tmaker):
+                    self.cursor.execute(sql)
+            for sql in searchSchema:
+                self.cursor.execute(sql)
+            self.cursor.execute(
+                "CREATE TABLE IF NOT EXISTS contact_tables "
+                "(tname VARCHAR(40) PRIMARY KEY, updated REAL, "
+                "generation VARCHAR(40))"
+            )
+            self.cursor.execute(
+                "CREATE TABLE IF NOT EXISTS contact_unindexed "
+                "(ttype VARCHAR(20), owner VARCHAR(12), "
+                "PRIMARY KEY (ttype, owner))"
+            )
+            self.cursor.execute("PRAGMA table_info(contact_tables)")
+            if 'generation' not in [r[1] for r in self.cursor.fetchall()]:
+                self.cursor.execute("ALTER TABLE contact_tables "
+                                    "ADD COLUMN generation VARCHAR(40)")
+            if version < 1:
+                self.migrate(names)
+            if version < 2:
+                self.markUnindexed()
+            if version < DB_VERSION:
+                self.cursor.execute("PRAGMA user_version=%d" % DB_VERSION)
+        except:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+
+        self.loadTables()
+        if self.carried:
+            INFO('联系人数据库中有 %d 个列表是上次登录时获取的，将在使用时重新验证',
+                 len(self.carried))
+
+    def loadTables(self):
+        self.cursor.execute(
+            "SELECT tname, updated, generation FROM contact_tables"
+        )
+        rows = self.cursor.fetchall()
+        self.present = dict((tname, updated) for tname, updated, g in rows)
+        self.carried = set(tname for tname, updated, g in rows
+                           if (g or '') != self.generation)
+        self.cursor.execute("SELECT ttype, owner FROM contact_unindexed")
+        self.unindexed = set(self.cursor.fetchall())
+
+    # 将旧版本的数据库（每个群/讨论组的成员各占一张表）迁移到新的表中
+    def migrate(self, names):
+        n = 0
+        for name in names:
+            m = legacyRegex.match(name)
+            if m:
+                tmaker = contactMaker[m.group(1) + '-member']
+                self.cursor.execute(
+                    "INSERT OR REPLACE INTO '%s' (owner,%s) SELECT ?,%s "
+                    "FROM '%s'" % (tmaker.table, tmaker.fieldStr,
+                                   tmaker.fieldStr, name),
+                    (m.group(2),)
+                )
+                self.cursor.execute("DROP TABLE '%s'" % name)
+                n += 1
+            elif name not in ('buddy', 'group', 'discuss'):
+                continue
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO contact_tables (tname, updated) "
+                "VALUES (?, ?)", (name, 0)
+            )
+        if n:
+            INFO('已将 %d 个群/讨论组的成员表合并到 group_member/discuss_member 表', n)
     
+    # 已有的列表尚无模糊搜索索引，记下这些列表，使用时再建立（见 ensureIndexed ）
+    def markUnindexed(self):
+        self.cursor.execute("DELETE FROM contact_search")
+        self.cursor.execute("DELETE FROM contact_grams")
+        for tmaker in contactMaker.values():
+            owner = tmaker.ctype.endswith('-member') and 'owner' or "''"
+            self.cursor.execute(
+                "INSERT OR IGNORE INTO contact_unindexed "
+                "SELECT DISTINCT ?, %s FROM '%s'" % (owner, tmaker.table),
+                (tmaker.ctype,)
+            )
+        n = self.cursor.execute(
+            "SELECT COUNT(*) FROM contact_unindexed").fetchone()[0]
+        if n:
+            INFO('联系人数据库中的 %d 个列表将在第一次模糊搜索或重新获取时建立'
+                 '搜索索引', n)
+
+    # 模糊搜索之前调用，为尚无索引的列表建立索引
+    def ensureIndexed(self, tinfo):
+        tmaker, owner = tMaker(tinfo), tOwner(tinfo) or ''
+        key = (tmaker.ctype, owner)
+        if key not in self.unindexed:
+            return
+        with self.lock:
+            if key not in self.unindexed:
+                return
+            self.Flush()
+            try:
+                self.cursor.execute(self.sqlOf(tmaker, 'SELECT'),
+                                    owner and [owner] or [])
+                rows = self.cursor.fetchall()
+                self.unindex(tmaker, owner)
+                self.index(tmaker, owner, rows)
+                self.cursor.execute("DELETE FROM contact_unindexed "
+                                    "WHERE ttype=? AND owner=?", key)
+            except:
+                self.conn.rollback()
+                traceback.print_exc()
+            else:
+                self.conn.commit()
+                self.unindexed.discard(key)
+
+    # 在事务中调用， uin 为 None 时删除整个列表的索引
+    def unindex(self, tmaker, owner, uin=None):
+        for table in ('contact_search', 'contact_grams'):
+            if uin is None:
+                self.cursor.execute(
+                    "DELETE FROM %s WHERE ttype=? AND owner=?" % table,
+                    (tmaker.ctype, owner)
+                )
+            else:
+                self.cursor.execute(
+                    "DELETE FROM %s WHERE ttype=? AND owner=? AND uin=?" %
+                    table, (tmaker.ctype, owner, uin)
+                )
+
+    def index(self, tmaker, owner, rows):
+        searchRows, gramRows = \
+            IndexRows(tmaker.ctype, owner, tmaker.fields, rows)
+        self.cursor.executemany(
+            "INSERT INTO contact_search VALUES (?,?,?,?,?)", searchRows
+        )
+        self.cursor.executemany(
+            "INSERT INTO contact_grams VALUES (?,?,?,?)", gramRows
+        )
+
     def Update(self, tinfo, contacts):
-        tname, tmaker = tName(tinfo), tMaker(tinfo)
+        if self.Sync(tinfo, contacts) is None:
+            return None
+        else:
+            return rName(tinfo)
+
+    # 将 contacts 与数据库中已有的列表比较，在一个事务中只写入有变化的联系人。
+    # 返回 (added, removed, changed) ，前两者为 QContact 列表， changed 为
+    # [(新 QContact, 旧 QContact), ...] ；出错时返回 None
+    def Sync(self, tinfo, contacts):
+        with self.lock:
+            return self.sync(tinfo, contacts)
+
+    def sync(self, tinfo, contacts):
+        tname, tmaker, owner = tName(tinfo), tMaker(tinfo), tOwner(tinfo)
+        iuin = tmaker.fields.index('uin')
+
+        self.Flush()
+        args = owner and [owner] or []
+        self.cursor.execute(self.sqlOf(tmaker, 'SELECT'), args)
+        old = dict((row[iuin], row) for row in self.cursor.fetchall())
+        new = dict((str(row[iuin]), row) for row in (contacts or []))
+
+        added = [row for uin, row in new.items() if uin not in old]
+        removed = [row for uin, row in old.items() if uin not in new]
+        changed = [(row, old[uin]) for uin, row in new.items()
+                   if uin in old and [str(x) for x in row] !=
+                                     [str(x) for x in old[uin]]]
         
         try:
-            if self.exist(tname):
-                self.cursor.execute("DELETE FROM '%s'" % tname)
-            else:
-                sql = ("CREATE TABLE '%s' (" % tname) + tmaker.columns + ')'
-                self.cursor.execute(sql)
+            # 上次登录时获取的成员列表的搜索索引可能已被 remap 删除，整体重建；
+            # 尚无索引的列表（见 markUnindexed ）同样整体建立索引
+            carried = tname in self.carried
+            remapped = carried and tname in ('group', 'discuss') and \
+                       self.remap(tmaker, old, new)
+            ikey = (tmaker.ctype, owner or '')
+            reindex = (carried and owner is not None) or \
+                      ikey in self.unindexed
+            sql = self.sqlOf(tmaker, 'DELETE', 'uin=?')
+            for row in removed:
+                self.cursor.execute(sql, args + [row[iuin]])
+                reindex or self.unindex(tmaker, owner or '', row[iuin])
             
-            if contacts:
-                w = ','.join(['?']*len(tmaker.fields))
-                sql = "INSERT INTO '%s' VALUES(%s)" % (tname, w)
-                self.cursor.executemany(sql, contacts)
+            rows = added + [row for row, oldRow in changed]
+            if rows:
+                for row, oldRow in changed:
+                    self.cursor.execute(sql, args + [oldRow[iuin]])
+                    reindex or self.unindex(tmaker, owner or '', oldRow[iuin])
+                self.cursor.executemany(
+                    self.sqlOf(tmaker, 'INSERT'),
+                    [args + list(row) for row in rows]
+                )
+                reindex or self.index(tmaker, owner or '', rows)
+
+            if reindex:
+                self.unindex(tmaker, owner or '')
+                self.index(tmaker, owner or '', list(new.values()))
+                self.cursor.execute("DELETE FROM contact_unindexed "
+                                    "WHERE ttype=? AND owner=?", ikey)
+
+            updated = time.time()
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO contact_tables VALUES (?, ?, ?)",
+                (tname, updated, self.generation)
+            )
         except:
             self.conn.rollback()
             traceback.print_exc()
             return None
         else:
             self.conn.commit()
-            return rName(tinfo)
+            if remapped:
+                self.loadTables()
+                self.cache.Clear()
+            self.present[tname] = updated
+            self.carried.discard(tname)
+            self.unindexed.discard(ikey)
+            for row in added + removed:
+                self.cache.Invalidate(tinfo, str(row[iuin]))
+            for row, oldRow in changed:
+                self.cache.Invalidate(tinfo, oldRow[iuin])
+            make = tmaker.FromRow
+            return ([make(row) for row in added],
+                    [make(row) for row in removed],
+                    [(make(row), make(oldRow)) for row, oldRow in changed])
     
+    # 在事务中调用， old/new: {uin: row} ，为上次登录时获取的群/讨论组列表及新获取的
+    # 列表。返回被移动或删除的成员列表个数
+    def remap(self, tmaker, old, new):
+        keys = [tmaker.fields.index(f) for f in ('nick', 'mark', 'name')
+                if f in tmaker.fields]
+        iuin = tmaker.fields.index('uin')
+
+        # 名称 -> uin ，只使用名称唯一的群/讨论组
+        def byKey(rows):
+            d = {}
+            for row in rows:
+                k = tuple(str(row[i]) for i in keys)
+                d.setdefault(k, []).append(str(row[iuin]))
+            return dict((k, uins[0]) for k, uins in d.items()
+                        if len(uins) == 1)
+
+        newByKey = byKey(new.values())
+        mapping = dict((uin, newByKey[k]) for k, uin in
+                       byKey(old.values()).items() if k in newByKey)
+
+        prefix = tmaker.ctype + '_member_'
+        owners = [tname[len(prefix):] for tname in self.present
+                  if tname.startswith(prefix)]
+        pairs = [(o, mapping.get(o)) for o in owners if mapping.get(o) != o]
+        if not pairs:
+            return 0
+
+        # 旧 uin -> 新 uin （无法对应时为 NULL ），每张表只用一条语句更新
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS remap_owner "
+                            "(old VARCHAR(12) PRIMARY KEY, new VARCHAR(12))")
+        self.cursor.execute("DELETE FROM temp.remap_owner")
+        self.cursor.executemany("INSERT INTO temp.remap_owner VALUES (?, ?)",
+                                pairs)
+        moved = "SELECT old FROM temp.remap_owner WHERE new IS NOT NULL"
+        dropped = "SELECT old FROM temp.remap_owner WHERE new IS NULL"
+        newOf = "(SELECT '%s' || new FROM temp.remap_owner WHERE old=%s)"
+
+        # 被移动的成员列表的搜索索引在重新获取该列表时重建（见 sync ）
+        mtmaker = contactMaker[tmaker.ctype + '-member']
+        for table in ('contact_search', 'contact_grams'):
+            self.cursor.execute(
+                "DELETE FROM %s WHERE ttype=? AND owner IN "
+                "(SELECT old FROM temp.remap_owner)" % table, (mtmaker.ctype,)
+            )
+
+        # 成员表及 contact_tables 有唯一约束，先加上 '~' 前缀，以免与尚未移动的
+        # uin 冲突
+        self.cursor.execute("DELETE FROM '%s' WHERE owner IN (%s)" %
+                            (mtmaker.table, dropped))
+        self.cursor.execute("UPDATE '%s' SET owner=%s WHERE owner IN (%s)" %
+                            (mtmaker.table, newOf % ('~', 'owner'), moved))
+        self.cursor.execute("UPDATE '%s' SET owner=substr(owner, 2) "
+                            "WHERE owner LIKE '~%%'" % mtmaker.table)
+        owner = "substr(tname, %d)" % (len(prefix) + 1)
+        self.cursor.execute(
+            "DELETE FROM contact_tables WHERE tname LIKE ? AND %s IN (%s)" %
+            (owner, dropped), (prefix + '%',)
+        )
+        self.cursor.execute(
+            "UPDATE contact_tables SET tname=%s WHERE tname LIKE ? AND "
+            "%s IN (%s)" % (newOf % ('~' + prefix, owner), owner, moved),
+            (prefix + '%',)
+        )
+        self.cursor.execute("UPDATE contact_tables SET tname=substr(tname, 2) "
+                            "WHERE tname LIKE '~%'")
+        INFO('%s的 uin 已改变，已移动 %d 个、删除 %d 个成员列表',
+             CTYPES[tmaker.ctype], sum(1 for o, n in pairs if n is not None),
+             sum(1 for o, n in pairs if n is None))
+        return len(pairs)
+
+    # 是否为上次登录时获取、本次登录中尚未重新获取的列表
+    def IsCarried(self, tname):
+        return tname in self.carried
+
     def List(self, tinfo, cinfo=None):
+        q = self.query(tinfo, cinfo)
+        if q is None or isinstance(q, list):
+            return q
+        make = tMaker(tinfo).FromRow
+        return [make(item) for item in self.read(*q)]
+
+    # 与 List 相同，但逐个生成联系人对象（每次从数据库中读取 batch 行），不建立整个
+    # 列表。列表不存在时返回 None 。在遍历完之前不要修改这个列表
+    def Iter(self, tinfo, cinfo=None, batch=500):
+        q = self.query(tinfo, cinfo)
+        if q is None or isinstance(q, list):
+            return q
+        return self.iterRows(tMaker(tinfo).FromRow, q, batch)
+
+    # 分页读取（见 DBDisplayer.PageOfList ）：按 uin 排序，从 uin 大于 after 的联系人
+    # 开始，最多 limit 个（ None 表示不限），只读取 fields 中的字段（ None 表示全部）。
+    # 与 Iter 一样逐批从数据库中读取，生成 (uin, 字段值的 tuple) 。列表不存在时返回 None
+    def Rows(self, tinfo, cinfo=None, after=None, limit=None, fields=None,
+             batch=500):
+        tmaker = tMaker(tinfo)
+        fields = fields or tmaker.fields
+        assert all(f in tmaker.fields for f in fields)
+        q = self.condOf(tinfo, cinfo)
+        if q is None:
+            return None
+
+        # 模糊搜索等，结果已在内存中
+        if isinstance(q, list):
+            rows = sorted((c.uin, tuple(getattr(c, f) for f in fields))
+                          for c in q if after is None or c.uin > after)
+            return iter(rows[:limit] if limit is not None else rows)
+
+        cond, args = q
+        if after is not None:
+            cond, args = ' AND '.join(c for c in (cond, 'uin>?') if c), \
+                         args + [after]
+        where, wargs = self.where(tinfo, cond)
+        sql = "SELECT uin,%s FROM '%s'%s ORDER BY uin" % \
+              (','.join(fields), tmaker.table, where)
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        return self.iterRows(lambda row: (row[0], row[1:]),
+                             (sql, wargs + args), batch)
+
+    def iterRows(self, make, q, batch):
+        with self.reading() as cursor:
+            cursor = cursor.connection.cursor()
+            cursor.execute(*q)
+            items = cursor.fetchmany(batch)
+        try:
+            while items:
+                for item in items:
+                    yield make(item)
+                with self.reading():
+                    items = cursor.fetchmany(batch)
+        finally:
+            cursor.close()
+
+    # 返回查询语句 (sql, args) ；列表不存在时返回 None ；模糊搜索等直接得到结果时
+    # 返回联系人列表
+    def query(self, tinfo, cinfo):
+        q = self.condOf(tinfo, cinfo)
+        if q is None or isinstance(q, list):
+            return q
+        cond, args = q
+        owner = tOwner(tinfo)
+        return (self.sqlOf(tMaker(tinfo), 'SELECT', cond),
+                (owner and [owner] or []) + args)
+
+    # 与 query 相同，但返回 cinfo 对应的条件 (cond, args) ，不含 owner 条件
+    def condOf(self, tinfo, cinfo):
         tname, tmaker = tName(tinfo), tMaker(tinfo)
 
         if not self.exist(tname):
             return None
             
         if cinfo is None:
-            items = self.selectAll(tname)
+            return '', []
         elif cinfo == '':
-            items = []
+            return []
+        elif cinfo.startswith(':fuzzy:'):
+            return self.fuzzy(tinfo, cinfo[7:])
         else:
             like = False
             if cinfo.isdigit():
@@ -173,64 +773,90 @@ class ContactDB(object):
             if column not in tmaker.fields:
                 return []
 
-            items = self.select(tname, column, cinfo, like)
-        
-        return [tmaker(*item) for item in items]
+            return likeCond(column, cinfo, like)
     
+    # 模糊搜索，按匹配程度从高到低返回联系人
+    def fuzzy(self, tinfo, query):
+        self.ensureIndexed(tinfo)
+        tmaker = tMaker(tinfo)
+        with self.reading() as cursor:
+            uins = Search(cursor, tmaker.ctype, tOwner(tinfo) or '', query)
+        if not uins:
+            return []
+        where, args = self.where(tinfo,
+                                 'uin IN (%s)' % ','.join(['?']*len(uins)))
+        sql = "SELECT %s FROM '%s'%s" % (tmaker.fieldStr, tmaker.table, where)
+        iuin = tmaker.fields.index('uin')
+        items = dict((item[iuin], item) for item in self.read(sql, args + uins))
+        return [tmaker.FromRow(items[uin]) for uin in uins if uin in items]
+
     def exist(self, tname):
-        self.cursor.execute(
-            ("SELECT tbl_name FROM sqlite_master "
-             "WHERE type='table' AND tbl_name='%s'") % tname
-        )
-        return bool(self.cursor.fetchall())
+        return tname in self.present
 
-    def select(self, tname, column, value, like=False):
-        if not like:
-            sql = "SELECT * FROM '%s' WHERE %s=?" % (tname, column)
+    # 列表的更新时间（ time.time() ），未获取过的列表返回 None
+    def Updated(self, tname):
+        return self.present.get(tname)
+
+    def where(self, tinfo, cond=''):
+        owner = tOwner(tinfo)
+        if owner is None:
+            return (cond and (' WHERE ' + cond)), []
         else:
-            value = '%' + value + '%'
-            sql = "SELECT * FROM '%s' WHERE %s like ?" % (tname, column)
-        self.cursor.execute(sql, (value,))
-        return self.cursor.fetchall()
-
-    def selectAll(self, tname):
-        self.cursor.execute("SELECT * FROM '%s'" % tname)
-        return self.cursor.fetchall()
+            return ' WHERE owner=?' + (cond and (' AND ' + cond)), [owner]
+
+    def select(self, tinfo, column, value, like=False):
+        return self.read(*self.selectQuery(tinfo, column, value, like))
+
+    def selectQuery(self, tinfo, column, value, like=False):
+        owner = tOwner(tinfo)
+        cond, args = likeCond(column, value, like)
+        return (self.sqlOf(tMaker(tinfo), 'SELECT', cond),
+                (owner and [owner] or []) + args)
+
+    def selectAll(self, tinfo):
+        owner = tOwner(tinfo)
+        return self.read(self.sqlOf(tMaker(tinfo), 'SELECT'),
+                         owner and [owner] or [])
     
+    # Modify/Delete 的修改在 commitDelay 秒内提交（见 defer ），之后的读取都会先提交
+    # 这些修改。 Delete 返回 True 表示已放入队列
     def Delete(self, tinfo, c):
-        tname = tName(tinfo)
-        try:
-            self.cursor.execute("DELETE FROM '%s' WHERE uin=?" % tname, [c.uin])
-        except:
-            self.conn.rollback()
-            traceback.print_exc()
-            return False
-        else:
-            self.conn.commit()
-            return True
+        tmaker, owner = tMaker(tinfo), tOwner(tinfo)
+        sql = self.sqlOf(tmaker, 'DELETE', 'uin=?')
+        args = (owner and [owner] or []) + [c.uin]
+
+        def op():
+            self.cursor.execute(sql, args)
+            self.unindex(tmaker, owner or '', c.uin)
+
+        self.defer(op)
+        self.cache.Invalidate(tinfo, c.uin)
+        return True
     
+    # 联系人对象是只读的， c 本身不会改变，返回修改后的联系人对象
     def Modify(self, tinfo, c, **kw):
-        tname, tmaker = tName(tinfo), tMaker(tinfo)
-        colstr, values = [], []
-
-        for column, value in kw.items():
+        tmaker, owner = tMaker(tinfo), tOwner(tinfo)
+        columns = sorted(kw.keys())
+        for column in columns:
             assert column in tmaker.fields
-            colstr.append("%s=?" % column)
-            values.append(value)
-            c.__dict__[column] = value
 
-        values.append(c.uin)
+        sql = self.sqlOf(tmaker, 'SET ' + ','.join('%s=?' % column
+                                                   for column in columns),
+                         'uin=?')
+        args = [kw[column] for column in columns] + \
+               (owner and [owner] or []) + [c.uin]
+        reindex = any(column in SEARCH_FIELDS for column in kw)
+        row = [kw.get(f, getattr(c, f)) for f in tmaker.fields]
 
-        sql = "UPDATE '%s' SET %s WHERE uin=?" % (tname, ','.join(colstr))
-        try:
-            self.cursor.execute(sql, values)
-        except:
-            self.conn.rollback()
-            traceback.print_exc()
-            return False
-        else:
-            self.conn.commit()
-            return True
+        def op():
+            self.cursor.execute(sql, args)
+            if reindex:
+                self.unindex(tmaker, owner or '', c.uin)
+                self.index(tmaker, owner or '', [row])
+
+        self.defer(op)
+        self.cache.Invalidate(tinfo, c.uin)
+        return tmaker.FromRow(row)
 
     @classmethod
     def NullContact(cls, tinfo, uin):
@@ -262,8 +888,8 @@ if __name__ == '__main__':
     print(db.List('buddy', 'name名称1'))
 
     db.Update('group', [
-        ['123456', 'uin849384', '昵称1', '备注1', '名称1', 'gcode1'],
-        ['456789', 'uin823484', '昵称2', '备注2', '名称2', 'gcode2']
+        ['123456', '849384', '昵称1', '备注1', '名称1', 'gcode1'],
+        ['456789', '823484', '昵称2', '备注2', '名称2', 'gcode2']
     ])
     
     print(db.List('group', '12345'))
@@ -281,3 +907,156 @@ if __name__ == '__main__':
     print(db.List(g, '名称2'))
     print(db.List(g, ':like:名称'))
     print(db.List(g, ':like:1'))
+    print(db.List(g, ':fuzzy:名片'))
+    print(db.List(g, ':fuzzy:mc'))
+
+    # 列出一个 2000 人的群：旧的 QContact （每个对象带一个 __dict__ ）与 __slots__
+    # 的耗时和内存，以及用 Iter 遍历时的内存峰值
+    import tracemalloc
+
+    class legacyMember(object):
+        fields = GroupMember.fields
+        def __init__(self, *fields):
+            for k, field in zip(self.fields, fields):
+                self.__dict__[k] = field
+            self.__dict__['ctype'] = 'group-member'
+
+    big = db.List('group', '456789')[0]
+    db.Update(big, [
+        [str(100000+i), str(200000+i), 'nick%d' % i, '', 'card%d' % i,
+         'name%d' % i, 0, 0, '成员', 2, 0, 1, '', 0] for i in range(2000)
+    ])
+    for name, make in [('dict ', lambda r: legacyMember(*r)),
+                       ('slots', GroupMember.FromRow)]:
+        t = time.time()
+        for k in range(50):
+            cl = [make(r) for r in db.selectAll(big)]
+        t = (time.time() - t) / 50
+        rows = db.selectAll(big)
+        tracemalloc.start()
+        cl = [make(r) for r in rows]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('%s List 2000 members: %.2f ms, %d KB (%d bytes/contact)' %
+              (name, t * 1000, size // 1024, size // len(cl)))
+    del cl, rows
+    for name, func in [('List', db.List), ('Iter', db.Iter)]:
+        tracemalloc.start()
+        n = sum(1 for c in func(big) if c.name)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%s over %d members: peak %d KB' % (name, n, peak // 1024))
+
+    # 数据库文件中连续修改 500 个成员的耗时：每次修改后提交（旧的默认日志模式）与
+    # WAL + 批量提交；以及 4 个线程同时查询与单线程查询的吞吐量
+    import os, random, tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    for name, batch, pragmas in [
+        ('commit each ', 1, ["PRAGMA journal_mode=DELETE",
+                             "PRAGMA synchronous=FULL"]),
+        ('WAL + batch ', ContactDB.commitBatch, [])
+    ]:
+        db = ContactDB(os.path.join(tmpdir, name.strip() + '.db'))
+        db.commitBatch = batch
+        for sql in pragmas:
+            db.conn.execute(sql)
+        db.Update('group', [['123', '456', '', '', 'g', '']])
+        g = db.List('group')[0]
+        db.Update(g, [
+            [str(100000+i), str(200000+i), 'nick%d' % i, '', 'card%d' % i,
+             'name%d' % i, 0, 0, '成员', 2, 0, 1, '', 0] for i in range(2000)
+        ])
+        membs = db.List(g)[:500]
+        t = time.time()
+        for m in membs:
+            db.Modify(g, m, role='管理员', role_id=1)
+        db.Flush()
+        print('%s Modify x500: %.1f ms' % (name, (time.time() - t) * 1000))
+
+    def lookups(n):
+        for i in range(n):
+            assert db.List(g, 'uin=%d' % (200000 + i % 2000))
+
+    for nThread in (1, 4):
+        threads = [threading.Thread(target=lookups, args=(8000//nThread,))
+                   for i in range(nThread)]
+        t = time.time()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        print('%d thread(s): %.0f lookups/s' %
+              (nThread, 8000 / (time.time() - t)))
+    shutil.rmtree(tmpdir)
+
+    # 比较旧的分表结构和新的合并表结构在 10000 个群时的 List 耗时
+    tmpdir = tempfile.mkdtemp()
+    dbname = os.path.join(tmpdir, 'bench.db')
+    nGroup, nMemb = 10000, 20
+
+    def memb(owner, i):
+        return [str(owner*100+i), str(owner*1000+i), 'nick%d' % i, '',
+                'card%d' % i, 'name%d' % i, 0, 0, '成员', 2, 0, 1, '', 0]
+
+    conn = sqlite3.connect(dbname)
+    conn.text_factory = str
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE 'group' (%s)" % Group.columns)
+    cur.executemany("INSERT INTO 'group' VALUES(?,?,?,?,?,?)", [
+        [str(i), str(i), '', '', 'g%d' % i, ''] for i in range(nGroup)
+    ])
+    for i in range(nGroup):
+        tname = 'group_member_%d' % i
+        cur.execute("CREATE TABLE '%s' (%s)" % (tname, GroupMember.columns))
+        cur.executemany("INSERT INTO '%s' VALUES(%s)" %
+                        (tname, ','.join(['?']*14)),
+                        [memb(i, j) for j in range(nMemb)])
+    conn.commit()
+
+    # 旧版本的 List ：查询 sqlite_master ，再在成员表中全表扫描
+    def legacyList(uin, column, value):
+        tname = 'group_member_' + uin
+        cur.execute("SELECT tbl_name FROM sqlite_master "
+                    "WHERE type='table' AND tbl_name='%s'" % tname)
+        if not cur.fetchall():
+            return None
+        cur.execute("SELECT * FROM '%s' WHERE %s=?" % (tname, column),
+                    (value,))
+        return [GroupMember(*r) for r in cur.fetchall()]
+
+    queries = []
+    for k in range(2000):
+        i, j = random.randrange(nGroup), random.randrange(nMemb)
+        queries.append((i, random.choice([
+            ('uin', str(i*1000+j)), ('qq', str(i*100+j)), ('name', 'name%d' % j)
+        ])))
+
+    t = time.time()
+    for i, (column, value) in queries:
+        assert len(legacyList(str(i), column, value)) == 1
+    tLegacy = (time.time() - t) / len(queries)
+    conn.close()
+
+    t = time.time()
+    db = ContactDB(dbname)
+    tMigrate = time.time() - t
+    groups = dict((g.uin, g) for g in db.List('group'))
+
+    t = time.time()
+    for i, (column, value) in queries:
+        assert len(db.List(groups[str(i)], '%s=%s' % (column, value))) == 1
+    tNew = (time.time() - t) / len(queries)
+
+    # 第一次模糊搜索时为该群建立索引
+    tFuzzy = []
+    for k in range(2):
+        t = time.time()
+        for i, (column, value) in queries:
+            assert db.List(groups[str(i)], ':fuzzy:card1')
+        tFuzzy.append((time.time() - t) / len(queries))
+
+    print('%d groups x %d members: legacy List %.1f us, indexed List %.1f us, '
+          'fuzzy List %.1f us (first %.1f us), migration %.2f s' % (
+              nGroup, nMemb, tLegacy*1e6, tNew*1e6, tFuzzy[1]*1e6,
+              tFuzzy[0]*1e6, tMigrate))
+    shutil.rmtree(tmpdir)
@@ -5,7 +5,7 @@ p = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
 if p not in sys.path:
     sys.path.insert(0, p)
 
-from qqbot.qcontactdb.contactdb import rName
+from qqbot.qcontactdb.contactdb import rName, tOwner, contactMaker
 from qqbot.qcontactdb.myprettytable import PrettyTable
 from qqbot.utf8logger import DEBUG
 
@@ -88,8 +88,84 @@ class DBDisplayer(object):
             assert False
     
     def objOfList(self, tinfo, cinfo=None):
-        cl = self.List(tinfo, cinfo)        
+        cl = self.Iter(tinfo, cinfo)
         if cl is None:
             return None, '错误：无法向 QQ 服务器获取联系人资料'
         else:
             return [c.__dict__ for c in cl], None
+
+    # 分页列出联系人（ HTTP-API 的 list 命令带 cursor/limit/fields 参数时使用），
+    # 返回 (listPage, err) 。成员列表按 (群/讨论组的 uin, 成员的 uin) 排序。
+    # 所需的列表在这里全部准备好（ QContactDB 获取、 dbView 检查），遍历 listPage 时
+    # 只从数据库中读取，可在任意线程中进行
+    def PageOfList(self, ctype, info1=None, info2=None, cursor=None,
+                   limit=None, fields=None):
+        tmaker = contactMaker[ctype]
+        for field in fields or []:
+            if field not in tmaker.fields:
+                return None, '错误：%s没有 %s 字段' % (CTYPES[ctype], field)
+
+        if ctype in ('buddy', 'group', 'discuss'):
+            tinfos, cinfo = [ctype], info1
+        else:
+            assert info1
+            cl = self.List(ctype[:-7], info1)
+            if cl is None:
+                return None, '错误：无法向 QQ 服务器获取联系人资料'
+            elif not cl:
+                return None, '错误：%s（%s）不存在' % (CTYPES[ctype[:-7]], info1)
+            tinfos, cinfo = sorted(cl, key=lambda c: c.uin), info2
+
+        # cursor 为上一页最后一个联系人的 uin ，成员列表为 "owner.uin"
+        owner, x, after = (cursor or '').rpartition('.')
+        parts = []
+        for tinfo in tinfos:
+            if cursor and tOwner(tinfo) is not None:
+                if tinfo.uin < owner:
+                    continue
+                start = (tinfo.uin == owner) and after or None
+            else:
+                start = after or None
+            # 多取一个，以判断是否还有下一页
+            rows = self.Rows(tinfo, cinfo, start,
+                             limit is not None and limit + 1 or None, fields)
+            if rows is None:
+                return None, '错误：无法向 QQ 服务器获取联系人资料'
+            parts.append((tOwner(tinfo), rows))
+
+        return listPage(parts, limit, fields or tmaker.fields), None
+
+# 逐个生成联系人的 dict （只含所选的字段，成员另有 owner ），遍历完后 self.next 为
+# 下一页的 cursor （没有下一页时为 None ）， self.count 为本页的联系人数
+class listPage(object):
+    def __init__(self, parts, limit, fields):
+        self.parts = parts
+        self.limit = limit
+        self.fields = fields
+        self.next = None
+        self.count = 0
+
+    def __iter__(self):
+        fields, last = self.fields, None
+        try:
+            for owner, rows in self.parts:
+                for uin, row in rows:
+                    if self.count == self.limit:
+                        self.next = last
+                        return
+                    d = dict(zip(fields, row))
+                    if owner is not None:
+                        d['owner'] = owner
+                        last = owner + '.' + uin
+                    else:
+                        last = uin
+                    self.count += 1
+                    yield d
+        finally:
+            self.Close()
+
+    # 关闭尚未读完的数据库游标（否则其所在的只读连接一直停留在旧的快照上）
+    def Close(self):
+        for owner, rows in self.parts:
+            if hasattr(rows, 'close'):
+                rows.close()
@@ -14,7 +14,7 @@ from qqbot.common import JsonDumps, HTMLUnescape, PY3, STR2BYTES, BYTES2STR
 
 import collections, os
 
-def fetchBuddyTable(self):
+def fetchBuddyTable(self, policy=None):
 
     result = self.smartRequest(
         url = 'http://s.web2.qq.com/api/get_user_friends2',
@@ -24,7 +24,8 @@ def fetchBuddyTable(self):
         Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001&'
                    'callback=1&id=2'),
         expectedKey = 'marknames',
-        repeatOnDeny = 4
+        repeatOnDeny = 4,
+        policy = policy
     )
 
     markDict = dict((str(d['uin']), str(d['markname']))
@@ -104,7 +105,7 @@ def getManaulGroupQQDict():
 
     return mgQQDict
 
-def fetchGroupTable(self):
+def fetchGroupTable(self, policy=None):
 
 #    qqResult = self.smartRequest(
 #        url = 'http://qun.qq.com/cgi-bin/qun_mgr/get_group_list',
@@ -120,7 +121,8 @@ def fetchGroupTable(self):
         Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001&'
                    'callback=1&id=2'),
         expectedKey = 'gmarklist',
-        repeatOnDeny = 6
+        repeatOnDeny = 6,
+        policy = policy
     )
     
     markDict = dict((str(d['uin']), str(d['markname'])) \
@@ -170,7 +172,7 @@ def fetchGroupTable(self):
     return groups
 
 # by @waylonwang, pandolia
-def fetchGroupMemberTable(self, group):
+def fetchGroupMemberTable(self, group, policy=None):
     
     result = self.smartRequest(
         url = ('http://s.web2.qq.com/api/get_group_info_ext2?gcode=%s'
@@ -178,7 +180,8 @@ def fetchGroupMemberTable(self, group):
         Referer = ('http://s.web2.qq.com/proxy.html?v=20130916001'
                    '&callback=1&id=1'),
         expectedKey = 'minfo',
-        repeatOnDeny = 5
+        repeatOnDeny = 5,
+        policy = policy
     )
 
     cardDict = collections.defaultdict(list)
@@ -187,7 +190,8 @@ def fetchGroupMemberTable(self, group):
         r = self.smartRequest(
             url='http://qinfo.clt.qq.com/cgi-bin/qun_info/get_group_members_new',
             Referer='http://qinfo.clt.qq.com/member.html',
-            data={'gc': group.qq, 'u': self.uin , 'bkn': self.bkn}
+            data={'gc': group.qq, 'u': self.uin , 'bkn': self.bkn},
+            policy=policy
         )        
         
         for m in r['mems']:
@@ -260,7 +264,7 @@ def fetchGroupMemberTable(self, group):
     
     return membss
 
-def fetchDiscussTable(self):
+def fetchDiscussTable(self, policy=None):
     result = self.smartRequest(
         url = ('http://s.web2.qq.com/api/get_discus_list?clientid=%s&'
                'psessionid=%s&vfwebqq=%s&t={rand}') % 
@@ -268,20 +272,22 @@ def fetchDiscussTable(self):
         Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001'
                    '&callback=1&id=2'),
         expectedKey = 'dnamelist',
-        repeatOnDeny = 5
+        repeatOnDeny = 5,
+        policy = policy
     )['dnamelist']        
     discusses = []
     for info in result:
         discusses.append([str(info['did']), str(info['name'])])
     return discusses
 
-def fetchDiscussMemberTable(self, discuss):
+def fetchDiscussMemberTable(self, discuss, policy=None):
     result = self.smartRequest(
         url = ('http://d1.web2.qq.com/channel/get_discu_info?'
                'did=%s&psessionid=%s&vfwebqq=%s&clientid=%s&t={rand}') %
               (discuss.uin, self.psessionid, self.vfwebqq, self.clientid),
         Referer = ('http://d1.web2.qq.com/proxy.html?v=20151105001'
-                   '&callback=1&id=2')
+                   '&callback=1&id=2'),
+        policy = policy
     )
     qqDict = dict((m['mem_uin'], m['ruin']) for m in result['info']['mem_list'])
     membs = []
@@ -289,20 +295,20 @@ def fetchDiscussMemberTable(self, discuss):
         membs.append([str(qqDict[m['uin']]), str(m['uin']), str(m['nick'])])
     return membs
 
-def Fetch(self, tinfo):
+def Fetch(self, tinfo, policy=None):
     rname, ttype = rName(tinfo), tType(tinfo)
     INFO('正在获取 %s ...', rname)
     try:
         if ttype == 'buddy':
-            table = fetchBuddyTable(self)
+            table = fetchBuddyTable(self, policy)
         elif ttype == 'group':
-            table = fetchGroupTable(self)
+            table = fetchGroupTable(self, policy)
         elif ttype == 'discuss':
-            table = fetchDiscussTable(self)
+            table = fetchDiscussTable(self, policy)
         elif ttype == 'group-member':
-            table = fetchGroupMemberTable(self, tinfo)
+            table = fetchGroupMemberTable(self, tinfo, policy)
         else:
-            table = fetchDiscussMemberTable(self, tinfo)
+            table = fetchDiscussMemberTable(self, tinfo, policy)
     except RequestError:
         table = None
     except:
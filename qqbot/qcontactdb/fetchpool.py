@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# 并行获取群/讨论组成员列表（ FirstFetch 的第二阶段）
+#
+#   1) nWorkers 个线程各使用一个会话副本并行地调用 Fetch
+#   2) 所有线程共用一个令牌桶限制请求速率：每次成功后速率增加 rateStep ，失败后减半
+#      （在 minRate ~ maxRate 之间）
+#   3) 每次取出最近有消息的群/讨论组先获取（见 QContactDB.activity ），已经获取过的
+#      列表（如收到消息时已按需获取）直接跳过
+#   4) 获取到的列表交给主线程写入数据库（ wait=False 时通过 MainLoop ，此时机器人
+#      可以在获取过程中正常处理消息）
+#
+# 运行指标： firstfetch_total 、 firstfetch_done 、 firstfetch_failed 、
+#            firstfetch_rate
+
+import sys, os.path as op
+p = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, threading
+
+from qqbot.qcontactdb.contactdb import tName
+from qqbot.sendqueue import TokenBucket
+from qqbot.mainloop import PutTask, BACKGROUND
+from qqbot.utf8logger import INFO, ERROR
+from qqbot.common import StartDaemonThread, Queue
+from qqbot.metrics import SetGauge
+
+class FetchPool(object):
+
+    nWorkers = 4
+    initRate, minRate, maxRate, rateStep = 2.0, 0.5, 8.0, 0.2
+
+    def __init__(self, contactdb):
+        self.contactdb = contactdb
+        self.cond = threading.Condition()
+        self.pending = []
+        self.total = self.done = self.failed = 0
+        self.bucket = TokenBucket(self.initRate, 2)
+        self.results = None
+        self.stopped = False
+
+    # owners: 群/讨论组列表。 wait=True 时在本线程中写入数据库，全部完成后返回
+    def Start(self, owners, wait=False):
+        with self.cond:
+            self.pending.extend(owners)
+            self.total += len(owners)
+        SetGauge('firstfetch_total', self.total)
+        INFO('开始并行获取 %d 个群/讨论组的成员列表', len(owners))
+
+        if wait:
+            self.results = Queue.Queue()
+
+        for i in range(min(self.nWorkers, len(owners))):
+            StartDaemonThread(self.work, self.contactdb.session.Copy())
+
+        if wait:
+            while self.done + self.failed < self.total:
+                self.apply(*self.results.get())
+
+    def Stop(self):
+        self.stopped = True
+
+    def Progress(self):
+        return self.done, self.failed, self.total
+
+    # 在 self.cond 内调用，取出最近有消息的一个群/讨论组
+    def pick(self):
+        activity = self.contactdb.activity
+        best, bestT = None, -1
+        for i, owner in enumerate(self.pending):
+            t = activity.get((owner.ctype, owner.uin), 0)
+            if t > bestT:
+                best, bestT = i, t
+        return self.pending.pop(best)
+
+    def work(self, session):
+        while not self.stopped:
+            with self.cond:
+                if not self.pending:
+                    return
+                owner = self.pick()
+
+            if self.contactdb.db.exist(tName(owner)):
+                self.deliver(owner, False)
+                continue
+
+            wait = self.bucket.Take()
+            while wait > 0:
+                time.sleep(wait)
+                wait = self.bucket.Take()
+
+            try:
+                contacts = self.contactdb.Fetch(owner, session)
+            except Exception:
+                ERROR('获取 %s 的成员列表时出错', owner, exc_info=True)
+                contacts = None
+
+            with self.cond:
+                if contacts is None:
+                    self.bucket.rate = max(self.minRate, self.bucket.rate / 2)
+                else:
+                    self.bucket.rate = min(self.maxRate,
+                                           self.bucket.rate + self.rateStep)
+            SetGauge('firstfetch_rate', self.bucket.rate)
+            self.deliver(owner, contacts)
+
+    # contacts 为 False 表示已获取过，为 None 表示获取失败
+    def deliver(self, owner, contacts):
+        if self.results is not None:
+            self.results.put((owner, contacts))
+        else:
+            PutTask(self.apply, (owner, contacts), priority=BACKGROUND,
+                    source='firstfetch')
+
+    # 主线程
+    def apply(self, owner, contacts):
+        if contacts is None:
+            self.failed += 1
+        else:
+            if contacts is not False and \
+                    not self.contactdb.db.exist(tName(owner)):
+                self.contactdb.Store(owner, contacts)
+            self.done += 1
+
+        n = self.done + self.failed
+        SetGauge('firstfetch_done', self.done)
+        SetGauge('firstfetch_failed', self.failed)
+        if n == self.total or n % 20 == 0:
+            INFO('成员列表获取进度：%d/%d（失败 %d 个）',
+                 n, self.total, self.failed)
+
+if __name__ == '__main__':
+    # 比较旧的 FirstFetch （逐个获取，每次间隔 1 秒）和并行获取 30 个群的成员列表
+    # 的耗时（使用本地的 MockSmartQQ ）
+    import tempfile
+    from qqbot.qconf import QConf
+    from qqbot.qqbotcls import QQBot
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.qcontactdb.qcontactdb import QContactDB
+    from qqbot.utf8logger import DisableLog, EnableLog
+
+    server = MockSmartQQ(nGroups=30, nMembers=50, latency=0.05)
+    server.Start()
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    session.Login(QConf(['-b', tempfile.mkdtemp(), '-q', server.qq]))
+
+    bot = QQBot()
+    bot.onUpdate = bot.onContactAdded = bot.onContactRemoved = \
+        bot.onContactChanged = lambda *args: None
+
+    contactdb = QContactDB(session, bot)
+    groups = contactdb.List('group')
+    DisableLog()
+    t = time.time()
+    for g in groups:
+        contactdb.Update(g)
+        time.sleep(1.0)
+    print('sequential: %.2f s' % (time.time() - t))
+
+    contactdb = QContactDB(session, bot)
+    contactdb.db = contactdb.db.__class__()
+    contactdb.List('group')
+    t = time.time()
+    contactdb.fetchPool = FetchPool(contactdb)
+    contactdb.fetchPool.Start(contactdb.List('group'), wait=True)
+    print('parallel:   %.2f s, progress %s' %
+          (time.time() - t, contactdb.fetchPool.Progress()))
+    EnableLog()
+    server.Stop()
@@ -5,22 +5,72 @@ p = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
 if p not in sys.path:
     sys.path.insert(0, p)
 
-from qqbot.qcontactdb.contactdb import ContactDB
+from qqbot.qcontactdb.contactdb import ContactDB, tName, rName
 from qqbot.qcontactdb.display import DBDisplayer
 from qqbot.qcontactdb.fetch import Fetch
+from qqbot.qcontactdb.contactcache import MISSING
+from qqbot.qcontactdb.fetchpool import FetchPool
+from qqbot.qcontactdb.singleflight import SingleFlight
+from qqbot.qcontactdb.refresher import Refresher
 from qqbot.utf8logger import INFO
 from qqbot.common import SYSTEMSTR2STR
 
-import collections, time, re
+import time, re, threading
+
+# 列表不在数据库中，或为上次登录时获取、尚未重新获取的列表（见 ContactDB.carried ）
+class NotInDB(Exception):
+    pass
+
+# 只读取数据库中已有的列表，可在任意线程中使用（每个线程使用各自的只读连接，
+# 见 ContactDB.reading ），不会获取列表或触发任何事件
+class dbView(DBDisplayer):
+    def __init__(self, db):
+        self.db = db
+
+    def List(self, tinfo, cinfo=None):
+        return self.check(tinfo, self.db.List(tinfo, cinfo))
+
+    def Iter(self, tinfo, cinfo=None):
+        return self.check(tinfo, self.db.Iter(tinfo, cinfo))
+
+    def Rows(self, tinfo, cinfo=None, after=None, limit=None, fields=None):
+        return self.check(tinfo,
+                          self.db.Rows(tinfo, cinfo, after, limit, fields))
+
+    def check(self, tinfo, result):
+        if result is None or self.db.IsCarried(tName(tinfo)):
+            raise NotInDB(rName(tinfo))
+        return result
 
 class QContactDB(DBDisplayer):
-    def __init__(self, session):
+
+    # 某个 uin 在重新获取列表后仍不在列表中时，此后 unknownTTL 秒内不再因为这个 uin
+    # 重新获取列表
+    unknownTTL = 300
+
+    revalidateRetry = 60
+
+    def __init__(self, session, bot=None):
         self.session = session.Copy()
+        self.bot = bot
         dbname = SYSTEMSTR2STR(session.dbname)
-        self.db = ContactDB(dbname)
+        # 每次手动登录得到新的 psessionid ，用作数据库中各列表的 generation
+        self.db = ContactDB(dbname, getattr(session, 'psessionid', '') or '')
+        self.activity = {}
+        self.fetchPool = None
+        self.refresher = None
+        self.updates = SingleFlight('update')
+        self.fetches = SingleFlight('fetch')
+        self.unknown = {}
+        self.unknownLock = threading.Lock()
+        self.revalidated = {}
         INFO('联系人数据库文件：%s', dbname)
 
+    # 列表已过期时仍立即返回数据库中的内容，同时请求后台刷新（见 refresher.py ）。
+    # 上次登录时获取的列表在第一次使用时先重新获取（其中的 uin 可能已经改变，
+    # 见 contactdb.py ），获取失败时仍返回数据库中的内容
     def List(self, tinfo, cinfo=None):
+        self.revalidate(tinfo)
         result = self.db.List(tinfo, cinfo)
         if result is None:
             if not self.Update(tinfo):
@@ -28,30 +78,115 @@ class QContactDB(DBDisplayer):
             else:
                 return self.db.List(tinfo, cinfo)
         else:
+            if self.refresher is not None:
+                self.refresher.Touch(tinfo)
             return result
 
+    # 与 List 相同，但返回逐个生成联系人对象的迭代器（见 ContactDB.Iter ）
+    def Iter(self, tinfo, cinfo=None):
+        self.revalidate(tinfo)
+        result = self.db.Iter(tinfo, cinfo)
+        if result is None:
+            if not self.Update(tinfo):
+                return None
+            else:
+                return self.db.Iter(tinfo, cinfo)
+        else:
+            if self.refresher is not None:
+                self.refresher.Touch(tinfo)
+            return result
+
+    # 与 List 相同，但分页读取（见 ContactDB.Rows ）
+    def Rows(self, tinfo, cinfo=None, after=None, limit=None, fields=None):
+        self.revalidate(tinfo)
+        result = self.db.Rows(tinfo, cinfo, after, limit, fields)
+        if result is None:
+            if not self.Update(tinfo):
+                return None
+            else:
+                return self.db.Rows(tinfo, cinfo, after, limit, fields)
+        else:
+            if self.refresher is not None:
+                self.refresher.Touch(tinfo)
+            return result
+
+    # 重新获取失败后 revalidateRetry 秒内不再重试
+    def revalidate(self, tinfo):
+        tname = tName(tinfo)
+        if self.db.IsCarried(tname) and \
+                time.time() - self.revalidated.get(tname, 0) > \
+                self.revalidateRetry:
+            self.revalidated[tname] = time.time()
+            self.Update(tinfo)
+
+    # 见 dbView ，需要的列表不在数据库中时抛出 NotInDB
+    def View(self):
+        return dbView(self.db)
+
+    # maxAge: {列表类型: 秒数} ，见 refresher.DEFAULT_MAXAGE
+    def StartRefresher(self, scheduler, maxAge=None):
+        self.refresher = Refresher(self, maxAge)
+        self.refresher.Start(scheduler)
+
+    def StopRefresher(self):
+        if self.refresher is not None:
+            self.refresher.Stop()
+            self.refresher = None
+
+    # 只写入有变化的联系人，并对每个新增、删除、修改的联系人分别触发
+    # onContactAdded/onContactRemoved/onContactChanged 事件（第一次获取某个列表
+    # 及重新获取上次登录时获取的列表时不触发这些事件），最后触发 onUpdate 事件。
+    # 对同一列表同时或连续（ self.updates.window 秒内）的多次调用只获取一次
     def Update(self, tinfo):
-        contacts = Fetch(self.session, tinfo)
+        return self.updates.Do(tName(tinfo), self.update, tinfo)
+
+    def update(self, tinfo):
+        contacts = self.Fetch(tinfo)
         if contacts is None:
             return False
+        return self.Store(tinfo, contacts)
+
+    # 同一列表正在获取时（如 FetchPool 的工作线程正在获取某个群的成员列表），
+    # 其他线程等待并共用其结果。 session 为 None 时使用 self.session
+    def Fetch(self, tinfo, session=None):
+        return self.fetches.Do(tName(tinfo), Fetch, session or self.session,
+                               tinfo)
+
+    def Store(self, tinfo, contacts):
+        tname = tName(tinfo)
+        first = not self.db.exist(tname) or self.db.IsCarried(tname)
+        diff = self.db.Sync(tinfo, contacts)
+        if diff is None:
+            return False
+
+        bot = self.bot
+        if bot is None:
+            from qqbot import _bot as bot
+
+        added, removed, changed = diff
+        if first:
+            INFO('已获取并更新 %s', rName(tinfo))
         else:
-            rname = self.db.Update(tinfo, contacts)
-            if rname is None:
-                return False
-            else:
-                from qqbot import _bot; _bot.onUpdate(tinfo)
-                INFO('已获取并更新 %s', rname)
-                return True
+            INFO('已获取并更新 %s（新增 %d 个，删除 %d 个，修改 %d 个）',
+                 rName(tinfo), len(added), len(removed), len(changed))
+            for c in added:
+                bot.onContactAdded(tinfo, c)
+            for c in removed:
+                bot.onContactRemoved(tinfo, c)
+            for c, old in changed:
+                bot.onContactChanged(tinfo, c, old)
+        bot.onUpdate(tinfo)
+        return True
     
-    def FirstFetch(self):
-        q = collections.deque(['buddy', 'group', 'discuss'])
-        while q:
-            tinfo = q.popleft()
+    # 先获取好友、群、讨论组列表，再由 FetchPool 并行获取各群/讨论组的成员列表。
+    # wait=False 时获取成员列表的同时机器人即可开始处理消息
+    def FirstFetch(self, wait=False):
+        owners = []
+        for tinfo in ('buddy', 'group', 'discuss'):
             if self.Update(tinfo) and tinfo in ('group', 'discuss'):
-                cl = self.List(tinfo)
-                if cl:
-                    q.extend(cl)
-            time.sleep(1.0)
+                owners.extend(self.List(tinfo) or [])
+        self.fetchPool = FetchPool(self)
+        self.fetchPool.Start(owners, wait)
         
     sysRegex = re.compile('^(' + ')|('.join([
         r'.+\(\d+\) 被管理员禁言.+',
@@ -61,8 +196,20 @@ class QContactDB(DBDisplayer):
 		r'http://buluo\.qq\.com/mobile/detail\.html.+'
     ]) + ')$')
 
-    def find(self, tinfo, uin, thisQQ, content):
+    # 按 uin 查找联系人，先查 self.db.cache ，返回值与 List(tinfo, 'uin='+uin) 相同
+    def lookup(self, tinfo, uin):
+        c = self.db.cache.Get(tinfo, uin)
+        if c is MISSING:
+            return []
+        elif c is not None:
+            return [c]
         cl = self.List(tinfo, 'uin='+uin)
+        if cl is not None:
+            self.db.cache.Put(tinfo, uin, cl and cl[0] or MISSING)
+        return cl
+
+    def find(self, tinfo, uin, thisQQ, content):
+        cl = self.lookup(tinfo, uin)
         if cl is None:
             return None
         elif not cl:
@@ -72,24 +219,28 @@ class QContactDB(DBDisplayer):
             
             if not isinstance(tinfo, str):
                 if getattr(self, 'selfUin', None) == uin:
-                    cl2 = self.List(tinfo, 'uin='+thisQQ)
+                    cl2 = self.lookup(tinfo, thisQQ)
                     return cl2[0] if cl2 else None
             
             if tinfo == 'buddy':
                 if getattr(self, 'selfBuddyUin', None) == uin:
-                    cl2 = self.List(tinfo, 'uin='+thisQQ)
+                    cl2 = self.lookup(tinfo, thisQQ)
                     return cl2[0] if cl2 else None
             
+            if self.isUnknown(tinfo, uin):
+                return None
+
             if self.Update(tinfo):
-                cl = self.List(tinfo, 'uin='+uin)
+                cl = self.lookup(tinfo, uin)
                 if not cl:
+                    self.setUnknown(tinfo, uin)
                     if not isinstance(tinfo, str):
                         self.selfUin = uin
-                        cl2 = self.List(tinfo, 'uin='+thisQQ)
+                        cl2 = self.lookup(tinfo, thisQQ)
                         return cl2[0] if cl2 else None                    
                     elif tinfo == 'buddy':
                         self.selfBuddyUin = uin
-                        cl2 = self.List(tinfo, 'uin='+thisQQ)
+                        cl2 = self.lookup(tinfo, thisQQ)
                         return cl2[0] if cl2 else None
                     else:
                         return None
@@ -100,7 +251,28 @@ class QContactDB(DBDisplayer):
         else:
             return cl[0]
     
+    def isUnknown(self, tinfo, uin):
+        key = (tName(tinfo), uin)
+        with self.unknownLock:
+            t = self.unknown.get(key)
+            if t is None:
+                return False
+            elif t > time.time():
+                return True
+            del self.unknown[key]
+            return False
+
+    def setUnknown(self, tinfo, uin):
+        now = time.time()
+        with self.unknownLock:
+            if len(self.unknown) >= 10000:
+                for key, t in list(self.unknown.items()):
+                    if t <= now:
+                        del self.unknown[key]
+            self.unknown[(tName(tinfo), uin)] = now + self.unknownTTL
+
     def FindSender(self, ctype, fromUin, membUin, thisQQ, content):
+        self.activity[(ctype, fromUin)] = time.time()
         contact = self.find(ctype, fromUin, thisQQ, content)
         member = None
         nameInGroup = None
@@ -114,8 +286,76 @@ class QContactDB(DBDisplayer):
             if member is None:
                 member = self.db.NullContact(contact, membUin)
             if ctype == 'group':
-                cl = self.List(contact, 'uin='+thisQQ)
+                cl = self.lookup(contact, thisQQ)
                 if cl:
                     nameInGroup = cl[0].name
         
-        return contact, member, nameInGroup
\ No newline at end of file
+        return contact, member, nameInGroup
+if __name__ == '__main__':
+    # 比较有/无联系人缓存时 onPollComplete 的吞吐量（使用本地的 MockSmartQQ 服务器）
+    import os, tempfile, random
+    from qqbot.qconf import QConf
+    from qqbot.qqbotcls import QQBot
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.utf8logger import DisableLog, EnableLog
+
+    server = MockSmartQQ(nGroups=20, nMembers=500, pollHold=0.1)
+    server.Start()
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    conf = QConf(['-b', tempfile.mkdtemp(), '-q', server.qq])
+    session.Login(conf)
+
+    bot = QQBot()
+    bot.conf = conf
+    contactdb = QContactDB(session, bot)
+    bot.onUpdate = bot.onQQMessage = lambda *args: None
+    bot.onContactAdded = bot.onContactRemoved = bot.onContactChanged = \
+        lambda *args: None
+    bot.findSender = contactdb.FindSender
+    for g in contactdb.List('group'):
+        contactdb.List(g)
+
+    msgs = []
+    for i in range(20000):
+        gid, gcode, name = random.choice(server.groups)
+        uin, nick = random.choice(server.members[gcode])
+        msgs.append(('group', gid, uin, 'hello %d' % i))
+
+    DisableLog()
+    for enabled in (False, True):
+        contactdb.db.cache.enabled = enabled
+        t = time.time()
+        for ctype, fromUin, membUin, content in msgs:
+            bot.onPollComplete(ctype, fromUin, membUin, content)
+        t = time.time() - t
+        print('cache=%-5s %6.0f msgs/s' % (enabled, len(msgs) / t))
+    EnableLog()
+    print(contactdb.db.cache.Stats())
+
+    # 重新登录（群/成员的 uin 全部改变）后，沿用数据库文件时回复第一条群消息前的
+    # 耗时，以及在后台重新验证全部成员列表前的请求数；与删除数据库后 FirstFetch 比较
+    contactdb.db.Close()
+    server.Relogin()
+    session.Login(conf)
+    gid, gcode, name = server.groups[7]
+    membUin, nick = server.members[gcode][3]
+    DisableLog()
+    for name in ('warm start', 'FirstFetch'):
+        if name == 'FirstFetch':
+            os.remove(session.dbname)
+        del server.requests[:]
+        t = time.time()
+        contactdb = QContactDB(session, bot)
+        if name == 'FirstFetch':
+            contactdb.FirstFetch(wait=True)
+        contact, member, nameInGroup = contactdb.FindSender(
+            'group', gid, membUin, server.qq, 'hello'
+        )
+        t = time.time() - t
+        contactdb.db.Close()
+        print('%-10s first reply after %.2f s, %3d requests, sender %s/%s' %
+              (name, t, len(server.requests), contact.name, member.name))
+    EnableLog()
+    server.Stop()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# 联系人列表的后台刷新
+#
+# 每个列表（好友/群/讨论组列表、各群/讨论组的成员列表）的获取时间记录在数据库的
+# contact_tables 表中，重启后仍然有效。获取时间超过 maxAge[类型] 秒的列表视为过期
+# （ 0 表示不刷新该类列表）：
+#   1) 每 interval 秒检查一次（由 QQBot 的 APScheduler 触发，在主线程中执行），
+#      按获取时间从早到晚选出过期的列表。每次每类列表最多选出
+#      2 * 列表数 * interval / maxAge 个，同一时间过期的大量列表（如 FirstFetch 获取
+#      的所有成员列表）分散在约 maxAge/2 秒内刷新，而不是同时刷新
+#   2) 一个工作线程使用单独的会话副本逐个获取（每秒最多 rate 次），获取到的列表交给
+#      主线程写入数据库（ QContactDB.Store ，同样会触发 onContactAdded 等事件）
+#   3) QContactDB.List 遇到已过期的列表时，立即返回数据库中的内容，同时请求后台刷新
+#      （ stale-while-revalidate ），处理消息时不会等待获取联系人列表
+#   4) 获取失败的列表在 retryAfter 秒内不再刷新
+#   5) 上次登录时获取的列表（ ContactDB.carried ，其中的 uin 可能已经改变）视为已过期，
+#      且最先刷新
+#
+# 运行指标： contactrefresh_done{ttype} 、 contactrefresh_failed{ttype} 、
+#            contactrefresh_pending
+
+import sys, os.path as op
+p = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, math, threading, collections
+
+from apscheduler.triggers.interval import IntervalTrigger
+
+from qqbot.qcontactdb.contactdb import tName, tType
+from qqbot.sendqueue import TokenBucket
+from qqbot.mainloop import PutTask, BACKGROUND
+from qqbot.utf8logger import ERROR, DEBUG
+from qqbot.common import StartDaemonThread
+from qqbot.metrics import Inc, SetGauge
+
+# 各类列表的默认最长有效时间（秒），可通过配置文件中的 contactMaxAge 修改
+DEFAULT_MAXAGE = {
+    'buddy': 3600, 'group': 3600, 'discuss': 3600,
+    'group-member': 7200, 'discuss-member': 7200
+}
+
+# 'group_member_123' -> ('group-member', '123') ， 'group' -> ('group', None)
+def splitName(tname):
+    if tname in ('buddy', 'group', 'discuss'):
+        return tname, None
+    ctype, x, owner = tname.split('_', 2)
+    return ctype + '-member', owner
+
+class Refresher(object):
+
+    interval = 60
+    retryAfter = 600
+    rate = 1.0
+
+    def __init__(self, contactdb, maxAge=None):
+        self.contactdb = contactdb
+        self.maxAge = dict(DEFAULT_MAXAGE)
+        self.maxAge.update(maxAge or {})
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.queued = set()
+        self.failed = {}
+        self.bucket = TokenBucket(self.rate, 1)
+        self.job = None
+        self.working = self.stopped = False
+
+    def Start(self, scheduler):
+        self.job = scheduler.add_job(
+            lambda: PutTask(self.Check, priority=BACKGROUND, source='refresh'),
+            IntervalTrigger(seconds=self.interval)
+        )
+
+    def Stop(self):
+        if self.job is not None:
+            self.job.remove()
+            self.job = None
+        with self.cond:
+            self.stopped = True
+            self.queue.clear()
+            self.queued.clear()
+            self.cond.notify_all()
+
+    def isStale(self, tname, ttype, now):
+        maxAge = self.maxAge.get(ttype)
+        db = self.contactdb.db
+        updated = db.Updated(tname)
+        return bool(maxAge) and updated is not None and \
+            (now - updated > maxAge or db.IsCarried(tname))
+
+    # 主线程， QContactDB.List 返回数据库中的列表时调用
+    def Touch(self, tinfo):
+        tname = tName(tinfo)
+        if self.isStale(tname, tType(tinfo), time.time()) and \
+                time.time() - self.failed.get(tname, 0) > self.retryAfter:
+            self.request(tname, tinfo)
+
+    # 主线程，选出过期的列表交给工作线程
+    def Check(self):
+        now = time.time()
+        byType = collections.defaultdict(list)
+        db = self.contactdb.db
+        for tname, updated in list(db.present.items()):
+            if db.IsCarried(tname):
+                updated = 0
+            ttype, owner = splitName(tname)
+            byType[ttype].append((updated, tname, owner))
+
+        for ttype, tables in byType.items():
+            maxAge = self.maxAge.get(ttype)
+            if not maxAge:
+                continue
+            budget = int(math.ceil(2.0 * len(tables) * self.interval / maxAge))
+            for updated, tname, owner in sorted(tables):
+                if budget <= 0 or now - updated <= maxAge:
+                    break
+                if now - self.failed.get(tname, 0) <= self.retryAfter:
+                    continue
+                tinfo = self.tinfoOf(ttype, owner)
+                if tinfo is not None and self.request(tname, tinfo):
+                    budget -= 1
+
+    def tinfoOf(self, ttype, owner):
+        if owner is None:
+            return ttype
+        cl = self.contactdb.db.List(ttype[:-7], 'uin=' + owner)
+        return cl[0] if cl else None
+
+    def request(self, tname, tinfo):
+        with self.cond:
+            if self.stopped or tname in self.queued:
+                return False
+            self.queued.add(tname)
+            self.queue.append((tname, tinfo))
+            SetGauge('contactrefresh_pending', len(self.queued))
+            if not self.working:
+                self.working = True
+                StartDaemonThread(self.work, self.contactdb.session.Copy())
+            self.cond.notify()
+        return True
+
+    def work(self, session):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    if self.stopped:
+                        self.working = False
+                        return
+                    self.cond.wait()
+                tname, tinfo = self.queue.popleft()
+
+            # 排队期间已被其他途径（如 qq update 命令）更新
+            if not self.isStale(tname, tType(tinfo), time.time()):
+                PutTask(self.apply, (tname, tinfo, False),
+                        priority=BACKGROUND, source='refresh')
+                continue
+
+            wait = self.bucket.Take()
+            while wait > 0:
+                time.sleep(wait)
+                wait = self.bucket.Take()
+
+            DEBUG('后台刷新 %s', tinfo)
+            try:
+                contacts = self.contactdb.Fetch(tinfo, session)
+            except Exception:
+                ERROR('后台刷新 %s 时出错', tinfo, exc_info=True)
+                contacts = None
+            PutTask(self.apply, (tname, tinfo, contacts),
+                    priority=BACKGROUND, source='refresh')
+
+    # 主线程， contacts 为 False 表示无需刷新，为 None 表示获取失败
+    def apply(self, tname, tinfo, contacts):
+        with self.cond:
+            self.queued.discard(tname)
+            SetGauge('contactrefresh_pending', len(self.queued))
+        if contacts is False or self.stopped:
+            return
+        ttype = tType(tinfo)
+        if contacts is not None and self.contactdb.Store(tinfo, contacts):
+            self.failed.pop(tname, None)
+            Inc('contactrefresh_done', ttype=ttype)
+        else:
+            self.failed[tname] = time.time()
+            Inc('contactrefresh_failed', ttype=ttype)
+
+if __name__ == '__main__':
+    # 30 个成员列表同时过期时，刷新请求在各次检查之间的分布，以及 List 遇到过期列表时
+    # 的耗时（使用本地的 MockSmartQQ ）
+    import sys, tempfile
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from qqbot.qconf import QConf
+    from qqbot.qqbotcls import QQBot
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.qcontactdb.qcontactdb import QContactDB
+    from qqbot.mainloop import MainLoop
+    from qqbot.utf8logger import DisableLog, EnableLog
+
+    server = MockSmartQQ(nGroups=30, nMembers=50, latency=0.05)
+    server.Start()
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    session.Login(QConf(['-b', tempfile.mkdtemp(), '-q', server.qq]))
+
+    bot = QQBot()
+    bot.onUpdate = bot.onContactAdded = bot.onContactRemoved = \
+        bot.onContactChanged = lambda *args: None
+    contactdb = QContactDB(session, bot)
+    groups = contactdb.List('group')
+    for g in groups:
+        contactdb.List(g)
+    for tname in contactdb.db.present:
+        contactdb.db.present[tname] -= 30
+
+    # QContactDB 使用的是 qqbot.qcontactdb.refresher 模块中的 Refresher
+    from qqbot.qcontactdb import refresher
+    refresher.Refresher.interval, refresher.Refresher.rate = 1, 50.0
+    scheduler = BackgroundScheduler(daemon=True)
+    contactdb.StartRefresher(scheduler, {'group-member': 10, 'group': 0})
+
+    DisableLog()
+    contactdb.updates.window = contactdb.fetches.window = 0
+    t = time.time()
+    contactdb.Update(groups[1])
+    print('Update      %.1f ms' % ((time.time() - t) * 1000))
+    del server.requests[:]
+    t = time.time()
+    contactdb.List(groups[0], 'name=member1')
+    print('List(stale) %.1f ms' % ((time.time() - t) * 1000))
+
+    scheduler.start()
+    t0 = time.time()
+    try:
+        threading.Timer(6.5, lambda: PutTask(sys.exit, (0,))).start()
+        MainLoop()
+    except SystemExit:
+        pass
+    EnableLog()
+    ticks = collections.Counter(
+        int(t - t0) for path, t in server.requests if 'group_info_ext2' in path
+    )
+    print('fetches per second: %s' % [ticks[i] for i in range(7)])
+    print('refreshed: %d/30' % sum(
+        1 for g in groups if time.time() - contactdb.db.Updated(tName(g)) < 10
+    ))
+    server.Stop()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# 联系人模糊搜索
+#
+# 每个联系人的 name/nick/mark/card 被拆成单字和相邻两字（ bigram ）存入
+# contact_grams 表，按 (ttype, owner, gram) 建索引；各字段的原文及拼音首字母存入
+# contact_search 表。搜索时：
+#   1) 将查询串拆成单字（汉字）和 bigram ，统计每个联系人命中的比例（0~1 分）
+#   2) 查询串是某个字段的子串时加 1 分，是某个字段的前缀时再加 0.5 分，与某个字段
+#      完全相同时再加 0.5 分
+#   3) 查询串全为字母时，同时匹配各字段的拼音首字母（如 zs 匹配 “张三” ），
+#      匹配时加 1 分，为前缀时再加 0.5 分
+# 得分不低于 0.5 的联系人按得分从高到低排列，最多返回 FUZZY_LIMIT 个。
+#
+# 拼音首字母：优先使用 pypinyin （若已安装），否则按 GB2312 一级汉字的拼音顺序查表，
+# 二级汉字及其他字符忽略。
+
+import sys, os.path as op
+p = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import bisect
+
+from qqbot.common import STR2UNICODE, UNICODE2STR
+
+try:
+    from pypinyin import lazy_pinyin, Style
+except ImportError:
+    lazy_pinyin = None
+
+SEARCH_FIELDS = ('name', 'nick', 'mark', 'card')
+
+FUZZY_LIMIT = 20
+
+# GB2312 一级汉字按拼音排序，以下为每个声母的第一个汉字的编码
+_gbBounds = [
+    0xB0A1, 0xB0C5, 0xB2C1, 0xB4EE, 0xB6EA, 0xB7A2, 0xB8C1, 0xB9FE, 0xBBF7,
+    0xBFA6, 0xC0AC, 0xC2E8, 0xC4C3, 0xC5B6, 0xC5BE, 0xC6DA, 0xC8BB, 0xC8F6,
+    0xCBFA, 0xCDDA, 0xCEF4, 0xD1B9, 0xD4D1, 0xD7FA
+]
+_gbLetters = 'abcdefghjklmnopqrstwxyz'
+
+def initialOf(uch):
+    if uch.isalnum() and ord(uch) < 128:
+        return uch.lower()
+    if lazy_pinyin is not None:
+        py = lazy_pinyin(uch, style=Style.FIRST_LETTER, errors='ignore')
+        return py and py[0][:1].lower() or ''
+    try:
+        b = bytearray(uch.encode('gb2312'))
+    except UnicodeError:
+        return ''
+    if len(b) != 2:
+        return ''
+    i = bisect.bisect_right(_gbBounds, (b[0] << 8) | b[1]) - 1
+    return _gbLetters[i] if 0 <= i < len(_gbLetters) else ''
+
+# s: str ，返回拼音首字母串（ str ）
+def Initials(s):
+    return UNICODE2STR(u''.join(initialOf(uch) for uch in STR2UNICODE(s)))
+
+def normalize(s):
+    return u''.join(STR2UNICODE(s).lower().split())
+
+# 单字及相邻两字
+def grams(u):
+    result = set(u)
+    result.update(u[i:i+2] for i in range(len(u) - 1))
+    return result
+
+# 查询串中的字母、数字只按 bigram 匹配，以免英文查询命中太多联系人
+def queryGrams(u):
+    if len(u) == 1:
+        return set([u])
+    result = set(c for c in u if ord(c) >= 128)
+    result.update(u[i:i+2] for i in range(len(u) - 1))
+    return result
+
+# rows: 联系人记录（字段顺序同 fields ），返回 (searchRows, gramRows)
+def IndexRows(ttype, owner, fields, rows):
+    cols = [fields.index(f) for f in SEARCH_FIELDS if f in fields]
+    iuin = fields.index('uin')
+    searchRows, gramRows = [], []
+    for row in rows:
+        texts = [str(row[i] or '') for i in cols]
+        texts = [t for t in texts if t and t != '#NULL']
+        uin = row[iuin]
+        searchRows.append((
+            ttype, owner, uin, '\n'.join(texts).lower(),
+            '\n'.join(Initials(t) for t in texts)
+        ))
+        gs = set()
+        for t in texts:
+            gs.update(grams(normalize(t)))
+        gramRows.extend((ttype, owner, UNICODE2STR(g), uin) for g in gs)
+    return searchRows, gramRows
+
+def score(query, texts, initials):
+    s = 0.0
+    texts = texts.split('\n')
+    if any(query in t for t in texts):
+        s += 1
+        if any(t.startswith(query) for t in texts):
+            s += 0.5
+        if query in texts:
+            s += 0.5
+    if initials is not None:
+        initials = initials.split('\n')
+        if any(query in t for t in initials):
+            s += 1
+            if any(t.startswith(query) for t in initials):
+                s += 0.5
+    return s
+
+# 返回按得分排列的 uin 列表
+def Search(cursor, ttype, owner, query):
+    u = normalize(query)
+    if not u:
+        return []
+    qgrams = list(queryGrams(u))
+    query = UNICODE2STR(u)
+    isLetters = u.isalpha() and all(ord(c) < 128 for c in u)
+
+    scores = {}
+    cursor.execute(
+        "SELECT uin, COUNT(*) FROM contact_grams WHERE ttype=? AND owner=? "
+        "AND gram IN (%s) GROUP BY uin" % ','.join(['?']*len(qgrams)),
+        [ttype, owner] + [UNICODE2STR(g) for g in qgrams]
+    )
+    for uin, n in cursor.fetchall():
+        scores[uin] = float(n) / len(qgrams)
+
+    if isLetters:
+        cursor.execute(
+            "SELECT uin FROM contact_search WHERE ttype=? AND owner=? "
+            "AND initials LIKE ?", (ttype, owner, '%' + query + '%')
+        )
+        for (uin,) in cursor.fetchall():
+            scores.setdefault(uin, 0.0)
+
+    if not scores:
+        return []
+
+    uins = list(scores.keys())
+    cursor.execute(
+        "SELECT uin, texts, initials FROM contact_search WHERE ttype=? "
+        "AND owner=? AND uin IN (%s)" % ','.join(['?']*len(uins)),
+        [ttype, owner] + uins
+    )
+    for uin, texts, initials in cursor.fetchall():
+        scores[uin] += score(query, texts, isLetters and initials or None)
+
+    ranked = sorted((s, uin) for uin, s in scores.items() if s >= 0.5)
+    ranked.reverse()
+    return [uin for s, uin in ranked[:FUZZY_LIMIT]]
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# 合并对同一联系人列表的重复获取
+#
+# 同一个群连续收到几个陌生成员的消息时， QContactDB.find 会对每条消息都调用一次
+# Update ，重复下载整个成员列表。 SingleFlight 按 key （列表的表名）合并这些调用：
+#   1) 某个 key 的调用正在进行时，其他线程对同一 key 的调用不再执行，而是等待并共用
+#      其结果
+#   2) 调用成功（结果不为 None/False ）后的 window 秒内，同一 key 的调用直接返回
+#      上次的结果；失败的结果不保留，下次调用重新执行
+#
+# 运行指标： singleflight_shared{kind} 、 singleflight_calls{kind}
+
+import sys, os.path as op
+p = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, threading
+
+from qqbot.metrics import Inc
+
+class flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc = None
+        self.finished = 0
+
+class SingleFlight(object):
+    def __init__(self, name, window=3.0):
+        self.name = name
+        self.window = window
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def Do(self, key, func, *args):
+        with self.lock:
+            f = self.flights.get(key)
+            if f is not None and f.done.is_set() and \
+                    time.time() - f.finished > self.window:
+                f = None
+            if f is None:
+                f = self.flights[key] = flight()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            Inc('singleflight_shared', kind=self.name)
+            f.done.wait()
+            if f.exc is not None:
+                raise f.exc
+            return f.result
+
+        Inc('singleflight_calls', kind=self.name)
+        try:
+            f.result = func(*args)
+        except Exception as e:
+            f.exc = e
+            raise
+        finally:
+            with self.lock:
+                if f.exc is not None or f.result is None or \
+                        f.result is False:
+                    # 失败的结果只交给正在等待的调用
+                    if self.flights.get(key) is f:
+                        del self.flights[key]
+                else:
+                    f.finished = time.time()
+                    self.prune()
+            f.done.set()
+        return f.result
+
+    # 在 self.lock 内调用，清理过期的结果
+    def prune(self):
+        if len(self.flights) < 256:
+            return
+        now = time.time()
+        for key, f in list(self.flights.items()):
+            if f.done.is_set() and now - f.finished > self.window:
+                del self.flights[key]
+
+if __name__ == '__main__':
+    # 同一个群连续收到 200 条陌生成员（及自己）的消息时，统计下载群成员列表的次数
+    import tempfile
+    from qqbot.qconf import QConf
+    from qqbot.qqbotcls import QQBot
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.qcontactdb.qcontactdb import QContactDB
+    from qqbot.utf8logger import DisableLog, EnableLog
+
+    server = MockSmartQQ(nGroups=5, nMembers=200, latency=0.02)
+    server.Start()
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    session.Login(QConf(['-b', tempfile.mkdtemp(), '-q', server.qq]))
+
+    bot = QQBot()
+    bot.onUpdate = bot.onContactAdded = bot.onContactRemoved = \
+        bot.onContactChanged = lambda *args: None
+
+    gid = server.groups[0][0]
+    strangers = [str(900000 + i % 20) for i in range(200)]
+    for name, window, ttl in [('no singleflight', 0, 0),
+                              ('singleflight', 3.0, 300)]:
+        contactdb = QContactDB(session, bot)
+        contactdb.db = contactdb.db.__class__()
+        contactdb.updates.window = contactdb.fetches.window = window
+        contactdb.unknownTTL = ttl
+        contactdb.List('group')
+        del server.requests[:]
+        DisableLog()
+        t = time.time()
+        for membUin in strangers:
+            contactdb.FindSender('group', gid, membUin, server.qq, 'hello')
+        t = time.time() - t
+        EnableLog()
+        n = len([r for r in server.requests if 'group_info_ext2' in r[0]])
+        print('%-16s %3d fetches, %.2f s' % (name, n, t))
+    server.Stop()
@@ -12,7 +12,7 @@ p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if p not in sys.path:
     sys.path.insert(0, p)
 
-import sys, subprocess, time
+import sys, subprocess, time, threading
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from collections import defaultdict
@@ -21,10 +21,16 @@ from qqbot.qconf import QConf
 from qqbot.utf8logger import INFO, CRITICAL, ERROR, WARN
 from qqbot.qsession import QLogin, RequestError
 from qqbot.common import StartDaemonThread, Import
-from qqbot.qterm import QTermServer
-from qqbot.mainloop import MainLoop, Put
+from qqbot.termserver import QTermServer
+from qqbot.mainloop import MainLoop, PutTask
+from qqbot.mainloop import CONTROL, MESSAGE, BACKGROUND
 from qqbot.groupmanager import GroupManager
 from qqbot.termbot import TermBot
+from qqbot.sendqueue import SendQueue
+from qqbot.poller import Poller
+from qqbot.slots import SlotFilter, SlotIndex, SlotRunner, GetFilter, funcLabels
+from qqbot.metrics import Inc, Observe, Snapshot
+from qqbot.facemap import Message
 
 RESTART = 201
 FRESH_RESTART = 202
@@ -40,6 +46,11 @@ def getReason(code):
 def runBot(argv):
     if sys.argv[-1] == '--subprocessCall':
         sys.argv.pop()
+        if QConf(argv).users:
+            from qqbot.bothost import QQBotHost
+            QQBotHost(argv).Run()
+            return
+
         try:
             bot = QQBot._bot
             bot.Login(argv)
@@ -94,22 +105,55 @@ def RunBot(argv=None):
     except KeyboardInterrupt:
         sys.exit(1)
 
-def _call(func, *args, **kwargs):
+# 当前正在调用插件（或加载插件、登录）的 QQBot 对象，qqbotslot/qqbotsched 装饰器
+# 将注册到此对象上。单账号模式下始终为 _bot ，多账号模式下（见 bothost.py）各个
+# QQBot 对象在调用插件函数之前将自身设为当前对象。
+_local = threading.local()
+
+def currentBot():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else QQBot._bot
+
+class asCurrent(object):
+    def __init__(self, bot):
+        self.bot = bot
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self.bot)
+
+    def __exit__(self, *exc):
+        _local.stack.pop()
+
+# 每个插件函数的耗时和异常次数记入 plugin_latency{plugin,slot[,qq]} 和
+# plugin_errors{plugin,slot[,qq]} ，可通过 qq plugins 命令查看（多账号模式下带有
+# qq 标签，各账号分别统计，见 QQBot.pluginLabels ）
+def _call(func, bot, *args, **kwargs):
+    t = time.time()
+    labels = bot.pluginLabels(func)
     try:
-        func(*args, **kwargs)
+        func(bot, *args, **kwargs)
     except Exception as e:
+        Inc('plugin_errors', **labels)
         ERROR('', exc_info=True)
         ERROR('执行 %s.%s 时出错，%s', func.__module__, func.__name__, e)
+    finally:
+        Observe('plugin_latency', time.time() - t, **labels)
 
 class QQBot(GroupManager, TermBot):
 
     def Login(self, argv=None):
-        self.init(argv)
-        session, contactdb = QLogin(self.conf)
+        with asCurrent(self):
+            self.init(argv)
+            session, contactdb = QLogin(self.conf, self)
         self.session, self.contactdb = session, contactdb
 
+        # any thread （消息由发送队列的工作线程发送）
+        self.sendQueue = SendQueue(session)
+        self.SendTo = self.sendQueue.SendTo
+
         # main thread
-        self.SendTo = session.Copy().SendTo
         self.groupKick = session.GroupKick
         self.groupSetAdmin = session.GroupSetAdmin
         self.groupShut = session.GroupShut
@@ -120,29 +164,21 @@ class QQBot(GroupManager, TermBot):
         self.Update = contactdb.Update
         self.StrOfList = contactdb.StrOfList
         self.ObjOfList = contactdb.ObjOfList
+        self.PageOfList = contactdb.PageOfList
         self.findSender = contactdb.FindSender
         self.firstFetch = contactdb.FirstFetch
         self.Delete = contactdb.db.Delete
         self.Modify = contactdb.db.Modify
         
-        # child thread 1
-        self.poll = session.Copy().Poll
+        # child thread 1 （ conf.pollConcurrency 个 poll 线程）
+        self.poller = Poller(session, self.conf.pollConcurrency)
 
     def Run(self):
-        if self.conf.startAfterFetch:
-            self.firstFetch()
+        self.start()
 
-        self.onPlug()
-        self.onStartupComplete()
-        
-        # child thread 1~4
-        StartDaemonThread(self.pollForever)
+        # child thread 2
         StartDaemonThread(self.intervalForever)
-        StartDaemonThread(QTermServer(self.conf.termServerPort, self.onTermCommand).Run)
-        self.scheduler.start()
 
-        self.started = True
-        
         try:
             MainLoop()
         except SystemExit as e:
@@ -154,30 +190,59 @@ class QQBot(GroupManager, TermBot):
             self.onExit(1, 'unknown-error', e)
             raise SystemExit(1)
     
+    def start(self):
+        if self.conf.startAfterFetch:
+            self.firstFetch()
+
+        self.onPlug()
+        self.onStartupComplete()
+
+        # 后台刷新联系人列表（检查在主线程中进行，获取在刷新线程中进行）
+        self.contactdb.StartRefresher(self.scheduler, self.conf.contactMaxAge)
+        
+        # child thread 1, 3
+        self.poller.Start(self.onPollItem, self.onPollExpire)
+        self.termServer = QTermServer(self.conf.termServerPort, self)
+        StartDaemonThread(self.termServer.Run)
+        if not self.scheduler.running:
+            self.scheduler.start()
+
+        self.started = True
+    
     def Stop(self):
-        sys.exit(0)
+        self.exit(0)
     
     def Restart(self):
-        sys.exit(RESTART)
+        self.exit(RESTART)
     
     def FreshRestart(self):
-        sys.exit(FRESH_RESTART)
+        self.exit(FRESH_RESTART)
+    
+    # 单账号模式下直接退出进程（由父进程决定是否重启），多账号模式下只停止本账号，
+    # 由 QQBotHost 决定是否重新登录本账号
+    def exit(self, code):
+        # 提交联系人数据库中尚未提交的修改（见 ContactDB.defer ）
+        self.contactdb.db.Flush()
+        # 等待发送队列中的消息（如插件在 Stop 之前发出的消息）发送完毕
+        self.sendQueue.Flush()
+        if self.host is None:
+            sys.exit(code)
+        else:
+            self.host.onBotExit(self, code)
     
     # child thread 1
-    def pollForever(self):
-        while True:
-            try:
-                result = self.poll()
-            except RequestError:
-                Put(sys.exit, LOGIN_EXPIRE)
-                break
-            except:
-                ERROR('qsession.Poll 方法出错', exc_info=True)
-            else:
-                Put(self.onPollComplete, *result)
+    # 消息优先于 term 命令和定时任务处理，不同联系人的消息轮流处理
+    def onPollItem(self, ctype, fromUin, membUin, content):
+        PutTask(self.onPollComplete,
+                (ctype, fromUin, membUin, content, time.time()),
+                priority=MESSAGE, source=(self.conf.qq, ctype, fromUin))
+
+    # child thread 1
+    def onPollExpire(self):
+        PutTask(self.exit, (LOGIN_EXPIRE,), priority=CONTROL)
 
-    def onPollComplete(self, ctype, fromUin, membUin, content):
-        if ctype == 'timeout':
+    def onPollComplete(self, ctype, fromUin, membUin, content, received=None):
+        if ctype == 'timeout' or self.stopped:
             return
 
         contact, member, nameInGroup = \
@@ -187,16 +252,28 @@ class QQBot(GroupManager, TermBot):
             INFO('来自 %s 的系统消息： "%s"', contact, content)
             return
 
+        # 多账号模式下在日志中标明接收消息的账号
+        tag = self.host and ('[%s] ' % self.conf.qq) or ''
+
+        # content 为 facemap.Message ，修改后的文本在读取 segments 时重新解析
         if self.detectAtMe(nameInGroup, content):
-            INFO('有人 @ 我：%s[%s]' % (contact, member))
-            content = '[@ME] ' + content.replace('@'+nameInGroup, '')
-        else:
-            content = content.replace('@ME', '@Me')
+            INFO('%s有人 @ 我：%s[%s]' % (tag, contact, member))
+            content = Message(
+                '[@ME] ' + content.replace('@'+nameInGroup, '')
+            )
+        elif '@ME' in content:
+            content = Message(content.replace('@ME', '@Me'))
                 
         if ctype == 'buddy':
-            INFO('来自 %s 的消息: "%s"' % (contact, content))
+            INFO('%s来自 %s 的消息: "%s"' % (tag, contact, content))
         else:
-            INFO('来自 %s[%s] 的消息: "%s"' % (contact, member, content))
+            INFO('%s来自 %s[%s] 的消息: "%s"' % (tag, contact, member, content))
+
+        # 推送给 HTTP-API 的订阅者（见 termpush.py ）
+        termServer = getattr(self, 'termServer', None)
+        if termServer is not None:
+            termServer.events.Publish(self.conf.qq, contact, member, content,
+                                      received)
 
         self.onQQMessage(contact, member, content)
     
@@ -211,10 +288,13 @@ class QQBot(GroupManager, TermBot):
     def intervalForever(self):
         while True:
             time.sleep(300)
-            Put(self.onInterval)
+            PutTask(self.onInterval, priority=BACKGROUND, source='interval')
     
-    def __init__(self):        
-        self.scheduler = BackgroundScheduler(daemon=True)
+    def __init__(self, host=None):
+        self.host = host
+        self.stopped = False
+        self.scheduler = host and host.scheduler or \
+                         BackgroundScheduler(daemon=True)
         self.schedTable = defaultdict(list)
         self.slotsTable = {
             'onInit': [],
@@ -223,16 +303,23 @@ class QQBot(GroupManager, TermBot):
             'onQQMessage': [],
             'onInterval': [],
             'onUpdate': [],
+            'onContactAdded': [],
+            'onContactRemoved': [],
+            'onContactChanged': [],
             'onPlug': [],
             'onUnplug': [],
             'onExit': [],
         }
+        self.slotIndex = SlotIndex(self.slotsTable['onQQMessage'])
+        self.slotRunner = SlotRunner(self.callConcurrent, self.pluginLabels)
+        self.concurrentSlots = {}
         self.started = False
         self.plugins = {}
     
     def init(self, argv):
         for name, slots in self.slotsTable.items():
             setattr(self, name, self.wrap(slots))
+        self.onQQMessage = self.dispatchQQMessage
 
         self.conf = QConf(argv)
         self.conf.Display()
@@ -244,32 +331,70 @@ class QQBot(GroupManager, TermBot):
     
     def wrap(self, slots):
         def func(*args, **kwargs):
-            for f in slots:
-                _call(f, self, *args, **kwargs)
+            with asCurrent(self):
+                for f in slots:
+                    _call(f, self, *args, **kwargs)
         return func
+
+    # 只调用过滤条件与此消息匹配的 onQQMessage 函数（见 slots.py ），
+    # concurrent 函数交给 slotRunner 在子线程中调用
+    def dispatchQQMessage(self, contact, member, content):
+        with asCurrent(self):
+            for f in self.slotIndex.Lookup(contact, content):
+                timeout = self.concurrentSlots.get(f)
+                if timeout is None:
+                    _call(f, self, contact, member, content)
+                else:
+                    self.slotRunner.Submit((contact.ctype, contact.uin), f,
+                                           (contact, member, content), timeout)
+
+    # slotRunner 的工作线程
+    def callConcurrent(self, func, *args):
+        with asCurrent(self):
+            _call(func, self, *args)
     
-    def AddSlot(self, func):
-        self.slotsTable[func.__name__].append(func)
+    # concurrent=True 时（或函数的 slotConcurrent 属性为 True 时），该函数在
+    # slotRunner 的工作线程中调用，每次调用最多 timeout 秒（默认 30 秒）
+    def AddSlot(self, func, concurrent=False, timeout=None):
+        name = func.__name__
+        if GetFilter(func) is not None and name != 'onQQMessage':
+            raise ValueError('只有 onQQMessage 回调函数可以设置过滤条件')
+        if concurrent or getattr(func, 'slotConcurrent', False):
+            if name != 'onQQMessage':
+                raise ValueError('只有 onQQMessage 回调函数可以并发执行')
+            self.concurrentSlots[func] = \
+                timeout or getattr(func, 'slotTimeout', None) or 30
+        self.slotsTable[name].append(func)
+        self.slotIndex.Invalidate()
         return func
 
-    def AddSched(self, **triggerArgs):
+    # timeout 不为 None 时，任务到时后 timeout 秒内仍未开始执行（如主线程繁忙）则
+    # 跳过这一次执行
+    def AddSched(self, timeout=None, **triggerArgs):
         def wrapper(func):
-            job = lambda: Put(_call, func, self)
+            job = lambda: PutTask(self.callSched, (func,), source='sched',
+                                  timeout=timeout)
             job.__name__ = func.__name__
             j = self.scheduler.add_job(job, CronTrigger(**triggerArgs))
             self.schedTable[func.__module__].append(j)
             return func
         return wrapper
     
+    def callSched(self, func):
+        with asCurrent(self):
+            _call(func, self)
+
     def unplug(self, moduleName, removeJob=True):
         for slots in self.slotsTable.values():
             i = 0
             while i < len(slots):
                 if slots[i].__module__ == moduleName:
+                    self.concurrentSlots.pop(slots[i], None)
                     slots[i] = slots[-1]
                     slots.pop()
                 else:
                     i += 1
+        self.slotIndex.Invalidate()
 
         if removeJob:
             for job in self.schedTable.pop(moduleName, []):
@@ -277,6 +402,10 @@ class QQBot(GroupManager, TermBot):
             self.plugins.pop(moduleName, None)
     
     def Plug(self, moduleName):
+        with asCurrent(self):
+            return self.plug(moduleName)
+
+    def plug(self, moduleName):
         self.unplug(moduleName)
         try:
             module = Import(moduleName)
@@ -291,7 +420,7 @@ class QQBot(GroupManager, TermBot):
             names = []
             for slotName in self.slotsTable.keys():
                 if hasattr(module, slotName):
-                    self.slotsTable[slotName].append(getattr(module, slotName))
+                    self.AddSlot(getattr(module, slotName))
                     names.append(slotName)
 
             if (not names) and (moduleName not in self.schedTable):
@@ -328,11 +457,68 @@ class QQBot(GroupManager, TermBot):
     def Plugins(self):
         return list(self.plugins.keys())
 
+    # 插件运行指标的标签，多账号模式下带上本账号的 qq ，以免各账号的统计混在一起
+    def pluginLabels(self, func):
+        labels = funcLabels(func)
+        if self.host is not None:
+            labels['qq'] = self.conf.qq
+        return labels
+
+    # 返回 {pluginName: {funcName: {calls, errors, timeouts, skipped, avg,
+    # p99, max}}} ，
+    # 耗时的单位为秒
+    def PluginStats(self):
+        stats = dict((name, {}) for name in self.Plugins())
+        qq = self.conf.qq if self.host is not None else None
+        snapshot = Snapshot('plugin_')
+        errors = snapshot.get('plugin_errors', {})
+        timeouts = snapshot.get('plugin_timeouts', {})
+        skipped = snapshot.get('plugin_skipped', {})
+        for labels, h in snapshot.get('plugin_latency', {}).items():
+            d = dict(kv.split('=', 1) for kv in labels.split(','))
+            if d['plugin'] in stats and d.get('qq') == qq:
+                stats[d['plugin']][d['slot']] = {
+                    'calls': h['count'], 'errors': errors.get(labels, 0),
+                    'timeouts': timeouts.get(labels, 0),
+                    'skipped': skipped.get(labels, 0),
+                    'avg': h['avg'], 'p99': h['p99'], 'max': h['max']
+                }
+        return stats
+
+    # 停止本账号：移除定时任务，poll 线程将在本次 poll 返回后结束
+    def shutdown(self):
+        self.stopped = True
+        self.sendQueue.Stop()
+        self.slotRunner.Stop()
+        if self.contactdb.fetchPool is not None:
+            self.contactdb.fetchPool.Stop()
+        self.contactdb.StopRefresher()
+        if getattr(self, 'termServer', None) is not None:
+            self.termServer.Stop()
+        self.poller.Stop()
+        for moduleName in list(self.schedTable.keys()):
+            for job in self.schedTable.pop(moduleName):
+                job.remove()
+
 _bot = QQBot()
 QQBot._bot = _bot
-QQBotSlot = _bot.AddSlot
-QQBotSched = _bot.AddSched
-QQBot.__init__ = None
+
+# 用法： @qqbotslot 或 @qqbotslot(ctype=..., uin=..., qq=..., prefix=..., regex=...,
+#                                    concurrent=False, timeout=None)
+# 过滤条件及并发选项保存在函数的属性中，以插件形式加载时同样有效
+def QQBotSlot(func=None, concurrent=False, timeout=None, **filters):
+    if func is None:
+        def wrapper(func):
+            if filters:
+                func.slotFilter = SlotFilter(**filters)
+            if concurrent:
+                func.slotConcurrent, func.slotTimeout = True, timeout
+            return currentBot().AddSlot(func)
+        return wrapper
+    return currentBot().AddSlot(func)
+
+def QQBotSched(**triggerArgs):
+    return currentBot().AddSched(**triggerArgs)
 
 if __name__ == '__main__':
     from qqbot import _bot as bot
@@ -75,9 +75,10 @@ class QrcodeManager(object):
         with open(self.qrcodePath, 'wb') as f:
             f.write(qrcode)
 
-        from qqbot import _bot
-        if hasattr(_bot, 'onQrcode'):
-            _bot.onQrcode(self.qrcodePath, qrcode)
+        from qqbot.qqbotcls import currentBot
+        bot = currentBot()
+        if hasattr(bot, 'onQrcode'):
+            bot.onQrcode(self.qrcodePath, qrcode)
         
         if self.cmdQrcode:
             try:
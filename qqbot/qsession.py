@@ -13,7 +13,7 @@ from qqbot.basicqsession import BasicQSession, RequestError
 from qqbot.groupmanager import GroupManagerSession
 from qqbot.common import SYSTEMSTR2STR
 
-def QLogin(conf):
+def QLogin(conf, bot=None):
     if conf.qq:
         INFO('开始自动登录...')
         picklePath = conf.PicklePath()
@@ -21,6 +21,7 @@ def QLogin(conf):
         try:
             with open(picklePath, 'rb') as f:
                 session.__dict__ = pickle.load(f)
+            session.mountSharedAdapter()
             session.dbname = conf.absPath(session.dbbasename)
         except Exception as e:
             WARN('自动登录失败，原因：%s', e)
@@ -35,15 +36,7 @@ def QLogin(conf):
                 WARN('自动登录失败，原因：%s', e)
                 DEBUG('', exc_info=True)                
             else:
-                return session, QContactDB(session)
-            
-            if os.path.exists(session.dbname):
-                try:
-                    os.remove(session.dbname)
-                except OSError:
-                    pass
-                except:
-                    WARN('', exc_info=True)
+                return session, QContactDB(session, bot)
 
     INFO('开始手动登录...')
     session = QSession()
@@ -57,7 +50,7 @@ def QLogin(conf):
     else:
         INFO('登录信息已保存至：%s' % SYSTEMSTR2STR(picklePath))
 
-    return session, QContactDB(session)
+    return session, QContactDB(session, bot)
 
 class QSession(BasicQSession, GroupManagerSession):
     pass
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+# smartRequest 的重试策略
+#
+# 每次请求失败后，由 RetryPolicy 决定是否重试以及重试前等待多长时间：
+#   1) 每类错误（网络错误 CE 、超时 TO 、 URL 地址错误 UE 、请求被拒绝 DE ）
+#      各有一个重试次数上限
+#   2) 重试间隔按指数增长（ baseDelay * factor^(n-1) ，不超过 maxDelay ），并加入
+#      随机抖动，避免多个会话同步地向服务器发请求
+#   3) 若设置了 deadline ，整个请求（含所有重试）超过 deadline 秒即放弃
+#   4) 同一接口连续出现网络错误/超时/URL 错误时打开熔断器， resetTimeout 秒内该接口
+#      的请求直接失败，之后放行试探请求，成功则关闭熔断器
+#
+# 每次重试判定都记入 qqbot.metrics ：
+#   smartrequest_retry{endpoint,error,decision} 、 smartrequest_backoff{endpoint}
+#
+# 不同接口可以有各自的策略（见 SetPolicy/GetPolicy ），也可以在调用 smartRequest 、
+# Fetch 以及 GroupManagerSession 的各个方法时通过 policy 参数指定。
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, random, threading
+
+from qqbot.common import UrlSplit
+from qqbot.metrics import Inc, Observe
+from qqbot.utf8logger import WARN, INFO
+
+ERROR_NAMES = {
+    'CE': '网络错误', 'TO': '超时', 'UE': 'URL 地址错误', 'DE': '请求被拒绝错误'
+}
+
+class CircuitBreaker(object):
+    def __init__(self, endpoint, threshold=10, resetTimeout=30):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.resetTimeout = resetTimeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.openedAt = None
+
+    # closed/open/half-open
+    def State(self):
+        if self.openedAt is None:
+            return 'closed'
+        elif time.time() - self.openedAt < self.resetTimeout:
+            return 'open'
+        else:
+            return 'half-open'
+
+    def Allow(self):
+        return self.State() != 'open'
+
+    def OnSuccess(self):
+        with self.lock:
+            if self.openedAt is not None:
+                INFO('接口“%s”已恢复正常，关闭熔断器', self.endpoint)
+            self.failures, self.openedAt = 0, None
+
+    def OnFailure(self):
+        with self.lock:
+            self.failures += 1
+            if self.openedAt is not None:
+                # half-open 状态下的试探请求失败，重新打开
+                if time.time() - self.openedAt >= self.resetTimeout:
+                    self.openedAt = time.time()
+            elif self.failures >= self.threshold:
+                WARN('接口“%s”连续 %d 次请求失败，打开熔断器（%d 秒）',
+                     self.endpoint, self.failures, self.resetTimeout)
+                self.openedAt = time.time()
+                Inc('smartrequest_breaker_open', endpoint=self.endpoint)
+
+_breakersLock = threading.Lock()
+_breakers = {}
+
+def getBreaker(endpoint, threshold, resetTimeout):
+    with _breakersLock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = \
+                CircuitBreaker(endpoint, threshold, resetTimeout)
+        return _breakers[endpoint]
+
+def Breakers():
+    return dict((k, b.State()) for k, b in _breakers.items())
+
+def Endpoint(url):
+    return UrlSplit(url).path.rstrip('/').split('/')[-1] or url
+
+class RetryPolicy(object):
+
+    def __init__(self, maxConnErrors=5, maxTimeouts=20, maxUrlErrors=5,
+                 maxDenies=None, baseDelay=0.5, factor=2.0, maxDelay=8.0,
+                 jitter=0.5, deadline=None, breaker=True,
+                 breakerThreshold=10, breakerReset=30, pingInterval=60):
+        # 各类错误的最多重试次数， maxDenies 为 None 时使用 smartRequest 的
+        # repeatOnDeny 参数
+        self.maxConnErrors = maxConnErrors
+        self.maxTimeouts = maxTimeouts
+        self.maxUrlErrors = maxUrlErrors
+        self.maxDenies = maxDenies
+
+        # 第 n 次重试前等待 min(maxDelay, baseDelay * factor^(n-1)) 秒，
+        # 再乘以 [1-jitter, 1] 之间的随机数
+        self.baseDelay = baseDelay
+        self.factor = factor
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+
+        # 整个请求（含重试）的最长时间（秒）， None 表示不限
+        self.deadline = deadline
+
+        self.breaker = breaker
+        self.breakerThreshold = breakerThreshold
+        self.breakerReset = breakerReset
+
+        # 服务器返回 502/504/404 时向 pinghot.qq.com 报告的最小间隔（秒）
+        self.pingInterval = pingInterval
+
+    def Copy(self, **kwargs):
+        c = self.__class__()
+        c.__dict__.update(self.__dict__)
+        c.__dict__.update(kwargs)
+        return c
+
+    def Delay(self, n):
+        d = min(self.maxDelay, self.baseDelay * (self.factor ** (n - 1)))
+        return d * (1 - self.jitter * random.random())
+
+    def Begin(self, url, repeatOnDeny=2):
+        return RetryState(self, url, repeatOnDeny)
+
+    def __repr__(self):
+        return 'RetryPolicy(%s)' % ', '.join(
+            '%s=%r' % kv for kv in sorted(self.__dict__.items())
+        )
+
+class RetryState(object):
+    def __init__(self, policy, url, repeatOnDeny):
+        self.policy = policy
+        self.endpoint = Endpoint(url)
+        self.start = time.time()
+        self.counts = {'CE': 0, 'TO': 0, 'UE': 0, 'DE': 0}
+        self.limits = {
+            'CE': policy.maxConnErrors,
+            'TO': policy.maxTimeouts,
+            'UE': policy.maxUrlErrors,
+            'DE': repeatOnDeny if policy.maxDenies is None
+                  else policy.maxDenies
+        }
+        if policy.breaker:
+            self.breaker = getBreaker(self.endpoint, policy.breakerThreshold,
+                                      policy.breakerReset)
+        else:
+            self.breaker = None
+
+    @property
+    def N(self):
+        return sum(self.counts.values())
+
+    # 发请求前调用，熔断器打开时返回 False
+    def Allow(self):
+        if self.breaker is None or self.breaker.Allow():
+            return True
+        Inc('smartrequest_retry', endpoint=self.endpoint, error='-',
+            decision='breaker-open')
+        return False
+
+    # 本次请求剩余的时间（秒），用于设置 HTTP 请求的超时
+    def Remaining(self, timeout):
+        if self.policy.deadline is None:
+            return timeout
+        return max(0.1, min(timeout,
+                            self.start + self.policy.deadline - time.time()))
+
+    def OnSuccess(self):
+        if self.breaker is not None:
+            self.breaker.OnSuccess()
+        if self.N:
+            Inc('smartrequest_retry', endpoint=self.endpoint, error='-',
+                decision='recovered')
+
+    # 请求失败后调用，返回 (decision, delay) ，decision 为：
+    #   'retry'         等待 delay 秒后重试
+    #   'timeout-value' 超时次数达到上限，返回 timeoutRetVal
+    #   'giveup'        放弃
+    def OnFailure(self, error, hasTimeoutRetVal=False):
+        self.counts[error] += 1
+
+        if self.breaker is not None:
+            if error == 'DE':
+                # 服务器可以正常访问，只是拒绝了本次请求
+                self.breaker.OnSuccess()
+            else:
+                self.breaker.OnFailure()
+
+        n, limit, delay = self.counts[error], self.limits[error], 0
+
+        # 若网络没有问题但 retcode 有误，一般连续 3 次都出错就没必要再试了
+        if (n <= limit if error == 'DE' else n < limit):
+            delay = self.policy.Delay(self.N)
+            if self.policy.deadline is not None and \
+                    time.time() + delay - self.start >= self.policy.deadline:
+                decision = 'deadline'
+            elif self.breaker is not None and not self.breaker.Allow():
+                decision = 'breaker-open'
+            else:
+                decision = 'retry'
+        elif error == 'TO' and n == limit and hasTimeoutRetVal:
+            decision = 'timeout-value'
+        else:
+            decision = 'giveup'
+
+        Inc('smartrequest_retry', endpoint=self.endpoint, error=error,
+            decision=decision)
+        if decision == 'retry':
+            Observe('smartrequest_backoff', delay, endpoint=self.endpoint)
+            return decision, delay
+        elif decision == 'timeout-value':
+            return decision, 0
+        else:
+            return 'giveup', 0
+
+_pingLock = threading.Lock()
+_lastPing = [0]
+
+# 是否需要向 pinghot.qq.com 报告超时（所有会话共用一个计时器）
+def ShouldPing(policy):
+    with _pingLock:
+        if time.time() - _lastPing[0] >= policy.pingInterval:
+            _lastPing[0] = time.time()
+            return True
+        return False
+
+DEFAULT_POLICY = RetryPolicy()
+
+# 各接口的默认策略，键为 url 路径的最后一段
+endpointPolicies = {
+    # 长轮询：服务器 504 时直接返回，由 pollForever 重新发起；不熔断，
+    # 以免掉线检测（ Poll 失败后的 TestLogin ）被熔断器拦截
+    'poll2': RetryPolicy(maxDelay=4.0, breaker=False),
+    'get_online_buddies2': RetryPolicy(breaker=False),
+
+    # 发消息：失败后尽快放弃，避免消息积压
+    'send_buddy_msg2': RetryPolicy(maxTimeouts=5, maxDelay=4.0, deadline=60),
+    'send_qun_msg2': RetryPolicy(maxTimeouts=5, maxDelay=4.0, deadline=60),
+    'send_discu_msg2': RetryPolicy(maxTimeouts=5, maxDelay=4.0, deadline=60),
+
+    # 联系人列表：数据量大，允许等更久
+    'get_group_info_ext2': RetryPolicy(maxDelay=16.0, deadline=300),
+    'get_user_friends2': RetryPolicy(maxDelay=16.0, deadline=300),
+}
+
+def GetPolicy(url):
+    return endpointPolicies.get(Endpoint(url), DEFAULT_POLICY)
+
+def SetPolicy(endpoint, policy):
+    if policy is None:
+        endpointPolicies.pop(endpoint, None)
+    else:
+        endpointPolicies[endpoint] = policy
+
+if __name__ == '__main__':
+    # 打印一次请求在连续超时情况下的重试间隔
+    policy = RetryPolicy(deadline=60)
+    state = policy.Begin('http://d1.web2.qq.com/channel/get_discu_info')
+    t = 0
+    while True:
+        decision, delay = state.OnFailure('TO')
+        print('%2d %-12s %.2f %.2f' % (state.N, decision, delay, t))
+        t += delay
+        if decision != 'retry':
+            break
+    from qqbot.metrics import Report
+    print(Report('smartrequest'))
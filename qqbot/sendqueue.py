@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+# 消息发送队列
+#
+# bot.SendTo(contact, content) 只是把消息放入发送队列并立即返回一个
+# concurrent.futures.Future 对象，真正的发送由后台的工作线程完成，因此插件即使对
+# 每条群消息都进行回复，也不会阻塞 MainLoop 。
+#
+#   1) 好友/群/讨论组 消息各有一个发送队列和一个工作线程（各用一个会话副本）
+#   2) 每个联系人有一个令牌桶（ targetRate 条/秒，最多积攒 targetBurst 条），
+#      所有联系人共用一个全局令牌桶（ globalRate 条/秒，最多积攒 globalBurst 条）
+#   3) 队列中发往同一个联系人的多条短消息会被合并为一条发送（总长度不超过一个分片），
+#      同一联系人的消息总是按放入队列的顺序发送
+#   4) 工作线程每次只发送一个分片（见 Partition ），长消息的其余部分放回队列（排在
+#      该联系人的其他消息之前），等该联系人再次取得令牌时发送，工作线程从不为某个
+#      联系人等待令牌，不同联系人之间互不阻塞。空闲超过 bucketIdle 秒的联系人的
+#      令牌桶已经装满，与新建的一样，将被删除
+#   5) future.result() 返回 '向 xx 发消息成功' 或 '错误：...' （与原 SendTo 的返回值
+#      相同），在 asyncio 中可以使用 await asyncio.wrap_future(future)
+#   6) Stop 之后不再接受新消息，但已在队列中的消息仍会发送完毕；退出前可调用
+#      Flush(timeout) 等待队列中的消息发送完毕（ QQBot.exit 中会调用）
+#
+# 运行指标： sendqueue_depth{ctype} 、 sendqueue_wait{ctype} 、
+#            sendqueue_sent{ctype} 、 sendqueue_coalesced{ctype} 、
+#            sendqueue_throttle{ctype}
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, threading, collections
+
+from concurrent.futures import Future
+
+from qqbot.basicqsession import RequestError, checkSendTo
+from qqbot.utf8logger import INFO, WARN, ERROR
+from qqbot.common import StartDaemonThread, Partition, STR2BYTES
+from qqbot.metrics import Inc, Observe, SetGauge
+
+CTYPES = ('buddy', 'group', 'discuss')
+
+# 合并后的消息长度上限（字节），与 Partition 的分片长度相同
+COALESCE_LIMIT = 720
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.t = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now-self.t)*self.rate)
+        self.t = now
+
+    # 取得令牌还需等待的时间（秒）
+    def Wait(self):
+        with self.lock:
+            self.refill()
+            return max(0, (1 - self.tokens) / self.rate)
+
+    def Full(self):
+        with self.lock:
+            self.refill()
+            return self.tokens >= self.capacity
+
+    # 取得一个令牌，返回 0 ；若令牌不足，返回需要等待的时间（秒）
+    def Take(self):
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+class outMessage(object):
+    def __init__(self, contact, content, resendOn1202):
+        self.contact = contact
+        self.key = (contact.ctype, contact.uin)
+        self.content = content
+        self.resendOn1202 = resendOn1202
+        self.future = Future()
+        self.t = time.time()
+        # 本条消息代表的原始消息（长消息的其余部分代表已开始发送的那些消息）
+        self.origins = [self]
+        self.started = False
+
+class SendQueue(object):
+
+    targetRate, targetBurst = 1.0, 3
+    globalRate, globalBurst = 3.0, 6
+    coalesce = True
+    flushTimeout = 10
+    bucketIdle = 60
+
+    def __init__(self, session):
+        self.session = session
+        self.cond = threading.Condition()
+        self.pending = dict((ctype, collections.deque()) for ctype in CTYPES)
+        self.workers = {}
+        self.buckets = {}
+        self.globalBucket = TokenBucket(self.globalRate, self.globalBurst)
+        self.pruned = time.time()
+        self.sending = 0
+        self.stopped = False
+
+    # 任意线程中均可调用，立即返回一个 Future
+    def SendTo(self, contact, content, resendOn1202=True):
+        content, err = checkSendTo(contact, content)
+        if err:
+            ERROR(err)
+            f = Future()
+            f.set_result(err)
+            return f
+
+        m = outMessage(contact, content, resendOn1202)
+        with self.cond:
+            if self.stopped:
+                m.future.set_result('错误：发送队列已关闭，向 %s 发消息失败'
+                                    % (contact,))
+                return m.future
+            self.pending[contact.ctype].append(m)
+            SetGauge('sendqueue_depth', len(self.pending[contact.ctype]),
+                     ctype=contact.ctype)
+            if contact.ctype not in self.workers:
+                # 每个工作线程使用一个会话副本，msgId 错开以免重复
+                session = self.session.Copy()
+                session.msgId += 1000000 * (len(self.workers) + 1)
+                self.workers[contact.ctype] = session
+                StartDaemonThread(self.workAt, contact.ctype, session)
+            self.cond.notify_all()
+        return m.future
+
+    # 不再接受新消息，工作线程发送完队列中的消息后结束
+    def Stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    # 等待队列中（以及正在发送）的消息发送完毕，最多等待 timeout 秒（默认为
+    # flushTimeout ），全部发送完毕时返回 True
+    def Flush(self, timeout=None):
+        if timeout is None:
+            timeout = self.flushTimeout
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.sending or any(self.pending.values()):
+                wait = deadline - time.time()
+                if wait <= 0:
+                    WARN('发送队列中尚有 %d 条消息未发送完毕',
+                         self.sending + sum(map(len, self.pending.values())))
+                    return False
+                self.cond.wait(wait)
+        return True
+
+    def Depth(self):
+        return dict((ctype, len(q)) for ctype, q in self.pending.items())
+
+    # 在 self.cond 内调用
+    def bucket(self, key):
+        now = time.time()
+        if now - self.pruned > self.bucketIdle:
+            self.pruned = now
+            for k in [k for k, b in self.buckets.items() if b.Full()]:
+                del self.buckets[k]
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(self.targetRate, self.targetBurst)
+        return self.buckets[key]
+
+    # 在 self.cond 内调用。选出第一个可以发送的消息（同一联系人只看其最早的一条消息），
+    # 取得该联系人及全局的令牌，返回 (messages, 0) ；若令牌不足，返回
+    # (None, 最短等待时间)
+    def pick(self, ctype):
+        pending = self.pending[ctype]
+        if not pending:
+            return None, None
+
+        # 全局令牌桶由各工作线程共用
+        wait = self.globalBucket.Wait()
+        if wait > 0:
+            return None, wait
+
+        seen, wait = set(), None
+        for i, m in enumerate(pending):
+            if m.key in seen:
+                continue
+            seen.add(m.key)
+            w = self.bucket(m.key).Wait()
+            if w == 0:
+                break
+            wait = w if wait is None else min(wait, w)
+        else:
+            return None, wait
+
+        if self.globalBucket.Take() != 0:
+            return None, self.globalBucket.Wait()
+        self.bucket(m.key).Take()
+
+        del pending[i]
+        msgs = [m]
+
+        # 合并发往同一联系人的后续短消息
+        if self.coalesce:
+            n, j = len(STR2BYTES(m.content)), i
+            while j < len(pending):
+                m2 = pending[j]
+                if m2.key != m.key:
+                    j += 1
+                    continue
+                n += len(STR2BYTES(m2.content)) + 1
+                if n > COALESCE_LIMIT or m2.resendOn1202 != m.resendOn1202:
+                    break
+                del pending[j]
+                msgs.append(m2)
+
+        SetGauge('sendqueue_depth', len(pending), ctype=ctype)
+        return msgs, 0
+
+    def workAt(self, ctype, session):
+        while True:
+            with self.cond:
+                throttled = None
+                while True:
+                    if self.stopped and not self.pending[ctype]:
+                        return
+                    msgs, wait = self.pick(ctype)
+                    if msgs is not None:
+                        self.sending += 1
+                        break
+                    if wait is not None and throttled is None:
+                        throttled = time.time()
+                    self.cond.wait(wait)
+                if throttled is not None:
+                    Observe('sendqueue_throttle', time.time() - throttled,
+                            ctype=ctype)
+
+            try:
+                self.sendMessages(ctype, session, msgs)
+            finally:
+                with self.cond:
+                    self.sending -= 1
+                    self.cond.notify_all()
+
+    # 发送 msgs 合并后的第一个分片，其余部分放回队列
+    def sendMessages(self, ctype, session, msgs):
+        msgs = [m for m in msgs
+                if m.started or m.future.set_running_or_notify_cancel()]
+        if not msgs:
+            return
+
+        if len(msgs) > 1:
+            Inc('sendqueue_coalesced', len(msgs) - 1, ctype=ctype)
+
+        m = msgs[0]
+        origins = [o for m2 in msgs for o in m2.origins]
+        front, rest = Partition('\n'.join(m2.content for m2 in msgs))
+        try:
+            result = self.send(session, m.contact, front, m.resendOn1202)
+        except Exception as e:
+            result = '错误：向 %s 发消息失败 %s' % (m.contact, e)
+            ERROR(result, exc_info=True)
+
+        if result is None and rest:
+            m2 = outMessage(m.contact, rest, m.resendOn1202)
+            m2.origins, m2.started = origins, True
+            with self.cond:
+                self.pending[ctype].appendleft(m2)
+                self.cond.notify_all()
+            return
+
+        result = result or ('向 %s 发消息成功' % (m.contact,))
+        now = time.time()
+        for o in origins:
+            Observe('sendqueue_wait', now - o.t, ctype=ctype)
+            o.future.set_result(result)
+
+    # 发送一个分片，成功时返回 None ，否则返回错误信息
+    def send(self, session, contact, content, resendOn1202):
+        epCodes = resendOn1202 and [0] or [0, 1202]
+        try:
+            session.send(contact.ctype, contact.uin, content, epCodes)
+        except Exception as e:
+            result = '错误：向 %s 发消息失败 %s' % (str(contact), e)
+            ERROR(result, exc_info=(not isinstance(e, RequestError)))
+            return result
+        else:
+            INFO('向 %s 发消息成功：%s' % (contact, content))
+            Inc('sendqueue_sent', ctype=contact.ctype)
+            return None
+
+if __name__ == '__main__':
+    # 使用本地的 MockSmartQQ 服务器测试发送队列
+    import tempfile
+    from qqbot.qconf import QConf
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.qcontactdb.contactdb import ContactDB
+    from qqbot.metrics import Report
+
+    server = MockSmartQQ(pollHold=0.1)
+    server.Start()
+
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    session.Login(QConf(['-b', tempfile.mkdtemp(), '-q', '']))
+
+    sq = SendQueue(session)
+    buddies = [ContactDB.NullContact('buddy', str(1000+i)) for i in range(3)]
+    group = ContactDB.NullContact('group', '2000')
+
+    t = time.time()
+    futures = [sq.SendTo(buddies[i % 3], 'hello %d' % i) for i in range(30)]
+    futures += [sq.SendTo(group, 'hi %d' % i) for i in range(10)]
+    print('enqueued 40 messages in %.4f s' % (time.time() - t))
+    for f in futures:
+        f.result()
+    print('sent in %.2f s, %d requests' % (time.time() - t, len(server.sent)))
+    print(Report('sendqueue'))
+
+    # 一条 8 个分片的长消息不会阻塞发给其他联系人的消息
+    long = ' '.join('word%04d' % i for i in range(640))
+    t = time.time()
+    f1 = sq.SendTo(buddies[1], long)
+    time.sleep(0.05)
+    f2 = sq.SendTo(buddies[2], 'short')
+    f2.result()
+    print('short message after a long one: %.2f s' % (time.time() - t))
+    f1.result()
+    print('long message (%d chunks): %.2f s' %
+          (len(STR2BYTES(long)) // COALESCE_LIMIT + 1, time.time() - t))
+
+    # Stop 之前放入队列的消息仍会发送， Stop 之后放入的消息返回错误
+    futures = [sq.SendTo(buddies[0], 'bye %d' % i) for i in range(5)]
+    sq.Stop()
+    futures.append(sq.SendTo(buddies[0], 'too late'))
+    print('flushed: %s' % sq.Flush())
+    print([f.result() for f in futures])
+    server.Stop()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+# onQQMessage 回调函数的过滤条件及分派索引
+#
+# 插件可以在注册 onQQMessage 时声明过滤条件，只有满足条件的消息才会调用该函数：
+#
+#     @qqbotslot(ctype='group', uin=('123', '456'), prefix='-')
+#     def onQQMessage(bot, contact, member, content):
+#         ...
+#
+#   ctype  : 'buddy'/'group'/'discuss' 或其元组
+#   uin    : 联系人的 uin （或其元组/列表）
+#   qq     : 联系人的 qq 号码（或其元组/列表）
+#   prefix : 消息内容的前缀（或其元组），注意被 @ 时消息内容以 '[@ME] ' 开头
+#   regex  : 正则表达式（字符串或已编译的对象），用 re.search 匹配消息内容
+#
+# SlotIndex 按 (ctype, uin) 预先建立索引，每条消息只需查找两个列表（指定了该联系人
+# 的函数、未指定联系人的函数），再对其中的函数检查 qq/prefix/regex 条件。未声明过滤
+# 条件的函数对所有消息都会被调用。所有函数仍按注册的顺序调用。
+#
+# 设置了 concurrent=True 的 onQQMessage 函数不在主线程中调用，而是交给 SlotRunner ：
+#   1) 最多 maxWorkers 个工作线程，同一函数处理同一联系人的消息时保持消息的顺序，
+#      不同函数、不同联系人之间互不阻塞
+#   2) 一次调用超过 timeout 秒未返回时，报告并跳过这次调用（该线程不再计入工作线程
+#      数，后续消息由其他线程处理）；同一函数有 maxHung 次调用未返回时，跳过发给
+#      这个函数的新消息，直到其中一次调用返回
+#
+# 运行指标： plugin_timeouts{plugin,slot[,qq]} 、 plugin_skipped{plugin,slot[,qq]} 、
+#            slotrunner_workers 、 slotrunner_depth
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import re, time, threading, collections
+
+from qqbot.utf8logger import WARN, INFO
+from qqbot.common import StartDaemonThread
+from qqbot.metrics import Inc, SetGauge
+
+CTYPES = ('buddy', 'group', 'discuss')
+
+def strTuple(x):
+    if x is None:
+        return None
+    elif isinstance(x, (tuple, list, set, frozenset)):
+        return tuple(str(i) for i in x)
+    else:
+        return (str(x),)
+
+class SlotFilter(object):
+    def __init__(self, ctype=None, uin=None, qq=None, prefix=None, regex=None):
+        self.ctype = strTuple(ctype)
+        if self.ctype is not None:
+            for t in self.ctype:
+                if t not in CTYPES:
+                    raise ValueError('错误的联系人类型：%s' % t)
+        self.uin = strTuple(uin)
+        self.qq = strTuple(qq)
+        self.prefix = strTuple(prefix)
+        if regex is None or hasattr(regex, 'search'):
+            self.regex = regex
+        else:
+            self.regex = re.compile(regex)
+
+    # ctype/uin 之外的条件，在按索引找到函数后检查
+    def Match(self, contact, content):
+        return (self.qq is None or contact.qq in self.qq) and \
+               (self.prefix is None or content.startswith(self.prefix)) and \
+               (self.regex is None or self.regex.search(content) is not None)
+
+    def __repr__(self):
+        return 'SlotFilter(%s)' % ', '.join(
+            '%s=%r' % (k, v) for k, v in sorted(self.__dict__.items())
+            if v is not None
+        )
+
+def GetFilter(func):
+    return getattr(func, 'slotFilter', None)
+
+class SlotIndex(object):
+    def __init__(self, slots):
+        self.slots = slots
+        self.index = None
+
+    # 注册/注销回调函数后调用，下次分派时重建索引
+    def Invalidate(self):
+        self.index = None
+
+    def build(self):
+        # index[ctype][uin] = [(i, func, filter), ...] ， uin 为 None 表示不限联系人
+        index = dict((ctype, {None: []}) for ctype in CTYPES)
+        for i, func in enumerate(self.slots):
+            f = GetFilter(func)
+            entry = (i, func, f)
+            for ctype in (f and f.ctype or CTYPES):
+                d = index[ctype]
+                for uin in (f and f.uin or (None,)):
+                    d.setdefault(uin, []).append(entry)
+        self.index = index
+        return index
+
+    # 返回需要对此消息调用的函数列表（按注册顺序）
+    def Lookup(self, contact, content):
+        index = self.index or self.build()
+        d = index.get(contact.ctype)
+        if d is None:
+            return []
+        a, b = d[None], d.get(contact.uin)
+        if b:
+            a = sorted(a + b, key=lambda entry: entry[0])
+        return [func for i, func, f in a
+                if f is None or f.Match(contact, content)]
+
+    def __len__(self):
+        return len(self.slots)
+
+def funcName(func):
+    return '%s.%s' % (func.__module__, func.__name__)
+
+# 插件函数的运行指标的标签
+def funcLabels(func):
+    return {'plugin': func.__module__, 'slot': func.__name__}
+
+class slotCall(object):
+    def __init__(self, key, func, args, timeout):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.timeout = timeout
+        self.deadline = None
+
+class SlotRunner(object):
+
+    maxWorkers = 8
+    maxHung = 3
+    idleTimeout = 60
+
+    def __init__(self, run, labels=funcLabels):
+        # run(func, *args) 在工作线程中被调用， labels(func) 返回运行指标的标签
+        self.run = run
+        self.labels = labels
+        self.cond = threading.Condition()
+        self.lanes = {}
+        self.ready = collections.deque()
+        self.running = {}
+        self.hung = collections.defaultdict(int)
+        self.workers = self.idle = self.depth = 0
+        self.watching = self.stopped = False
+
+    # 在主线程中调用，立即返回
+    def Submit(self, key, func, args, timeout):
+        key = (func, key)
+        with self.cond:
+            if self.stopped:
+                return
+            if self.hung[func] >= self.maxHung:
+                WARN('插件函数 %s 有 %d 次调用未返回，跳过本条消息',
+                     funcName(func), self.hung[func])
+                Inc('plugin_skipped', **self.labels(func))
+                return
+            lane = self.lanes.get(key)
+            if lane is None:
+                lane = self.lanes[key] = collections.deque()
+            lane.append(slotCall(key, func, args, timeout))
+            if len(lane) == 1 and key not in self.running:
+                self.ready.append(key)
+            self.depth += 1
+            SetGauge('slotrunner_depth', self.depth)
+            self.spawn()
+            self.cond.notify()
+            if not self.watching:
+                self.watching = True
+                StartDaemonThread(self.watch)
+
+    def Stop(self):
+        with self.cond:
+            self.stopped = True
+            self.lanes.clear()
+            self.ready.clear()
+            self.depth = 0
+            self.cond.notify_all()
+
+    # 在 self.cond 内调用
+    def spawn(self):
+        n = min(len(self.ready) - self.idle, self.maxWorkers - self.workers)
+        for i in range(n):
+            self.workers += 1
+            StartDaemonThread(self.work)
+        SetGauge('slotrunner_workers', self.workers)
+
+    # 在 self.cond 内调用，结束（或跳过）一次调用后安排同一 lane 的下一条消息
+    def next(self, key):
+        lane = self.lanes.get(key)
+        if lane is None:
+            return
+        lane.popleft()
+        self.depth -= 1
+        SetGauge('slotrunner_depth', self.depth)
+        if lane:
+            self.ready.append(key)
+            self.cond.notify()
+        else:
+            del self.lanes[key]
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    if self.stopped:
+                        self.workers -= 1
+                        return
+                    self.idle += 1
+                    t = time.time()
+                    self.cond.wait(self.idleTimeout)
+                    self.idle -= 1
+                    if not self.ready and \
+                            time.time() - t >= self.idleTimeout:
+                        self.workers -= 1
+                        SetGauge('slotrunner_workers', self.workers)
+                        return
+                key = self.ready.popleft()
+                call = self.lanes[key][0]
+                call.deadline = time.time() + call.timeout
+                self.running[key] = call
+
+            self.run(call.func, *call.args)
+
+            with self.cond:
+                if self.running.get(key) is call:
+                    del self.running[key]
+                    self.next(key)
+                    continue
+
+                # 这次调用已被 watch 跳过，本线程已不计入工作线程数
+                self.hung[call.func] -= 1
+                INFO('插件函数 %s 的一次超时调用已返回', funcName(call.func))
+                if self.stopped or self.workers >= self.maxWorkers:
+                    return
+                self.workers += 1
+                SetGauge('slotrunner_workers', self.workers)
+
+    def watch(self):
+        while not self.stopped:
+            time.sleep(0.5)
+            with self.cond:
+                now = time.time()
+                for key, call in list(self.running.items()):
+                    if now < call.deadline:
+                        continue
+                    WARN('插件函数 %s 处理消息超过 %s 秒仍未返回，跳过此次调用',
+                         funcName(call.func), call.timeout)
+                    Inc('plugin_timeouts', **self.labels(call.func))
+                    del self.running[key]
+                    self.hung[call.func] += 1
+                    self.workers -= 1
+                    self.next(key)
+                self.spawn()
+
+if __name__ == '__main__':
+    # 比较逐个调用全部 40 个函数和按索引分派的耗时
+    import time
+    from qqbot.qcontactdb.contactdb import ContactDB
+
+    calls = [0]
+    def makeSlot(**kwargs):
+        def onQQMessage(bot, contact, member, content):
+            calls[0] += 1
+            if kwargs:
+                f = onQQMessage.slotFilter
+                if (f.ctype and contact.ctype not in f.ctype) or \
+                        (f.uin and contact.uin not in f.uin) or \
+                        not f.Match(contact, content):
+                    return
+        if kwargs:
+            onQQMessage.slotFilter = SlotFilter(**kwargs)
+        return onQQMessage
+
+    slots = [makeSlot(ctype='group', uin=str(1000+i)) for i in range(30)]
+    slots += [makeSlot(prefix='-cmd%d' % i) for i in range(8)]
+    slots += [makeSlot(), makeSlot(regex=r'\d{6}')]
+    index = SlotIndex(slots)
+
+    contacts = [ContactDB.NullContact('group', str(1000+i)) for i in range(60)]
+    msgs = [(contacts[i % 60], 'hello %d' % i) for i in range(20000)]
+
+    for name, dispatch in [
+        ('call all', lambda c, m: slots),
+        ('indexed', index.Lookup)
+    ]:
+        calls[0] = 0
+        t = time.time()
+        for contact, content in msgs:
+            for f in dispatch(contact, content):
+                f(None, contact, None, content)
+        t = time.time() - t
+        print('%-8s %.3f s, %.2f calls/msg' %
+              (name, t, calls[0] / float(len(msgs))))
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# HTTP-API 的批量命令（ POST /batch ）
+#
+# 请求的 body 为命令数组，或 {"items": 命令数组, "parallel": 并行数} ，每个命令为
+# 参数数组（如 ["send", "buddy", "jack", "hello"] ）或
+# {"args": 参数数组, "key": 幂等键} 。
+#   1) 最多 parallel （默认 4 ，不超过 maxParallel ）个命令同时执行：
+#      send 命令在批量任务的线程中查找联系人（见 termbot.sendView ）并放入发送队列
+#      （见 sendqueue.py ），等待发送完成，不占用主线程；只读命令同样在批量任务的
+#      线程中执行；其他命令（如 group-shut ）交给主线程执行
+#   2) 每个命令执行完后立即返回一行结果（ NDJSON ）：
+#      {"index": 序号, "key": 幂等键, "result": ..., "err": ..., "replayed": false}
+#      最后一行为 {"done": 成功数, "failed": 失败数}
+#   3) 带有幂等键的命令执行成功后，其结果保留 keyTTL 秒，期间再次提交同一个键的命令
+#      （如网络中断后重试整个批量任务）不会重复执行，而是直接返回上次的结果
+#      （ "replayed": true ）；同一个键的命令正在执行时，等待并共用其结果。失败的
+#      结果不保留，重试时重新执行
+#
+# 运行指标： termbatch_items{status} 、 termbatch_replayed
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, threading, collections
+
+from concurrent.futures import Future
+
+from qqbot.utf8logger import ERROR
+from qqbot.common import StartDaemonThread, Queue
+from qqbot.mainloop import PutTask
+from qqbot.metrics import Inc
+from qqbot.termbot import cmdFuncs, RunTermCommand, READONLY_CMDS, sendView
+from qqbot.qcontactdb import NotInDB
+
+class BatchError(Exception):
+    pass
+
+# 幂等键 -> Future ，见文件开头的说明
+class keyStore(object):
+
+    maxKeys = 10000
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.futures = collections.OrderedDict()
+
+    # 返回 (future, owner) ， owner 为 True 时由调用者执行命令并设置结果
+    def Claim(self, key):
+        with self.lock:
+            entry = self.futures.get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry[1], False
+            self.futures.pop(key, None)
+            f = Future()
+            self.futures[key] = (float('inf'), f)
+            self.prune()
+            return f, True
+
+    def Done(self, key, f, result, failed):
+        with self.lock:
+            if failed:
+                if self.futures.get(key, (0, None))[1] is f:
+                    del self.futures[key]
+            else:
+                self.futures[key] = (time.time() + self.ttl, f)
+        f.set_result(result)
+
+    # 在 self.lock 内调用
+    def prune(self):
+        if len(self.futures) <= self.maxKeys:
+            return
+        now = time.time()
+        for key, (expires, f) in list(self.futures.items()):
+            if expires <= now:
+                del self.futures[key]
+        while len(self.futures) > self.maxKeys:
+            key, (expires, f) = next(iter(self.futures.items()))
+            if expires == float('inf'):
+                break
+            del self.futures[key]
+
+class BatchRunner(object):
+
+    maxItems = 1000
+    maxParallel = 16
+    defaultParallel = 4
+    keyTTL = 24 * 3600
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.keys = keyStore(self.keyTTL)
+
+    # 返回 [(args, key), ...], parallel 。格式错误时抛出 BatchError
+    def Parse(self, obj):
+        parallel = self.defaultParallel
+        if isinstance(obj, dict):
+            parallel = obj.get('parallel', parallel)
+            obj = obj.get('items')
+        if not isinstance(obj, list):
+            raise BatchError('批量命令必须为数组')
+        if len(obj) > self.maxItems:
+            raise BatchError('批量命令最多 %d 个' % self.maxItems)
+        if not isinstance(parallel, int) or parallel < 1:
+            raise BatchError('parallel 必须为正整数')
+
+        items = []
+        for item in obj:
+            key = None
+            if isinstance(item, dict):
+                key, item = item.get('key'), item.get('args')
+            if not isinstance(item, list) or not item or any(
+                    isinstance(x, (list, dict)) or x is None for x in item):
+                raise BatchError('第 %d 个命令格式错误' % len(items))
+            args = [x if isinstance(x, str) else str(x) for x in item]
+            items.append((args, key if key is None else str(key)))
+        return items, min(parallel, self.maxParallel)
+
+    # 在 parallel 个线程中执行 items ，按完成的顺序逐个生成
+    # (index, key, result, err, replayed) ，调用者每取得一个结果就可以发送出去
+    def Run(self, items, parallel):
+        pending = collections.deque(enumerate(items))
+        lock, results = threading.Lock(), Queue.Queue()
+
+        def work():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    index, (args, key) = pending.popleft()
+                # 每个命令都必须产生一行结果，否则 Run 将一直等待
+                try:
+                    row = self.runItem(args, key)
+                except BaseException as e:
+                    err = '运行命令过程中出错：%r' % e
+                    ERROR(err, exc_info=True)
+                    Inc('termbatch_items', status='failed')
+                    row = (None, err, False)
+                results.put((index, key) + row)
+
+        for i in range(min(parallel, len(items))):
+            StartDaemonThread(work)
+
+        for i in range(len(items)):
+            yield results.get()
+
+    # 返回 (result, err, replayed)
+    def runItem(self, args, key):
+        if key is None:
+            result, err = self.execute(args)
+        else:
+            f, owner = self.keys.Claim(key)
+            if not owner:
+                Inc('termbatch_replayed')
+                result, err = f.result()
+                return result, err, True
+            try:
+                result, err = self.execute(args)
+            except BaseException as e:
+                self.keys.Done(key, f, (None, str(e)), True)
+                raise
+            self.keys.Done(key, f, (result, err), failed(result, err))
+        Inc('termbatch_items', status=failed(result, err) and 'failed' or 'ok')
+        return result, err, False
+
+    def execute(self, args):
+        cmd = args[0]
+        if cmd == 'send':
+            return RunTermCommand(sendView(self.bot, 'batch'), args, True)
+        elif cmd in READONLY_CMDS:
+            try:
+                return RunTermCommand(self.bot.TermView(), args, True)
+            except NotInDB:
+                pass
+        elif cmd not in cmdFuncs:
+            return None, 'QQBot 命令格式错误'
+        return PutTask(RunTermCommand, (self.bot, args, True), source='batch',
+                       report=False).result()
+
+# 命令出错，或 send 命令的消息全部发送失败
+def failed(result, err):
+    if err is not None:
+        return True
+    return isinstance(result, list) and bool(result) and all(
+        isinstance(r, str) and r.startswith('错误') for r in result
+    )
+
+if __name__ == '__main__':
+    # 向 300 个群各发一条消息：逐个调用 /send （每个一个连接，在连接线程中等待发送
+    # 完成）与一次 /batch 的耗时；以及重试同一批量任务时不会重复发送
+    import tempfile, socket
+    from qqbot.qconf import QConf
+    from qqbot.qqbotcls import QQBot
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.qcontactdb.qcontactdb import QContactDB
+    from qqbot.sendqueue import SendQueue
+    from qqbot.termserver import QTermServer
+    from qqbot.mainloop import MainLoop
+    from qqbot.common import PY3, JsonDumps, JsonLoads, BYTES2STR
+    from qqbot.utf8logger import DisableLog, EnableLog
+    from qqbot.metrics import Snapshot
+
+    if PY3:
+        import http.client as httplib
+    else:
+        import httplib
+
+    server = MockSmartQQ(nGroups=300, nMembers=2, latency=0.01)
+    server.Start()
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    session.Login(QConf(['-b', tempfile.mkdtemp(), '-q', server.qq]))
+
+    # 关闭发送限速，只比较请求的往返开销
+    SendQueue.targetRate = SendQueue.globalRate = 1000.0
+    SendQueue.targetBurst = SendQueue.globalBurst = 1000
+    bot = QQBot()
+    bot.plugins = {}
+    bot.contactdb = QContactDB(session, bot)
+    bot.List = bot.contactdb.List
+    bot.SendTo = SendQueue(session).SendTo
+    bot.onUpdate = lambda *args: None
+    groups = [g.name for g in bot.List('group')]
+
+    term = QTermServer(8194, bot)
+    StartDaemonThread(term.Run)
+    StartDaemonThread(MainLoop)
+    time.sleep(0.5)
+
+    DisableLog()
+    t = time.time()
+    for name in groups[:100]:
+        sock = socket.create_connection(('127.0.0.1', 8194))
+        sock.sendall(('GET /send/group/%s/hello HTTP/1.1\r\n'
+                      'Connection: close\r\n\r\n' % name).encode('utf8'))
+        while sock.recv(65536):
+            pass
+        sock.close()
+    print('100 x /send     %.2f s, %s' % (time.time() - t,
+                                          Snapshot('termserver_requests')))
+
+    body = JsonDumps({'parallel': 8, 'items': [
+        {'args': ['send', 'group', name, 'hello'], 'key': 'notify-' + name}
+        for name in groups
+    ]})
+    for attempt in ('batch', 'retry'):
+        del server.sent[:]
+        t = time.time()
+        conn = httplib.HTTPConnection('127.0.0.1', 8194)
+        conn.request('POST', '/batch', body)
+        lines = BYTES2STR(conn.getresponse().read()).splitlines()
+        replayed = sum(1 for l in lines if JsonLoads(l).get('replayed'))
+        print('300 x %-9s %.2f s, %d sent, %d replayed, last line %s' %
+              (attempt, time.time() - t, len(server.sent), replayed,
+               lines[-1]))
+    EnableLog()
+    server.Stop()
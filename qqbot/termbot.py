@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
 from qqbot.utf8logger import ERROR
-from qqbot.mainloop import Put
+from qqbot.mainloop import Put, PutTask
 from qqbot.common import Unquote, STR2BYTES, JsonDumps, BYTES2STR
+from qqbot.metrics import Report, Snapshot
+from qqbot.qcontactdb import NotInDB
 
 cmdFuncs, usage = {}, {}
 
+# 只读命令，由 term 服务器直接在连接线程中执行（见 TermBot.TermView ），不经过主线程
+READONLY_CMDS = ('help', 'list', 'plugins', 'stats')
+
 class TermBot(object):
 
+    # 旧的接口： command 为 qq 命令行工具发来的命令或 HTTP GET 请求，返回应答
     def onTermCommand(bot, command):
         command = BYTES2STR(command)
         if command.startswith('GET /'):
@@ -23,15 +29,8 @@ class TermBot(object):
         else:
             http = False
             argv = command.strip().split(None, 3)
-    
-        if argv and argv[0] in cmdFuncs:
-            try:
-                result, err = cmdFuncs[argv[0]](bot, argv[1:], http)
-            except Exception as e:
-                result, err = None, '运行命令过程中出错：' + str(type(e)) + str(e)
-                ERROR(err, exc_info=True)
-        else:
-            result, err = None, 'QQBot 命令格式错误'
+
+        result, err = RunTermCommand(bot, argv, http)
         
         if http:
             rep = {'result':result, 'err': err}
@@ -46,6 +45,59 @@ class TermBot(object):
     
         return rep
 
+    # 只读命令使用的视图，可在任意线程中使用：联系人直接从数据库中读取（见
+    # QContactDB.View ），插件列表及运行指标读取时复制
+    def TermView(bot):
+        return termView(bot)
+
+# argv: [命令, 参数1, ...] ，返回 (result, err) 。 bot 为 TermView 时，所需的联系人
+# 列表不在数据库中则抛出 NotInDB ，由调用者改到主线程中执行
+def RunTermCommand(bot, argv, http=False):
+    if argv and argv[0] in cmdFuncs:
+        try:
+            return cmdFuncs[argv[0]](bot, argv[1:], http)
+        except NotInDB:
+            raise
+        except Exception as e:
+            err = '运行命令过程中出错：' + str(type(e)) + str(e)
+            ERROR(err, exc_info=True)
+            return None, err
+    else:
+        return None, 'QQBot 命令格式错误'
+
+# HTTP-API 的分页 list （见 DBDisplayer.PageOfList ），返回 (listPage, err) 。与
+# RunTermCommand 一样， bot 为 TermView 时可能抛出 NotInDB
+def ListPage(bot, args, cursor=None, limit=None, fields=None):
+    if ((len(args) in (1, 2)) and args[0] in ('buddy', 'group', 'discuss')) or \
+            ((len(args) in (2, 3)) and args[1] and
+             (args[0] in ('group-member', 'discuss-member'))):
+        return bot.PageOfList(*args, cursor=cursor, limit=limit, fields=fields)
+    else:
+        return None, 'QQBot 命令格式错误'
+
+class termView(object):
+    def __init__(self, bot):
+        view = bot.contactdb.View()
+        self.List, self.StrOfList, self.ObjOfList, self.PageOfList = \
+            view.List, view.StrOfList, view.ObjOfList, view.PageOfList
+        self.Plugins, self.PluginStats = bot.Plugins, bot.PluginStats
+
+# send 命令使用的 bot ，可在任意线程中使用：在当前线程中查找联系人，数据库中没有时
+# 交给主线程查找；在当前线程中等待消息发送完毕，不占用主线程
+class sendView(object):
+    def __init__(self, bot, source='term'):
+        self.bot = bot
+        self.view = bot.contactdb.View()
+        self.source = source
+        self.SendTo = bot.SendTo
+
+    def List(self, tinfo, cinfo=None):
+        try:
+            return self.view.List(tinfo, cinfo)
+        except NotInDB:
+            return PutTask(self.bot.List, (tinfo, cinfo), source=self.source,
+                           report=False).result()
+
 def cmd_help(bot, args, http=False):
     '''1 help'''
     if len(args) == 0:
@@ -78,8 +130,8 @@ def cmd_fresh_restart(bot, args, http=False):
         return None, 'QQBot 命令格式错误'
 
 def cmd_list(bot, args, http=False):
-    '''2 list buddy|group|discuss [qq|name|key=val]
-       2 list group-member|discuss-member oqq|oname|okey=oval [qq|name|key=val]'''
+    '''2 list buddy|group|discuss [qq|name|key=val|:fuzzy:text]
+       2 list group-member|discuss-member oqq|oname|okey=oval [qq|name|key=val|:fuzzy:text]'''
     
     if (len(args) in (1, 2)) and args[0] in ('buddy', 'group', 'discuss'):
         # list buddy
@@ -92,6 +144,7 @@ def cmd_list(bot, args, http=False):
     elif (len(args) in (2, 3)) and args[1] and (args[0] in ('group-member', 'discuss-member')):
         # list group-member xxx班
         # list group-member xxx班 yyy
+        # list group-member xxx班 :fuzzy:yyy
         if not http:
             return bot.StrOfList(*args), None
         else:
@@ -131,7 +184,7 @@ def cmd_send(bot, args, http=False):
             return None, '%s-%s 不存在' % (args[0], args[1])
         else:
             msg = args[2].replace('\\n','\n').replace('\\t','\t')
-            result = [bot.SendTo(c, msg) for c in cl]
+            result = [f.result() for f in [bot.SendTo(c, msg) for c in cl]]
             if not http:
                 result = '\n'.join(result)
             return result, None
@@ -152,7 +205,7 @@ def group_operation(bot, ginfo, minfos, func, exArgs, http):
         for minfo in minfos:
             ml = bot.List(g, minfo)
             if ml is None:
-                membsResult.append('错误：向 QQ 服务器请求%s的成员列表失败' % g)
+                membsResult.append('错误：向 QQ 服务器请求%s的成员列表失败' % (g,))
             elif not ml:
                 membsResult.append('错误：%s[成员“%s”]不存在' % (g, minfo))
             else:
@@ -246,12 +299,36 @@ def cmd_unplug(bot, args, http=False):
         return None, 'QQBot 命令格式错误'
 
 def cmd_plugins(bot, args, http=False):
-    '''5 plugins'''
-    if len(args) == 0:
+    '''5 plugins [stats]'''
+    if len(args) == 0 and http:
+        return bot.Plugins(), None
+    elif len(args) == 0 or args == ['stats']:
+        stats = bot.PluginStats()
+        if http:
+            return stats, None
+        lines = ['已加载插件：%s' % bot.Plugins()]
+        for name, funcs in sorted(stats.items()):
+            for funcName, st in sorted(funcs.items()):
+                lines.append(
+                    '  %s.%s 调用 %d 次，出错 %d 次，超时 %d 次，跳过 %d 次，'
+                    '耗时 avg=%.1fms p99=%.1fms max=%.1fms' % (
+                        name, funcName, st['calls'], st['errors'],
+                        st['timeouts'], st['skipped'],
+                        st['avg']*1000, st['p99']*1000, st['max']*1000
+                    )
+                )
+        return '\n'.join(lines), None
+    else:
+        return None, 'QQBot 命令格式错误'
+
+def cmd_stats(bot, args, http=False):
+    '''7 stats [prefix]'''
+    if len(args) in (0, 1):
+        prefix = args and args[0] or ''
         if not http:
-            return '已加载插件：%s' % bot.Plugins(), None
+            return Report(prefix), None
         else:
-            return bot.Plugins(), None
+            return Snapshot(prefix), None
     else:
         return None, 'QQBot 命令格式错误'
                     
@@ -265,8 +342,8 @@ QQBot 命令：
     qq help|stop|restart
 
 2） 联系人查询命令
-    qq list buddy|group|discuss [qq|name|key=val]
-    qq list group-member|discuss-member oqq|oname|okey=oval [qq|name|key=val]
+    qq list buddy|group|discuss [qq|name|key=val|:fuzzy:text]
+    qq list group-member|discuss-member oqq|oname|okey=oval [qq|name|key=val|:fuzzy:text]
 
 3） 联系人更新命令
     qq update buddy|group|discuss
@@ -285,5 +362,8 @@ QQBot 命令：
 
 6） 加载/卸载/显示插件
     qq plug/unplug myplugin
-    qq plugins\
+    qq plugins [stats]
+
+7） 运行指标（请求重试、熔断等）
+    qq stats [prefix]\
 '''
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+# HTTP-API 的消息推送（ GET /events ， Server-Sent Events ）
+#
+# 外部程序不需要编写插件，连接到 /events 即可实时收到 QQBot 收到的消息，如：
+#     GET /events?ctype=group,discuss&uin=2001,2002&overflow=close
+#   1) 每条消息（见 QQBot.onPollComplete ）推送为一个 SSE 事件：
+#          id: 启动时间-序号
+#          event: message
+#          data: {"qq": 本账号, "ctype": ..., "contact": {...}, "member": {...},
+#                 "content": ..., "received": 收到消息的时间, "time": 推送的时间}
+#      连接空闲 heartbeat 秒时发送一行注释（ ": ping" ），以便及时发现已断开的连接
+#   2) 过滤条件（均可用逗号分隔多个值，省略表示不过滤）： ctype 、 uin （联系人的
+#      uin ）、 qq （联系人的 QQ 号）
+#   3) 每个订阅者有一个长度为 buffer （默认 maxBuffer ）的缓冲区，主线程只把事件放入
+#      缓冲区，从不等待订阅者。缓冲区满时按 overflow 处理：
+#        drop-oldest （默认）：丢弃最早的事件
+#        drop-newest         ：丢弃新的事件
+#        close               ：发送完缓冲区中的事件后断开连接。客户端带上
+#                              Last-Event-ID 重新连接时（ EventSource 会自动这样
+#                              做），从最近 historySize 个事件中补发其后的事件
+#      丢弃了事件时，推送 event: dropped ， data: {"dropped": 丢弃的事件数}
+#   4) 最多 maxSubscribers 个订阅者，超出时返回 503
+#
+# 运行指标： termpush_subscribers 、 termpush_published 、
+#            termpush_dropped{overflow} 、 termpush_closed
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import time, threading, collections
+
+from qqbot.common import JsonDumps, STR2BYTES
+from qqbot.metrics import Inc, SetGauge
+
+OVERFLOWS = ('drop-oldest', 'drop-newest', 'close')
+
+FILTERS = ('ctype', 'uin', 'qq')
+
+class PushError(Exception):
+    pass
+
+# seq: 序号， attrs: 用于过滤的属性， frame: 编码好的 SSE 事件
+pushEvent = collections.namedtuple('pushEvent', 'seq attrs frame')
+
+class subscriber(object):
+    def __init__(self, filters, size, overflow):
+        self.filters = filters
+        self.size = size
+        self.overflow = overflow
+        self.cond = threading.Condition()
+        self.buf = collections.deque()
+        self.dropped = 0
+        self.closed = False
+
+    def match(self, event):
+        attrs = event.attrs
+        for key, values in self.filters.items():
+            if attrs.get(key) not in values:
+                return False
+        return True
+
+    # 主线程（或 EventHub.Subscribe 补发事件时），不会等待
+    def put(self, event):
+        with self.cond:
+            if self.closed:
+                return
+            if len(self.buf) >= self.size:
+                if self.overflow == 'close':
+                    self.closed = True
+                    Inc('termpush_closed')
+                    self.cond.notify()
+                    return
+                self.dropped += 1
+                Inc('termpush_dropped', overflow=self.overflow)
+                if self.overflow == 'drop-newest':
+                    return
+                self.buf.popleft()
+            self.buf.append(event)
+            self.cond.notify()
+
+    # 连接线程，返回 (事件列表, 丢弃数) ，等待 timeout 秒仍没有事件时两者均为空；
+    # 已关闭且缓冲区中的事件已全部取出时返回 None
+    def get(self, timeout):
+        with self.cond:
+            if not self.buf and not self.dropped and not self.closed:
+                self.cond.wait(timeout)
+            if not self.buf and not self.dropped and self.closed:
+                return None
+            events, dropped = list(self.buf), self.dropped
+            self.buf.clear()
+            self.dropped = 0
+            return events, dropped
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+class EventHub(object):
+
+    maxSubscribers = 32
+    maxBuffer = 256
+    historySize = 1024
+    heartbeat = 15
+
+    def __init__(self):
+        self.epoch = '%x' % int(time.time())
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.history = collections.deque(maxlen=self.historySize)
+        self.subscribers = []
+
+    # 主线程， QQBot.onPollComplete 调用
+    def Publish(self, qq, contact, member, content, received=None):
+        now = time.time()
+        cdict = contact.__dict__
+        data = JsonDumps({
+            'qq': qq, 'ctype': contact.ctype, 'contact': cdict,
+            'member': getattr(member, '__dict__', None), 'content': content,
+            'received': received or now, 'time': now
+        }, ensure_ascii=False)
+        attrs = {'ctype': contact.ctype, 'uin': contact.uin,
+                 'qq': cdict.get('qq')}
+
+        with self.lock:
+            self.seq += 1
+            event = pushEvent(self.seq, attrs, STR2BYTES(
+                'id: %s-%d\nevent: message\ndata: %s\n\n' %
+                (self.epoch, self.seq, data)
+            ))
+            self.history.append(event)
+            subscribers = list(self.subscribers)
+        Inc('termpush_published')
+
+        for sub in subscribers:
+            if sub.match(event):
+                sub.put(event)
+
+    # 连接线程。 params 为 {参数名: [值, ...]} ，参数错误时抛出 PushError ，订阅者
+    # 过多时返回 None
+    def Subscribe(self, params, lastEventId=None):
+        filters = {}
+        for key in FILTERS:
+            if params.get(key):
+                filters[key] = set(params[key])
+
+        overflow = (params.get('overflow') or [OVERFLOWS[0]])[0]
+        if overflow not in OVERFLOWS:
+            raise PushError('overflow 必须为 %s 之一' % '、'.join(OVERFLOWS))
+
+        try:
+            size = int((params.get('buffer') or [self.maxBuffer])[0])
+        except ValueError:
+            size = 0
+        if not 0 < size <= self.historySize:
+            raise PushError('buffer 必须为 1 ~ %d 之间的整数' % self.historySize)
+
+        sub = subscriber(filters, size, overflow)
+        with self.lock:
+            if len(self.subscribers) >= self.maxSubscribers:
+                return None
+            events, lost = self.missed(lastEventId)
+            sub.dropped = lost
+            for event in events:
+                if sub.match(event):
+                    sub.put(event)
+            self.subscribers.append(sub)
+            SetGauge('termpush_subscribers', len(self.subscribers))
+        return sub
+
+    # 在 self.lock 内调用，返回 Last-Event-ID 之后的事件，以及已不在 history 中的
+    # 事件数（未经过滤，是实际丢失的事件数的上限）
+    def missed(self, lastEventId):
+        try:
+            epoch, seq = lastEventId.rsplit('-', 1)
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return [], 0
+
+        # 重启前的事件已无法补发
+        if epoch != self.epoch or seq >= self.seq:
+            return [], 0
+
+        events = [e for e in self.history if e.seq > seq]
+        return events, events[0].seq - seq - 1
+
+    def Unsubscribe(self, sub):
+        sub.close()
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+            SetGauge('termpush_subscribers', len(self.subscribers))
+
+    # 关闭所有订阅者的连接
+    def Close(self):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for sub in subscribers:
+            sub.close()
+
+    # 连接线程，生成要发送给订阅者的数据，订阅者被关闭后结束
+    def Stream(self, sub):
+        yield b'retry: 3000\n\n'
+        while True:
+            got = sub.get(self.heartbeat)
+            if got is None:
+                return
+            events, dropped = got
+            if dropped:
+                yield STR2BYTES('event: dropped\ndata: {"dropped": %d}\n\n' %
+                                dropped)
+            if events:
+                yield b''.join(e.frame for e in events)
+            elif not dropped:
+                yield b': ping\n\n'
+
+if __name__ == '__main__':
+    # 1) 主线程推送一个事件的耗时：没有订阅者、 32 个订阅者（其中一个不读取）
+    # 2) 通过 QQBot-Term 服务器订阅 MockSmartQQ 推送的群消息（带过滤条件），以及
+    #    overflow=close 断开后带 Last-Event-ID 重连时补发的事件
+    import tempfile, socket
+    from qqbot.qconf import QConf
+    from qqbot.qqbotcls import QQBot
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.qcontactdb.qcontactdb import QContactDB
+    from qqbot.termserver import QTermServer
+    from qqbot.mainloop import MainLoop, PutTask
+    from qqbot.common import StartDaemonThread, BYTES2STR, JsonLoads
+    from qqbot.utf8logger import DisableLog, EnableLog
+
+    server = MockSmartQQ(nGroups=3, nMembers=5)
+    server.Start()
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    conf = QConf(['-b', tempfile.mkdtemp(), '-q', server.qq])
+    session.Login(conf)
+
+    bot = QQBot()
+    bot.conf = conf
+    bot.plugins = {}
+    bot.contactdb = QContactDB(session, bot)
+    bot.onUpdate = lambda *args: None
+    group = bot.contactdb.List('group')[0]
+    member = bot.contactdb.List(group)[0]
+
+    hub = EventHub()
+    for n in (0, 32):
+        for i in range(n):
+            sub = hub.Subscribe({'buffer': ['100']})
+            if i:
+                StartDaemonThread(lambda s: [x for x in hub.Stream(s)], sub)
+        t = time.time()
+        for i in range(10000):
+            hub.Publish(server.qq, group, member, 'hello %d' % i)
+        print('Publish, %2d subscribers: %5.1f us/event' %
+              (n, (time.time() - t) * 100))
+    hub.Close()
+
+    bot.findSender = bot.contactdb.FindSender
+    bot.onQQMessage = lambda *args: None
+    bot.detectAtMe = lambda *args: False
+    bot.termServer = term = QTermServer(8195, bot)
+    StartDaemonThread(term.Run)
+    StartDaemonThread(MainLoop)
+    time.sleep(0.5)
+
+    def subscribe(query, lastEventId=None):
+        sock = socket.create_connection(('127.0.0.1', 8195))
+        sock.sendall(STR2BYTES('GET /events?%s HTTP/1.1\r\n%s\r\n' % (
+            query, lastEventId and 'Last-Event-ID: %s\r\n' % lastEventId or ''
+        )))
+        return sock, sock.makefile('rb')
+
+    # 只读取 data 行，遇到空行时结束一个事件
+    def events(f, n):
+        got, event = [], {}
+        while len(got) < n:
+            line = BYTES2STR(f.readline())
+            if not line:
+                break
+            line = line.rstrip('\r\n')
+            if ':' in line and not line.startswith(':'):
+                k, v = line.split(':', 1)
+                event[k] = v.strip()
+            elif not line:
+                if event.get('data'):
+                    got.append(event)
+                event = {}
+        return got
+
+    DisableLog()
+    sock, f = subscribe('ctype=group&uin=%s&buffer=3&overflow=close' % group.uin)
+    time.sleep(0.2)
+    for i in range(10):
+        bot.onPollItem('group', group.uin, member.uin, 'msg%d' % i)
+    bot.onPollItem('buddy', '1000001', '', 'not for this subscriber')
+    time.sleep(0.5)
+    got = events(f, 10)
+    print('before close: %s' % [JsonLoads(e['data'])['content'] for e in got])
+    sock.close()
+
+    sock, f = subscribe('ctype=group&uin=%s' % group.uin, got[-1]['id'])
+    got = events(f, 10 - len(got))
+    print('after reconnect: %s' % [JsonLoads(e['data'])['content'] for e in got])
+    sock.close()
+    EnableLog()
+    server.Stop()
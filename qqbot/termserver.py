@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+
+# QQBot-Term 服务器（ HTTP/1.1 ）
+#
+# 同一端口同时接受两种请求：
+#   1) qq 命令行工具的原始协议：客户端发送一行命令（新版 qq 工具发送完后关闭写端，
+#      旧的客户端在 rawIdle 秒内没有更多数据时视为发送完毕），服务器返回命令的执行
+#      结果后关闭连接
+#   2) HTTP/1.1 ：
+#          GET  /send/buddy/jack/hello              （与旧版本相同，参数在 URL 中）
+#          POST /send    ["buddy", "jack", "hello"]  （参数为 JSON 数组）
+#          POST /        {"args": ["send", "buddy", "jack", "hello"]}
+#      URL 中的参数在前， body 中的参数在后， body 中的参数不需要 URL 编码。
+#      应答为 JSON ： {"result": ..., "err": ...} 。连接默认保持（ keep-alive ），
+#      超过 chunkSize 的应答以 chunked 方式边编码边发送。
+#          POST /batch   [["send", "group", "g1", "hi"], ...]
+#      批量执行命令，每个命令执行完后立即返回一行结果（见 termbatch.py ）。
+#          GET  /list/group-member/g1?limit=500&fields=uin,name&format=ndjson
+#      list 命令可带以下选项（也可放在 POST 的 body 中： {"args": [...], "limit": 500} ）：
+#        limit  ：每页最多返回的联系人数，应答中的 next 为下一页的 cursor （没有下一页
+#                 时为 null ）
+#        cursor ：从上一页的 next 之后开始
+#        fields ：只返回这些字段（逗号分隔），成员另带 owner （群/讨论组的 uin ）
+#        format ：json （默认，应答为 {"result": {"items": [...], "next": ...}} ）或
+#                 ndjson （每个联系人一行，最后一行为 {"next": ..., "count": ...} ）
+#      这种 list 按 uin 排序，联系人直接从数据库的游标中边读取边发送，不建立整个列表。
+#          GET  /events?ctype=group&uin=2001
+#      以 Server-Sent Events 推送收到的消息（见 termpush.py ）。
+#
+# 每个连接由一个线程处理（最多 maxConnections 个，超出时返回 503 ）。只读命令
+# （ termbot.READONLY_CMDS ）直接在连接线程中执行，联系人从数据库中读取（见
+# QContactDB.View ）； send 命令也在连接线程中查找联系人并等待发送结果（见
+# termbot.sendView ），只在联系人列表不在数据库中时由主线程查找；其余命令，以及
+# 需要的联系人列表不在数据库中的只读命令，交给主线程执行。
+#
+# 运行指标： termserver_requests{proto,via} 、 termserver_latency{via} 、
+#            termserver_connections 、 termserver_rejected
+
+import sys, os
+p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import socket, json, time, threading
+
+from qqbot.utf8logger import INFO, ERROR, DEBUG
+from qqbot.common import PY3, STR2BYTES, BYTES2STR, JsonLoads, JsonDumps, Unquote
+from qqbot.mainloop import PutTask
+from qqbot.metrics import Inc, Observe, SetGauge
+from qqbot.termbot import RunTermCommand, ListPage, READONLY_CMDS, sendView
+from qqbot.qcontactdb import NotInDB
+from qqbot.qterm import HOST, DEFPORT
+from qqbot.termbatch import BatchRunner, BatchError, failed
+from qqbot.termpush import EventHub, PushError
+
+if PY3:
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, TCPServer
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, TCPServer
+
+# list 命令的选项，见文件开头的说明
+LIST_OPTIONS = ('cursor', 'limit', 'fields', 'format')
+
+HTTP_METHODS = (b'GET ', b'POST ', b'HEAD ', b'PUT ', b'DELETE ', b'OPTIONS ')
+
+class QTermServer(object):
+
+    maxConnections = 64
+    keepAliveTimeout = 30
+    rawIdle = 0.2
+    maxBody = 4 * 1024 * 1024
+    chunkSize = 16 * 1024
+
+    def __init__(self, port, bot):
+        self.port = int(port or 0)
+        self.bot = bot
+        self.batch = BatchRunner(bot)
+        self.events = EventHub()
+        self.httpd = None
+        self.lock = threading.Lock()
+        self.nConnections = 0
+
+    def Run(self):
+        if not self.port:
+            INFO('QQBot-Term 服务器未开启，qq 命令和 HTTP-API 接口将无法使用')
+            return
+
+        try:
+            self.httpd = termHTTPServer((HOST, self.port), termHandler)
+        except socket.error as e:
+            ERROR('无法开启 QQBot-Term 服务器 ， %s', e)
+            ERROR('qq 命令和 HTTP-API 接口将无法使用')
+            return
+
+        self.httpd.term = self
+        INFO('已在 %s 的 %s 端口开启 QQBot-Term 服务器', HOST, self.port)
+        INFO('请在其他终端使用 qq 命令来控制 QQBot ，示例： qq send buddy jack hello')
+        self.httpd.serve_forever()
+
+    # 停止监听，已建立的连接处理完当前请求后关闭
+    def Stop(self):
+        httpd, self.httpd = self.httpd, None
+        self.events.Close()
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+            INFO('QQBot-Term 服务器已停止')
+
+    def acquire(self):
+        with self.lock:
+            if self.nConnections >= self.maxConnections:
+                return False
+            self.nConnections += 1
+            SetGauge('termserver_connections', self.nConnections)
+            return True
+
+    def release(self):
+        with self.lock:
+            self.nConnections -= 1
+            SetGauge('termserver_connections', self.nConnections)
+
+    # 在连接线程中调用，返回 (result, err)
+    def Execute(self, argv, proto):
+        t = time.time()
+        http = (proto == 'http')
+        result = None
+        if argv and argv[0] in READONLY_CMDS:
+            try:
+                result = RunTermCommand(self.bot.TermView(), argv, http)
+            except NotInDB as e:
+                DEBUG('%s 不在联系人数据库中，命令 %s 改到主线程中执行',
+                      e, argv[0])
+        elif argv and argv[0] == 'send':
+            result = RunTermCommand(sendView(self.bot), argv, http)
+
+        if result is not None:
+            via = 'view'
+        else:
+            via = 'main'
+            result = PutTask(RunTermCommand, (self.bot, argv, http),
+                             source='term', report=False).result()
+
+        Inc('termserver_requests', proto=proto, via=via)
+        Observe('termserver_latency', time.time() - t, via=via)
+        return result
+
+class termHTTPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def process_request(self, request, client_address):
+        if self.term.acquire():
+            ThreadingMixIn.process_request(self, request, client_address)
+            return
+
+        Inc('termserver_rejected')
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\n'
+                            b'Connection: close\r\nContent-Length: 0\r\n\r\n')
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.term.release()
+
+class termHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'QQBot-Term'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.term = self.server.term
+        self.connection.settimeout(self.term.keepAliveTimeout)
+        # 应答头和 body 分两次写入，避免 Nagle 算法与延迟确认使每个请求多等 40ms
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        try:
+            head = self.connection.recv(8, socket.MSG_PEEK)
+        except socket.error:
+            return
+        if head.startswith(HTTP_METHODS):
+            BaseHTTPRequestHandler.handle(self)
+        elif head:
+            self.handleRaw()
+
+    def log_message(self, format, *args):
+        DEBUG('QQBot-Term 服务器：%s %s', self.address_string(), format % args)
+
+    # qq 命令行工具的原始协议
+    def handleRaw(self):
+        sock, data = self.connection, b''
+        try:
+            while len(data) <= self.term.maxBody:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+                sock.settimeout(self.term.rawIdle)
+        except socket.timeout:
+            pass
+        except socket.error as e:
+            ERROR('QQBot-Term 服务器在接收数据时发生错误，%s', e)
+            return
+
+        argv = BYTES2STR(data).strip().split(None, 3)
+        result, err = self.term.Execute(argv, 'raw')
+        try:
+            sock.settimeout(self.term.keepAliveTimeout)
+            sock.sendall(STR2BYTES(str(err or result)) + b'\r\n')
+        except socket.error as e:
+            ERROR('QQBot-Term 服务器在发送数据时发生错误，%s', e)
+
+    def do_GET(self):
+        self.serve(None)
+
+    def do_POST(self):
+        body = self.readBody()
+        if body is not None:
+            self.serve(body)
+
+    # 返回请求的 body ，出错时返回 None （已发送错误应答）
+    def readBody(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts, size = [], 0
+            while True:
+                n = hexSize(self.rfile.readline().split(b';', 1)[0])
+                if n is None:
+                    self.sendError(400, 'chunk 的长度格式错误')
+                    return None
+                size += n
+                if size > self.term.maxBody:
+                    self.sendError(413, '请求的内容过长')
+                    return None
+                if n == 0:
+                    while self.rfile.readline().strip():
+                        pass
+                    return b''.join(parts)
+                parts.append(self.rfile.read(n))
+                self.rfile.readline()
+
+        n = (self.headers.get('Content-Length') or '0').strip()
+        if not n.isdigit():
+            self.sendError(400, 'Content-Length 格式错误')
+            return None
+        n = int(n)
+        if n > self.term.maxBody:
+            self.sendError(413, '请求的内容过长')
+            return None
+        return self.rfile.read(n)
+
+    def serve(self, body):
+        # 只有 /events 和 /list 使用查询参数，其他命令（以及查询参数不全是 list 选项
+        # 的 list 命令）的参数中可能有未编码的 "?"
+        url, x, query = self.path[1:].partition('?')
+        if url.rstrip('/') == 'events':
+            self.serveEvents(parseQuery(query))
+            return
+
+        opts = parseQuery(query)
+        if url.split('/', 1)[0] == 'list' and opts and \
+                all(k in LIST_OPTIONS for k in opts):
+            opts = dict((k, ','.join(v)) for k, v in opts.items())
+            url = url.rstrip('/')
+        else:
+            opts = {}
+            url = self.path[1:].rstrip('/')
+
+        if url == 'favicon.ico':
+            self.sendBytes(404, 'text/plain', [b''])
+            return
+
+        argv = [Unquote(x) for x in url.split('/')] if url else []
+        if argv == ['batch']:
+            self.serveBatch(body)
+            return
+
+        if body and body.strip():
+            try:
+                obj = JsonLoads(BYTES2STR(body))
+                argv.extend(argsOfBody(obj))
+            except ValueError as e:
+                self.sendError(400, '请求的内容不是合法的 JSON 参数列表：%s' % e)
+                return
+            if isinstance(obj, dict):
+                opts.update((k, obj[k]) for k in LIST_OPTIONS if k in obj)
+
+        if argv[:1] == ['list'] and opts:
+            self.serveList(argv[1:], opts)
+            return
+
+        self.sendJSON(200, dict(zip(('result', 'err'),
+                                    self.term.Execute(argv, 'http'))))
+
+    # 分页、只取部分字段或以 NDJSON 格式流式返回的 list 命令，见文件开头的说明
+    def serveList(self, args, opts):
+        try:
+            cursor, limit, fields, fmt = listOptions(opts)
+        except ValueError as e:
+            self.sendError(400, 'list 命令的参数错误：%s' % e)
+            return
+
+        t, bot = time.time(), self.term.bot
+        try:
+            page, err = ListPage(bot.TermView(), args, cursor, limit, fields)
+            via = 'view'
+        except NotInDB as e:
+            DEBUG('%s 不在联系人数据库中，改到主线程中准备', e)
+            page, err = PutTask(ListPage, (bot, args, cursor, limit, fields),
+                                source='term', report=False).result()
+            via = 'main'
+
+        if page is None:
+            self.sendJSON(200, {'result': None, 'err': err})
+        elif fmt == 'ndjson':
+            def lines():
+                for item in page:
+                    yield ndjson(item)
+                yield ndjson({'next': page.next, 'count': page.count})
+            try:
+                self.sendBytes(200, 'application/x-ndjson;charset=utf-8',
+                               lines())
+            finally:
+                page.Close()
+        else:
+            items = list(page)
+            self.sendJSON(200, {'result': {'items': items, 'next': page.next},
+                                'err': None})
+
+        Inc('termserver_requests', proto='http', via=via)
+        Observe('termserver_latency', time.time() - t, via=via)
+
+    def serveBatch(self, body):
+        if not body:
+            self.sendError(400, '批量命令需要用 POST 请求提交')
+            return
+        try:
+            items, parallel = self.term.batch.Parse(JsonLoads(BYTES2STR(body)))
+        except (ValueError, BatchError) as e:
+            self.sendError(400, '批量命令格式错误：%s' % e)
+            return
+
+        def lines():
+            nDone = nFailed = 0
+            for index, key, result, err, replayed in \
+                    self.term.batch.Run(items, parallel):
+                if failed(result, err):
+                    nFailed += 1
+                else:
+                    nDone += 1
+                yield ndjson({'index': index, 'key': key, 'result': result,
+                              'err': err, 'replayed': replayed})
+            yield ndjson({'done': nDone, 'failed': nFailed})
+
+        t = time.time()
+        self.sendBytes(200, 'application/x-ndjson;charset=utf-8', lines(),
+                       stream=True)
+        Inc('termserver_requests', proto='http', via='batch')
+        Observe('termserver_latency', time.time() - t, via='batch')
+
+    def serveEvents(self, params):
+        events = self.term.events
+        try:
+            sub = events.Subscribe(params, self.headers.get('Last-Event-ID'))
+        except PushError as e:
+            self.sendError(400, '订阅参数错误：%s' % e)
+            return
+        if sub is None:
+            self.sendError(503, '订阅者过多')
+            return
+
+        Inc('termserver_requests', proto='http', via='events')
+        self.close_connection = True
+        try:
+            self.sendBytes(200, 'text/event-stream;charset=utf-8',
+                           events.Stream(sub), stream=True)
+        except socket.error as e:
+            DEBUG('QQBot-Term 服务器：订阅者 %s 已断开，%s',
+                  self.address_string(), e)
+        finally:
+            events.Unsubscribe(sub)
+
+    def sendError(self, code, err):
+        self.close_connection = True
+        self.sendJSON(code, {'result': None, 'err': err})
+
+    def sendJSON(self, code, obj):
+        encoder = json.JSONEncoder(ensure_ascii=False, indent=4)
+        self.sendBytes(code, 'application/json;charset=utf-8',
+                       (STR2BYTES(s) for s in encoder.iterencode(obj)))
+
+    # pieces: bytes 的迭代器。总长度不超过 chunkSize 时使用 Content-Length ，
+    # 否则以 chunked 方式（ HTTP/1.0 的客户端则在发送完后关闭连接）边生成边发送。
+    # stream 为 True 时立即发送应答头，每生成一段就发送一段
+    def sendBytes(self, code, contentType, pieces, stream=False):
+        pieces, buf, size = iter(pieces), [], 0
+        while not stream:
+            piece = next(pieces, None)
+            if piece is None:
+                body = b''.join(buf)
+                self.send_response(code)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            buf.append(piece)
+            size += len(piece)
+            if size >= self.term.chunkSize:
+                break
+
+        chunked = self.request_version != 'HTTP/1.0'
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        if not chunked or self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+        def flush():
+            data = b''.join(buf)
+            del buf[:]
+            if data and chunked:
+                data = STR2BYTES('%x\r\n' % len(data)) + data + b'\r\n'
+            self.wfile.write(data)
+
+        flush()
+        size = 0
+        for piece in pieces:
+            buf.append(piece)
+            size += len(piece)
+            if stream or size >= self.term.chunkSize:
+                flush()
+                size = 0
+        flush()
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+# NDJSON 的一行
+def ndjson(obj):
+    return STR2BYTES(JsonDumps(obj, ensure_ascii=False)) + b'\n'
+
+# 返回 (cursor, limit, fields, format) ，格式错误时抛出 ValueError
+def listOptions(opts):
+    cursor = opts.get('cursor') or None
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError('cursor 必须为字符串')
+
+    limit = opts.get('limit')
+    if limit is not None and limit != '':
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit 必须为正整数')
+    else:
+        limit = None
+
+    fields = opts.get('fields') or None
+    if isinstance(fields, str):
+        fields = [f for f in fields.split(',') if f]
+    if fields is not None and (not isinstance(fields, list) or
+                               not all(isinstance(f, str) for f in fields)):
+        raise ValueError('fields 必须为字段名的数组或以逗号分隔的字段名')
+
+    fmt = opts.get('format') or 'json'
+    if fmt not in ('json', 'ndjson'):
+        raise ValueError('format 必须为 json 或 ndjson')
+
+    return cursor, limit, fields or None, fmt
+
+# chunk 的长度（十六进制），格式错误时返回 None
+def hexSize(s):
+    try:
+        n = int(s.strip(), 16)
+    except ValueError:
+        return None
+    return n if n >= 0 else None
+
+# 'ctype=group,discuss&uin=1' -> {'ctype': ['group', 'discuss'], 'uin': ['1']}
+def parseQuery(query):
+    params = {}
+    for item in query.split('&'):
+        key, x, value = item.partition('=')
+        if key:
+            params.setdefault(Unquote(key), []).extend(
+                Unquote(v) for v in value.split(',') if v
+            )
+    return params
+
+# POST 的 body ： ["arg1", ...] 或 {"args": ["arg1", ...]}
+def argsOfBody(obj):
+    if isinstance(obj, dict):
+        obj = obj.get('args', [])
+    if not isinstance(obj, list) or \
+            any(isinstance(x, (list, dict)) or x is None for x in obj):
+        raise ValueError('参数必须为字符串或数字')
+    return [x if isinstance(x, str) else str(x) for x in obj]
+
+if __name__ == '__main__':
+    # 比较旧的 MySocketServer （单线程、每个请求一个连接）和本服务器在 8 个客户端
+    # 同时轮询 list group 时的吞吐量（使用本地的 MockSmartQQ ）
+    import tempfile
+    from qqbot.qconf import QConf
+    from qqbot.qqbotcls import QQBot
+    from qqbot.mocksmartqq import MockSmartQQ
+    from qqbot.basicqsession import BasicQSession
+    from qqbot.qcontactdb.qcontactdb import QContactDB
+    from qqbot.mysocketserver import MySocketServer
+    from qqbot.mainloop import MainLoop
+    from qqbot.common import StartDaemonThread
+    from qqbot.utf8logger import DisableLog, EnableLog
+
+    if PY3:
+        import http.client as httplib
+    else:
+        import httplib
+
+    server = MockSmartQQ(nGroups=20, nMembers=50)
+    server.Start()
+    BasicQSession.redirectTo = server.url
+    session = BasicQSession()
+    session.Login(QConf(['-b', tempfile.mkdtemp(), '-q', server.qq]))
+
+    bot = QQBot()
+    bot.plugins = {}
+    bot.contactdb = QContactDB(session, bot)
+    bot.List, bot.StrOfList, bot.ObjOfList = bot.contactdb.List, \
+        bot.contactdb.StrOfList, bot.contactdb.ObjOfList
+    bot.onUpdate = lambda *args: None
+    bot.contactdb.List('group')
+
+    # 旧的服务器：命令在主线程中执行，应答通过新线程发送
+    class oldServer(MySocketServer):
+        def onData(self, sock, addr, data):
+            future = PutTask(bot.onTermCommand, (data,), source='term',
+                             report=False)
+            StartDaemonThread(MySocketServer.onData, self, sock, addr, future)
+        def response(self, future):
+            return future.result()
+
+    StartDaemonThread(oldServer(HOST, 8191, 'old').Run)
+    term = QTermServer(8192, bot)
+    StartDaemonThread(term.Run)
+    StartDaemonThread(MainLoop)
+    time.sleep(0.5)
+
+    def oldClient(n):
+        for i in range(n):
+            sock = socket.create_connection((HOST, 8191))
+            sock.sendall(b'GET /list/group HTTP/1.1\r\nHost: x\r\n\r\n')
+            while sock.recv(65536):
+                pass
+            sock.close()
+
+    def newClient(n):
+        conn = httplib.HTTPConnection(HOST, 8192)
+        for i in range(n):
+            conn.request('GET', '/list/group')
+            assert JsonLoads(conn.getresponse().read())['result']
+        conn.close()
+
+    DisableLog()
+    for name, client in [('MySocketServer', oldClient),
+                         ('QTermServer', newClient)]:
+        t = time.time()
+        threads = [threading.Thread(target=client, args=(200,))
+                   for i in range(8)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        t = time.time() - t
+        print('%-15s %5.0f req/s' % (name, 1600 / t))
+
+    # 原始协议、 POST JSON 及超过 chunkSize 的应答
+    EnableLog()
+    sock = socket.create_connection((HOST, 8192))
+    sock.sendall(b'list group group1')
+    sock.shutdown(socket.SHUT_WR)
+    print(BYTES2STR(sock.recv(65536)))
+    conn = httplib.HTTPConnection(HOST, 8192)
+    conn.request('POST', '/list', '["group-member", "group1", "member3"]')
+    print(BYTES2STR(conn.getresponse().read()))
+    conn.request('GET', '/list/group-member/name:like:group')
+    resp = conn.getresponse()
+    print('%s, %d bytes' % (resp.getheader('Transfer-Encoding'),
+                            len(resp.read())))
+
+    # 列出所有群的全部成员：整个列表（ ObjOfList ）与逐页、 NDJSON 流式返回
+    DisableLog()
+    for path in ('/list/group-member/:like:group',
+                 '/list/group-member/:like:group?format=ndjson',
+                 '/list/group-member/:like:group?limit=200&fields=uin,name'):
+        t = time.time()
+        conn.request('GET', path)
+        n = len(conn.getresponse().read())
+        print('%-56s %6.1f ms, %7d bytes' % (path, (time.time() - t) * 1000, n))
+    server.Stop()
@@ -14,7 +14,8 @@ setup(
             'qq = qqbot:QTerm'
         ]
     },
-    install_requires = ['requests', 'certifi', 'apscheduler'],
+    install_requires = ['requests', 'certifi', 'apscheduler',
+                        'futures; python_version < "3"'],
     description = "QQBot: A conversation robot base on Tencent's SmartQQ",
     author = 'pandolia' ,
     author_email = 'pandolia@yeah.net',